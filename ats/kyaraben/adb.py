@@ -0,0 +1,349 @@
+"""
+
+A minimal asyncio client for the ADB wire protocol, talking directly to adbd
+on the Android VM (see ``protocol.txt`` in the AOSP adb sources).
+
+One transport connection is kept per device. Every command opens a stream
+on it (``shell:``, ``sync:``...), so many commands can run concurrently
+without spawning processes.
+
+"""
+
+import asyncio
+import re
+import struct
+import time
+
+from ats.kyaraben.process import quoted_cmdline
+
+
+A_SYNC = 0x434e5953
+A_CNXN = 0x4e584e43
+A_OPEN = 0x4e45504f
+A_OKAY = 0x59414b4f
+A_CLSE = 0x45534c43
+A_WRTE = 0x45545257
+A_AUTH = 0x48545541
+
+A_VERSION = 0x01000000
+MAX_PAYLOAD = 4096
+
+# sync: requests can't carry more than 64k of data
+SYNC_DATA_MAX = 64 * 1024
+
+HEADER = struct.Struct('<6I')
+
+
+class AdbError(Exception):
+    pass
+
+
+def checksum(data):
+    return sum(data) & 0xffffffff
+
+
+def pack_message(command, arg0, arg1, data=b''):
+    return HEADER.pack(command, arg0, arg1, len(data), checksum(data), command ^ 0xffffffff) + data
+
+
+def unpack_header(header):
+    """
+    returns:
+        (command, arg0, arg1, data_length)
+    """
+    command, arg0, arg1, length, _, magic = HEADER.unpack(header)
+    if magic != command ^ 0xffffffff:
+        raise AdbError('Invalid message header')
+    return command, arg0, arg1, length
+
+
+def sync_request(request_id, length_or_mode, data=b''):
+    return request_id + struct.pack('<I', length_or_mode) + data
+
+
+SHELL_STATUS_SUFFIX = '; __status=$?; echo; echo KYARABEN_STATUS=$__status'
+
+_re_shell_status = re.compile(rb'\r?\nKYARABEN_STATUS=(\d+)\r?\n$')
+
+
+def parse_shell_status(data):
+    """
+    Split the output of a command run with SHELL_STATUS_SUFFIX
+
+    returns:
+        (output, exit status)
+    """
+    m = _re_shell_status.search(data)
+    if not m:
+        raise AdbError('No exit status in the output of the command')
+    return data[:m.start()], int(m.group(1))
+
+
+class AdbStream:
+    """
+    One logical stream on a transport. Incoming data is buffered until read.
+    """
+
+    def __init__(self, connection, local_id):
+        self.connection = connection
+        self.local_id = local_id
+        self.remote_id = None
+        self.opened = connection.loop.create_future()
+        self.write_ready = asyncio.Event()
+        self.data_available = asyncio.Event()
+        self.buffer = bytearray()
+        self.closed = False
+        self.error = None
+
+    # called by the connection's reader
+
+    def on_okay(self, remote_id):
+        if not self.opened.done():
+            self.remote_id = remote_id
+            self.opened.set_result(True)
+        self.write_ready.set()
+
+    def on_data(self, data):
+        self.buffer.extend(data)
+        self.data_available.set()
+
+    def on_close(self, error=None):
+        self.closed = True
+        self.error = error
+        if not self.opened.done():
+            self.opened.set_exception(error or AdbError('Stream refused by the device'))
+        self.data_available.set()
+        self.write_ready.set()
+
+    # public interface
+
+    async def write(self, data):
+        view = memoryview(data)
+        while view:
+            chunk, view = view[:self.connection.max_payload], view[self.connection.max_payload:]
+            if self.closed:
+                raise self.error or AdbError('Stream closed')
+            self.write_ready.clear()
+            self.connection.send(A_WRTE, self.local_id, self.remote_id, bytes(chunk))
+            # the device acknowledges every WRTE before accepting another one
+            await self.write_ready.wait()
+
+    async def read_exactly(self, size):
+        while len(self.buffer) < size:
+            if self.closed:
+                raise self.error or AdbError('Stream closed after %d of %d bytes' % (len(self.buffer), size))
+            self.data_available.clear()
+            await self.data_available.wait()
+        ret = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return ret
+
+    async def read_all(self):
+        while not self.closed:
+            self.data_available.clear()
+            await self.data_available.wait()
+        if self.error:
+            raise self.error
+        ret = bytes(self.buffer)
+        self.buffer.clear()
+        return ret
+
+    def close(self):
+        if not self.closed:
+            if not self.connection.closed:
+                self.connection.send(A_CLSE, self.local_id, self.remote_id or 0)
+            self.connection.forget(self)
+            self.on_close()
+
+
+class AdbConnection:
+    """
+    A transport to a device running adbd over TCP.
+    """
+
+    def __init__(self, host, port, *, loop=None, connect_timeout=10):
+        self.host = host
+        self.port = port
+        self.loop = loop or asyncio.get_event_loop()
+        self.connect_timeout = connect_timeout
+        self.max_payload = MAX_PAYLOAD
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.streams = {}
+        self.next_local_id = 1
+        self.banner = None
+        self.closed = False
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port),
+            self.connect_timeout)
+        self.send(A_CNXN, A_VERSION, MAX_PAYLOAD, b'host::\0')
+
+        command, arg0, arg1, data = await asyncio.wait_for(self.read_message(), self.connect_timeout)
+        if command == A_AUTH:
+            self.close()
+            raise AdbError('Device %s:%s requires authentication' % (self.host, self.port))
+        if command != A_CNXN:
+            self.close()
+            raise AdbError('Unexpected reply to CNXN: %x' % command)
+
+        self.max_payload = min(arg1, 256 * 1024) or MAX_PAYLOAD
+        self.banner = data.rstrip(b'\0').decode('utf8', 'replace')
+        self.reader_task = self.loop.create_task(self.read_loop())
+
+    def send(self, command, arg0, arg1, data=b''):
+        if self.closed:
+            raise AdbError('Connection to %s:%s is closed' % (self.host, self.port))
+        self.writer.write(pack_message(command, arg0, arg1, data))
+
+    async def read_message(self):
+        command, arg0, arg1, length = unpack_header(await self.reader.readexactly(HEADER.size))
+        data = await self.reader.readexactly(length) if length else b''
+        return command, arg0, arg1, data
+
+    async def read_loop(self):
+        error = None
+        try:
+            while True:
+                command, arg0, arg1, data = await self.read_message()
+                # arg1 is our local id for OKAY, WRTE and CLSE
+                stream = self.streams.get(arg1)
+                if command == A_OKAY and stream:
+                    stream.on_okay(arg0)
+                elif command == A_WRTE:
+                    if stream:
+                        stream.on_data(data)
+                        self.send(A_OKAY, arg1, arg0)
+                    else:
+                        self.send(A_CLSE, 0, arg0)
+                elif command == A_CLSE and stream:
+                    self.forget(stream)
+                    stream.on_close()
+        except (asyncio.IncompleteReadError, ConnectionError, AdbError) as exc:
+            error = AdbError('Connection to %s:%s lost: %r' % (self.host, self.port, exc))
+        except asyncio.CancelledError:
+            error = AdbError('Connection to %s:%s closed' % (self.host, self.port))
+        finally:
+            self.closed = True
+            for stream in list(self.streams.values()):
+                stream.on_close(error)
+            self.streams.clear()
+
+    def forget(self, stream):
+        self.streams.pop(stream.local_id, None)
+
+    async def open(self, destination):
+        local_id = self.next_local_id
+        self.next_local_id += 1
+        stream = AdbStream(self, local_id)
+        self.streams[local_id] = stream
+        self.send(A_OPEN, local_id, 0, destination.encode('utf8') + b'\0')
+        await stream.opened
+        return stream
+
+    async def shell(self, *args):
+        """
+        Run a command and return (output, exit status). The v1 shell protocol
+        merges stdout and stderr, and does not report the exit status: the
+        command is followed by an echo of it.
+        """
+        command = quoted_cmdline(*args) + SHELL_STATUS_SUFFIX
+        stream = await self.open('shell:' + command)
+        try:
+            return parse_shell_status(await stream.read_all())
+        finally:
+            stream.close()
+
+    async def push(self, content, path, mode=0o644, mtime=None):
+        """
+        Write content (bytes) to a file on the device
+        """
+        reader = asyncio.StreamReader(loop=self.loop)
+        reader.feed_data(content)
+        reader.feed_eof()
+        await self.push_stream(reader, len(content), path, mode=mode, mtime=mtime)
+
+    async def push_stream(self, reader, size, path, mode=0o644, mtime=None):
+        """
+        Write a file to the device, with size bytes read from a StreamReader
+        """
+        if mtime is None:
+            mtime = int(time.time())
+        stream = await self.open('sync:')
+        try:
+            spec = '{},{}'.format(path, mode).encode('utf8')
+            await stream.write(sync_request(b'SEND', len(spec), spec))
+            remaining = size
+            while remaining:
+                chunk = await reader.readexactly(min(remaining, SYNC_DATA_MAX))
+                remaining -= len(chunk)
+                await stream.write(sync_request(b'DATA', len(chunk), chunk))
+            await stream.write(sync_request(b'DONE', mtime))
+
+            response = await stream.read_exactly(8)
+            if response[:4] == b'FAIL':
+                length = struct.unpack('<I', response[4:])[0]
+                message = await stream.read_exactly(length)
+                raise AdbError('push failed: %s' % message.decode('utf8', 'replace'))
+            if response[:4] != b'OKAY':
+                raise AdbError('push failed: unexpected response %r' % response)
+
+            await stream.write(sync_request(b'QUIT', 0))
+        finally:
+            stream.close()
+
+    def close(self):
+        self.closed = True
+        if self.reader_task:
+            self.reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+
+
+class AdbPool:
+    """
+    Keeps one connection per device, and reconnects when it has been lost.
+    """
+
+    def __init__(self, *, port, connect_timeout, loop=None):
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.loop = loop or asyncio.get_event_loop()
+        self.connections = {}
+        self.locks = {}
+
+    async def connection(self, key, host):
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+        async with lock:
+            conn = self.connections.get(key)
+            if conn and not conn.closed and conn.host == host:
+                return conn
+            if conn:
+                conn.close()
+            conn = AdbConnection(host, self.port, loop=self.loop, connect_timeout=self.connect_timeout)
+            await conn.connect()
+            self.connections[key] = conn
+            return conn
+
+    def cached(self, key):
+        """
+        Return the open connection for key, if any
+        """
+        conn = self.connections.get(key)
+        if conn and not conn.closed:
+            return conn
+        return None
+
+    def discard(self, key):
+        conn = self.connections.pop(key, None)
+        self.locks.pop(key, None)
+        if conn:
+            conn.close()
+
+    def close(self):
+        for key in list(self.connections):
+            self.discard(key)
@@ -0,0 +1,169 @@
+"""
+
+Fingerprint of an APK file: the SHA-256 of its content, and the SHA-256 of
+the certificate it is signed with (as printed by ``apksigner verify
+--print-certs``).
+
+Two APKs with the same content hash are the same build, and need not be
+installed twice. Two builds with the same signer can replace each other
+with ``adb install -r``; otherwise the installed package has to be removed
+first.
+
+The certificate is read from the v1 (JAR) signature block, a PKCS#7
+SignedData structure in META-INF/. APKs signed with the v2 scheme only have
+no signer fingerprint.
+
+The instrumentations declared in the manifest (the test packages run by
+``am instrument``) are read from the output of ``aapt dump xmltree``, so
+that the tests of a campaign are known before a device is booted.
+
+"""
+
+from collections import namedtuple
+import hashlib
+import re
+import zipfile
+
+
+APKFingerprint = namedtuple('APKFingerprint', 'sha256 signer')
+
+_re_signature_block = re.compile(r'^META-INF/[^/]+\.(RSA|DSA|EC)$')
+
+
+def der_header(data, offset):
+    """
+    Return (tag, start of the content, length of the content) of the DER
+    element at offset
+    """
+    tag = data[offset]
+    length = data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        size = length & 0x7f
+        if not size or offset + size > len(data):
+            raise ValueError('Unsupported DER length')
+        length = int.from_bytes(data[offset:offset + size], 'big')
+        offset += size
+    if offset + length > len(data):
+        raise ValueError('Truncated DER element')
+    return tag, offset, length
+
+
+def der_children(data, start, end):
+    """
+    (tag, element start, content start, element end) of the elements
+    between start and end
+    """
+    while start < end:
+        tag, content, length = der_header(data, start)
+        yield tag, start, content, content + length
+        start = content + length
+
+
+def signer_certificate(pkcs7):
+    """
+    DER encoding of the first certificate of a PKCS#7 SignedData
+    """
+    # ContentInfo ::= SEQUENCE { contentType OID, content [0] EXPLICIT SignedData }
+    tag, content, length = der_header(pkcs7, 0)
+    if tag != 0x30:
+        raise ValueError('Not a PKCS#7 ContentInfo')
+    for tag, _, explicit, explicit_end in der_children(pkcs7, content, content + length):
+        if tag != 0xa0:
+            continue
+        # SignedData ::= SEQUENCE { version, digestAlgorithms, encapContentInfo,
+        #                           certificates [0] IMPLICIT, ... }
+        tag, signed_data, signed_length = der_header(pkcs7, explicit)
+        signed_end = signed_data + signed_length
+        for tag, _, certs, certs_end in der_children(pkcs7, signed_data, signed_end):
+            if tag != 0xa0:
+                continue
+            for tag, start, _, end in der_children(pkcs7, certs, certs_end):
+                return pkcs7[start:end]
+    raise ValueError('No certificate in the signature block')
+
+
+def apk_signer(fileobj):
+    """
+    SHA-256 of the signing certificate, or None if it can't be found
+    """
+    try:
+        with zipfile.ZipFile(fileobj) as apk:
+            blocks = sorted(name for name in apk.namelist() if _re_signature_block.match(name))
+            if not blocks:
+                return None
+            certificate = signer_certificate(apk.read(blocks[0]))
+    except (zipfile.BadZipFile, ValueError, IndexError):
+        return None
+    return hashlib.sha256(certificate).hexdigest()
+
+
+def apk_fingerprint(fileobj):
+    """
+    fileobj: a binary file open for reading, positioned at the start
+    """
+    digest = hashlib.sha256()
+    while True:
+        chunk = fileobj.read(1024 * 1024)
+        if not chunk:
+            break
+        digest.update(chunk)
+    fileobj.seek(0)
+    return APKFingerprint(sha256=digest.hexdigest(), signer=apk_signer(fileobj))
+
+
+_re_xmltree_element = re.compile(r'^(?P<indent>\s*)E: (?P<name>\S+)')
+_re_xmltree_attribute = re.compile(r'^\s*A: (?:android:)?(?P<name>\w+)(?:\(0x[0-9a-f]+\))?="(?P<value>[^"]*)"')
+
+
+def apk_file_fingerprint(path):
+    with open(path, 'rb') as fin:
+        return apk_fingerprint(fin)
+
+
+def component_name(package, class_name):
+    """
+    Short form of a component, as listed by pm list instrumentation
+    """
+    if class_name.startswith('.'):
+        class_name = package + class_name
+    elif '.' not in class_name:
+        class_name = '{}.{}'.format(package, class_name)
+    if class_name.startswith(package + '.'):
+        class_name = class_name[len(package):]
+    return '{}/{}'.format(package, class_name)
+
+
+def parse_instrumentations(lines):
+    """
+    Instrumentations declared in the output of
+    aapt dump xmltree <apk> AndroidManifest.xml
+    """
+    package = None
+    instrumentations = []
+    element = None
+    attributes = {}
+
+    def close():
+        if element == 'instrumentation' and 'name' in attributes:
+            instrumentations.append(attributes['name'])
+
+    for line in lines:
+        m = _re_xmltree_element.match(line)
+        if m:
+            close()
+            element = m.group('name')
+            attributes = {}
+            continue
+        m = _re_xmltree_attribute.match(line)
+        if not m:
+            continue
+        if element == 'manifest' and m.group('name') == 'package':
+            package = m.group('value')
+        attributes[m.group('name')] = m.group('value')
+    close()
+
+    if package is None:
+        raise ValueError('No package in the manifest')
+
+    return [component_name(package, name) for name in instrumentations]
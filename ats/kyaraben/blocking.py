@@ -0,0 +1,31 @@
+"""
+
+Blocking file and CPU work, run in a thread pool instead of the event loop.
+
+A process serves all its requests or tasks from one thread: a callback that
+reads an upload or hashes a file delays every other one meanwhile. The work
+is run in a dedicated executor, apart from the default one that resolves
+host names.
+
+With asyncio.debug, the loop logs every callback that runs longer than
+asyncio.slow_callback_duration seconds, through the "asyncio" logger.
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def io_executor(config):
+    return ThreadPoolExecutor(max_workers=config['asyncio']['io_threads'])
+
+
+async def run_blocking(app, func, *args):
+    """
+    Return func(*args), called in the executor of the app
+    """
+    return await app.loop.run_in_executor(app.executor, func, *args)
+
+
+def setup_loop_debug(loop, config):
+    loop.set_debug(enabled=config['asyncio']['debug'])
+    loop.slow_callback_duration = config['asyncio']['slow_callback_duration']
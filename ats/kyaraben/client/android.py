@@ -164,6 +164,21 @@ class Delete(Command):
             self.app.LOG.info('Deleted %s', avm_id)
 
 
+class Reset(Command):
+    "Reset an Android VM to the state after its first boot"
+
+    def get_parser(self, prog_name):
+        ap = super().get_parser(prog_name)
+        self.app.add_auth_options(ap)
+        ap.add_argument('avm_id')
+        return ap
+
+    def take_action(self, parsed_args):
+        self.app.do_post('android', parsed_args.avm_id, 'reset',
+                         headers=self.app.auth_header(parsed_args))
+        self.app.LOG.info('Resetting %s', parsed_args.avm_id)
+
+
 class DisplayURL(Command):
     "URL to use for a NoVNC console"
 
@@ -0,0 +1,96 @@
+from cliff.command import Command
+from cliff.lister import Lister
+
+
+class Run(Command):
+    "Run a command on several virtual machines"
+
+    def get_parser(self, prog_name):
+        ap = super().get_parser(prog_name)
+        self.app.add_auth_options(ap)
+        ap.add_argument('command',
+                        choices=['monkey', 'testrun', 'apk_install'])
+        selector = ap.add_mutually_exclusive_group(required=True)
+        selector.add_argument('--avm', action='append', dest='avm_ids',
+                              help='run on this virtual machine')
+        selector.add_argument('--project',
+                              help='run on the READY virtual machines of this project')
+        selector.add_argument('--campaign',
+                              help='run on the READY virtual machines of this campaign')
+        ap.add_argument('--concurrency', type=int,
+                        help='max number of virtual machines running the command at once')
+        ap.add_argument('--package', action='append',
+                        help='monkey: run on this package; testrun: test package to run')
+        ap.add_argument('--event-count', type=int,
+                        help='monkey: number of events')
+        ap.add_argument('--throttle', type=int,
+                        help='monkey: throttle the events sent to the VM')
+        ap.add_argument('--apk',
+                        help='apk_install: APK to install')
+        return ap
+
+    def take_action(self, parsed_args):
+        self.app.LOG.debug('Requesting fleet command...')
+
+        payload = {
+            'command': parsed_args.command
+        }
+
+        if parsed_args.avm_ids:
+            payload['avm_ids'] = parsed_args.avm_ids
+        elif parsed_args.project:
+            payload['project_id'] = parsed_args.project
+        else:
+            payload['campaign_id'] = parsed_args.campaign
+
+        if parsed_args.concurrency:
+            payload['concurrency'] = parsed_args.concurrency
+
+        if parsed_args.command == 'monkey':
+            payload['packages'] = parsed_args.package
+            payload['event_count'] = parsed_args.event_count
+            if parsed_args.throttle:
+                payload['throttle'] = parsed_args.throttle
+        elif parsed_args.command == 'testrun':
+            if not parsed_args.package or len(parsed_args.package) > 1:
+                raise Exception('testrun requires a single --package')
+            payload['package'] = parsed_args.package[0]
+        else:
+            payload['apk_id'] = parsed_args.apk
+
+        r = self.app.do_post('fleet', 'commands',
+                             headers=self.app.auth_header(parsed_args),
+                             json=payload)
+
+        js = r.json()
+        batch_id = js['batch_id']
+
+        self.app.LOG.info('Running on %d virtual machines. To retrieve the results, '
+                          'run "kyaraben fleet command status %s"', js['avm_count'], batch_id)
+
+        print(batch_id)
+
+
+class Status(Lister):
+    "Show the results of a fleet command"
+
+    def get_parser(self, prog_name):
+        ap = super().get_parser(prog_name)
+        self.app.add_auth_options(ap)
+        ap.add_argument('batch_id')
+        return ap
+
+    def take_action(self, parsed_args):
+        self.app.LOG.debug('Requesting fleet command status...')
+
+        r = self.app.do_get('fleet', 'commands', parsed_args.batch_id,
+                            headers=self.app.auth_header(parsed_args))
+
+        js = r.json()
+        batch = js['batch']
+
+        self.app.LOG.info('%s: %s', batch['status'],
+                          ', '.join('%s=%d' % (status, count)
+                                    for status, count in sorted(batch['counts'].items())))
+
+        return self.app.list2fields(batch['commands'])
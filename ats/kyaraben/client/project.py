@@ -112,10 +112,18 @@ class Delete(Command):
         ap = super().get_parser(prog_name)
         self.app.add_auth_options(ap)
         ap.add_argument('project_id', nargs='+')
+        ap.add_argument('--force',
+                        action='store_true',
+                        help='remove the running vms and campaigns too')
         return ap
 
     def take_action(self, parsed_args):
+        params = {}
+        if parsed_args.force:
+            params['force'] = 'true'
+
         for project_id in parsed_args.project_id:
             self.app.do_delete('projects', project_id,
-                               headers=self.app.auth_header(parsed_args))
+                               headers=self.app.auth_header(parsed_args),
+                               params=params)
             self.app.LOG.info('Deleted %s', project_id)
@@ -0,0 +1,182 @@
+import argparse
+from cliff.command import Command
+from cliff.lister import Lister
+from cliff.show import ShowOne
+from pathlib import Path
+
+
+class Upload(Command):
+    "Add a trace of player events to a project"
+
+    def get_parser(self, prog_name):
+        ap = super().get_parser(prog_name)
+        self.app.add_auth_options(ap)
+        ap.add_argument('project_id')
+        ap.add_argument('file',
+                        type=argparse.FileType('rb'),
+                        help='trace file to upload, one JSON event per line: '
+                             '{"t": seconds, "key": routing_key, "payload": base64}')
+        ap.add_argument('--trace-name',
+                        help='name of the trace (defaults to the file name)')
+        return ap
+
+    def take_action(self, parsed_args):
+        self.app.LOG.debug('Requesting trace upload...')
+        project_id = parsed_args.project_id
+
+        filep = Path(parsed_args.file.name).absolute()
+
+        self.app.LOG.debug('project_id: %s', project_id)
+        self.app.LOG.debug('file: %s', filep)
+
+        files = {
+            'file': filep.open('rb')
+        }
+
+        data = {}
+        if parsed_args.trace_name is not None:
+            data['trace_name'] = parsed_args.trace_name
+
+        r = self.app.do_post('projects', project_id, 'traces',
+                             headers=self.app.auth_header(parsed_args),
+                             files=files,
+                             data=data)
+
+        js = r.json()
+
+        self.app.LOG.info('%d events, %.3f seconds', js['event_count'], js['duration'])
+        print(js['trace_id'])
+
+
+class List(Lister):
+    "List the traces in a project"
+
+    def get_parser(self, prog_name):
+        ap = super().get_parser(prog_name)
+        self.app.add_auth_options(ap)
+        ap.add_argument('project_id')
+        return ap
+
+    def take_action(self, parsed_args):
+        self.app.LOG.debug('Requesting trace list...')
+
+        project_id = parsed_args.project_id
+
+        r = self.app.do_get('projects', project_id, 'traces',
+                            headers=self.app.auth_header(parsed_args))
+
+        js = r.json()
+        traces = js['traces']
+
+        if not traces:
+            self.app.LOG.info('No trace found')
+
+        return self.app.list2fields(traces)
+
+
+class Delete(Command):
+    "Delete trace(s) from a project"
+
+    def get_parser(self, prog_name):
+        ap = super().get_parser(prog_name)
+        self.app.add_auth_options(ap)
+        ap.add_argument('project_id')
+        ap.add_argument('trace_id',
+                        nargs='+',
+                        help='traces to delete')
+        return ap
+
+    def take_action(self, parsed_args):
+        project_id = parsed_args.project_id
+
+        for trace_id in parsed_args.trace_id:
+            self.app.LOG.debug('Requesting trace delete...')
+            self.app.LOG.debug('project: %s - trace_id: %s', project_id, trace_id)
+
+            self.app.do_delete('projects', project_id, 'traces', trace_id,
+                               headers=self.app.auth_header(parsed_args))
+
+            self.app.LOG.info('Deleted %s', trace_id)
+
+
+class Replay(Command):
+    "Replay a trace on one or more virtual machines"
+
+    def get_parser(self, prog_name):
+        ap = super().get_parser(prog_name)
+        self.app.add_auth_options(ap)
+        ap.add_argument('project_id')
+        ap.add_argument('trace_id')
+        ap.add_argument('avm_id',
+                        nargs='+',
+                        help='virtual machines receiving the events')
+        ap.add_argument('--time-scale',
+                        type=float,
+                        help='speed of the replay (2 is twice as fast)')
+        return ap
+
+    def take_action(self, parsed_args):
+        self.app.LOG.debug('Requesting trace replay...')
+
+        payload = {
+            'avm_ids': parsed_args.avm_id
+        }
+
+        if parsed_args.time_scale is not None:
+            payload['time_scale'] = parsed_args.time_scale
+
+        r = self.app.do_post('projects', parsed_args.project_id,
+                             'traces', parsed_args.trace_id, 'replays',
+                             headers=self.app.auth_header(parsed_args),
+                             json=payload)
+
+        js = r.json()
+        print(js['replay_id'])
+
+
+class ReplayShow(ShowOne):
+    "Retrieve the progress of a trace replay"
+
+    def get_parser(self, prog_name):
+        ap = super().get_parser(prog_name)
+        self.app.add_auth_options(ap)
+        ap.add_argument('project_id')
+        ap.add_argument('replay_id')
+        return ap
+
+    def take_action(self, parsed_args):
+        self.app.LOG.debug('Showing replay')
+
+        r = self.app.do_get('projects', parsed_args.project_id,
+                            'replays', parsed_args.replay_id,
+                            headers=self.app.auth_header(parsed_args))
+
+        js = r.json()
+        replay = js['replay']
+
+        return self.dict2columns(replay)
+
+
+class ReplayStop(Command):
+    "Stop trace replay(s)"
+
+    def get_parser(self, prog_name):
+        ap = super().get_parser(prog_name)
+        self.app.add_auth_options(ap)
+        ap.add_argument('project_id')
+        ap.add_argument('replay_id',
+                        nargs='+',
+                        help='replays to stop')
+        return ap
+
+    def take_action(self, parsed_args):
+        project_id = parsed_args.project_id
+
+        for replay_id in parsed_args.replay_id:
+            self.app.LOG.debug('Requesting replay stop...')
+            self.app.LOG.debug('project: %s - replay_id: %s', project_id, replay_id)
+
+            self.app.do_delete('projects', project_id, 'replays', replay_id,
+                               headers=self.app.auth_header(parsed_args))
+
+            self.app.LOG.info('Stopping %s', replay_id)
@@ -12,10 +12,21 @@ options = [
     Option('amqp.hostname', default='127.0.0.1'),
     Option('amqp.admin_username', default='guest'),
     Option('amqp.admin_password', default='guest'),
+    Option('amqp.publish_channels', default=4,
+           help='number of channels a process publishes tasks on'),
+    Option('amqp.event_topology', default='per_service',
+           help='queues of the player events: per_service (7 per AVM) or per_avm (1 per AVM)'),
+    Option('amqp.event_credentials', default='per_avm',
+           help='RabbitMQ user of the players: per_avm (one each) or shared (amqp.event_username)'),
+    Option('amqp.event_username', default='android-events'),
+    Option('amqp.event_password', default=''),
     Option('orchestration.novnc_host',
            required=True,
            help='IP address/hostname of the player containers'),
     Option('orchestration.stackprefix', default=''),
+    Option('orchestration.avm_shards', default=16,
+           help='number of queues the interactive tasks are spread on, by avm_id. '
+                'Must be the same for all processes'),
     Option('openstack.os_auth_url', required=True),
     Option('openstack.insecure', default=False, required=False,
            help='Do not verify SSL certificate'),
@@ -24,19 +35,123 @@ options = [
     Option('openstack.os_username'),
     Option('openstack.os_password'),
     Option('openstack.floating_net', default='net04_ext'),
+    Option('openstack.volume_service', default='cinderv3',
+           help='name of the block storage API v3 in the service catalog'),
+    Option('openstack.data_snapshot', default=False,
+           help='Snapshot the data volume of the AVMs after the first boot, to reset them'),
+    Option('openstack.data_snapshot_boot_timeout', default=600,
+           help='seconds to wait for the first boot of an AVM, before it is READY '
+                'without a snapshot'),
+    Option('openstack.volume_timeout', default=300,
+           help='seconds to wait for a snapshot, or for a volume to be detached or reverted'),
+    Option('openstack.volume_poll_interval', default=1),
     Option('docker.host'),
     Option('docker.tls_verify', default=True),
     Option('db.dsn'),
+    Option('db.pool_spare', default=5,
+           help='connections of a worker beyond one per task it can run at once'),
     Option('quota.vm_async_max', default=1),
     Option('quota.vm_live_max', default=3),
     Option('openstack.template', default='android.yaml'),
     Option('worker.heat_poll_interval', default=5),
+    Option('worker.teardown_concurrency', default=10,
+           help='max number of AVMs removed at the same time by bulk deletions'),
+    Option('worker.batch_prefetch', default=1,
+           help='max number of campaign and project tasks run at the same time by a worker'),
+    Option('worker.device_prefetch', default=10,
+           help='max number of monkey and test runs, AVM resets and snapshots run at once '
+                'by a worker'),
+    Option('worker.drain_timeout', default=600,
+           help='seconds a stopping worker waits for its running tasks'),
+    Option('worker.metrics_interval', default=60,
+           help='seconds between two reports of the lane depths and task latencies'),
+    Option('worker.ledger_retention', default=60 * 60 * 24 * 7,
+           help='seconds before the progress of a task is forgotten'),
+    Option('worker.ledger_lease', default=60,
+           help='seconds before a task of a worker that died can run on another one'),
+    Option('compiler.concurrency', default=2,
+           help='max number of DSL, and of Java, compilations run at once by a worker'),
+    Option('compiler.queue_max', default=10,
+           help='compilations waiting for a compiler container, past which they are delayed'),
+    Option('compiler.lifetime', default=60 * 60,
+           help='seconds before a compiler container stops, it is not used past half of it'),
+    Option('compiler.max_uses', default=50,
+           help='compilations run by a compiler container before it is replaced'),
+    Option('camera.concurrency', default=2,
+           help='max number of camera file conversions run at once by a worker'),
+    Option('camera.queue_max', default=10,
+           help='camera file conversions waiting for a slot, past which they are delayed'),
+    Option('camera.output_format', default='v1',
+           help='tag of the output of video_create.sh, changed to convert cached files again'),
+    Option('asyncio.debug', default=False,
+           help='Enable the asyncio debug mode, and log the callbacks that block the loop'),
+    Option('asyncio.slow_callback_duration', default=0.1,
+           help='seconds a callback runs, past which it is logged in debug mode'),
+    Option('asyncio.io_threads', default=4,
+           help='threads of a process that read, write and hash the uploaded files'),
     Option('retry.delay_min', default=1,
            help='initial delay between retries'),
     Option('retry.delay_max', default=30,
            help='max delay between retries'),
     Option('retry.fail_timeout', default=60 * 60 * 24,
            help='after 24h, failed messages will be discarted'),
+    Option('retry.jitter', default=0.5,
+           help='fraction of the retry delay that is randomized'),
+    Option('retry.prefetch', default=200,
+           help='max number of failed messages received and not yet stored'),
+    Option('retry.batch_size', default=100,
+           help='max number of messages stored or released at once'),
+    Option('retry.flush_interval', default=1,
+           help='max seconds before received messages are stored'),
+    Option('retry.poll_interval', default=5,
+           help='max seconds between two checks of the retry schedule'),
+    Option('retry.claim_timeout', default=60,
+           help='seconds after which a message claimed by another instance can be released again'),
+    Option('retry.metrics_interval', default=60,
+           help='seconds between two reports of the retry throughput'),
+    Option('outbox.batch_size', default=100,
+           help='max number of queued tasks sent to the broker at once'),
+    Option('outbox.poll_interval', default=5,
+           help='max seconds between two checks of the task outbox'),
+    Option('trace.max_events', default=100000,
+           help='max number of events in an uploaded trace'),
+    Option('trace.max_avms', default=100,
+           help='max number of AVMs a trace is replayed on at once'),
+    Option('trace.batch_window', default=0.01,
+           help='events due within this many seconds are published together'),
+    Option('trace.progress_interval', default=5,
+           help='seconds between two updates of the replay status'),
+    Option('trace.replay_prefetch', default=20,
+           help='max number of replays run at the same time by a worker'),
+    Option('campaign.avm_reuse_limit', default=5,
+           help='max number of testruns with the same image and hwconfig run on one AVM (1 to disable)'),
+    Option('campaign.snapshot_reset', default=False,
+           help='Reset a reused AVM to the snapshot of its data volume, instead of '
+                'clearing or removing the packages of the previous testrun'),
+    Option('fleet.max_avms', default=200,
+           help='max number of AVMs a fleet command is run on'),
+    Option('fleet.concurrency', default=10,
+           help='default max number of AVMs running a fleet command at the same time'),
+    Option('fleet.max_concurrency', default=50,
+           help='max concurrency that can be requested for a fleet command'),
+    Option('monitor.reconcile_interval', default=300,
+           help='seconds between two reconciliations of Docker, Heat and AMQP with the DB'),
+    Option('monitor.stuck_timeout', default=60 * 60,
+           help='AVMs in CREATING, RESETTING or DELETING state for longer, '
+                'with no pending task, are repaired'),
+    Option('monitor.batch_size', default=20,
+           help='max number of leaked resources removed at once'),
+    Option('monitor.batch_interval', default=5,
+           help='seconds to wait between two batches of removals'),
+    Option('adb.native', default=False,
+           help='Talk to adbd on the AVMs directly, instead of running adb in the player containers'),
+    Option('adb.port', default=5555),
+    Option('adb.connect_timeout', default=10),
+    Option('device.state_ttl', default=30,
+           help='seconds before checking again whether a device has rebooted'),
+    Option('device.boot_wait', default=120,
+           help='seconds a campaign task waits for the boot of a device, before being delayed'),
+    Option('device.boot_poll_interval', default=1),
     Option('media.tempdir', default='/tmp'),
     Option('prjdata.apk_path', default='/data/project/apk/{apk_id}.apk'),
     Option('prjdata.camera_path', default='/data/project/camera/{camera_id}'),
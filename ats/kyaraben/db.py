@@ -0,0 +1,49 @@
+"""
+
+Database transactions.
+
+The queries of ats.util.db.sql() run on a connection of the pool in
+autocommit mode. A Transaction can be passed to sql() instead of the app or
+request, so that a group of queries, for instance the model changes of a
+handler and the tasks they publish, are committed together:
+
+    async with Transaction(request.app.dbpool) as tx:
+        await AndroidVM.insert(tx, ...)
+        await outbox_add(tx, 'avm_create', {...}, log=log)
+
+"""
+
+
+class Transaction:
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = None
+
+    @property
+    def dbpool(self):
+        # sql() takes its cursors from dbh.dbpool
+        return self
+
+    async def cursor(self, **kw):
+        return await self.conn.cursor(**kw)
+
+    async def execute(self, query):
+        with (await self.conn.cursor()) as cur:
+            await cur.execute(query)
+
+    async def __aenter__(self):
+        self.conn = await self.pool.acquire()
+        try:
+            await self.execute('BEGIN')
+        except Exception:
+            self.pool.release(self.conn)
+            self.conn = None
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+        finally:
+            self.pool.release(self.conn)
+            self.conn = None
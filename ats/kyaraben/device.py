@@ -0,0 +1,293 @@
+"""
+
+Run adb commands on the Android device of an AVM.
+
+With adb.native, when the address of the device is known, commands are
+multiplexed over a native ADB connection kept open in app.adb_pool.
+Otherwise (the default, or AVMs created before the address was recorded)
+they are run by the adb client of the {avm_id}_adb container.
+
+Both ways return a ProcWrap and raise ProcessError when the device can't
+be reached, so callers don't need to know which one was used.
+
+DeviceStateTracker follows the boot of the devices and keeps their
+properties, so that handlers and tasks don't query them on every call.
+
+install_apk() records the fingerprint of the APKs it installs on each
+device (see apkinfo.py), and does nothing when the same build is already
+installed.
+
+"""
+
+import asyncio
+from collections import namedtuple
+import os
+from pathlib import Path
+import re
+import tempfile
+import time
+
+from ats.kyaraben.adb import AdbError
+from ats.kyaraben.apkinfo import apk_file_fingerprint
+from ats.kyaraben.blocking import run_blocking
+from ats.kyaraben.docker import cmd_docker, cmd_docker_exec, cmd_docker_read_stream
+from ats.kyaraben.model.android import AndroidVM
+from ats.kyaraben.process import ProcessError, ProcWrap, quoted_cmdline
+
+
+def adb_container(avm_id):
+    return '{}_adb'.format(avm_id)
+
+
+def prj_container(project_id):
+    return '{}_prjdata'.format(project_id)
+
+
+async def device_address(app, avm_id):
+    if not app.config['adb']['native']:
+        return None
+    conn = app.adb_pool.cached(avm_id)
+    if conn:
+        return conn.host
+    return await AndroidVM(avm_id=avm_id).get_instance_ip(app)
+
+
+def adb_failure(app, avm_id, args, exc):
+    # the connection is likely broken, the next command will open a new one
+    app.adb_pool.discard(avm_id)
+    return ProcessError(args, ProcWrap(status=255,
+                                       stdout=b'',
+                                       stderr=str(exc).encode('utf8'),
+                                       strip=True))
+
+
+async def adb_shell(app, avm_id, *args, log):
+    host = await device_address(app, avm_id)
+    if host is None:
+        return await cmd_docker_exec(adb_container(avm_id), 'adb', 'shell', *args, log=log)
+
+    log.info('Running adb shell', avm_id=avm_id, command=quoted_cmdline(*args))
+    try:
+        conn = await app.adb_pool.connection(avm_id, host)
+        output, status = await conn.shell(*args)
+    except (AdbError, OSError, asyncio.TimeoutError) as exc:
+        raise adb_failure(app, avm_id, args, exc)
+
+    if status != 0:
+        # stdout and stderr are merged by the shell service
+        raise ProcessError(args, ProcWrap(status=status, stdout=output, stderr=output,
+                                          strip=True))
+
+    return ProcWrap(status=status, stdout=output, stderr=b'', strip=True)
+
+
+async def adb_install(app, avm_id, *, project_id, apk_path, log):
+    """
+    Install an APK from the project container, replacing the existing package.
+    """
+    host = await device_address(app, avm_id)
+    if host is None:
+        return await cmd_docker_exec(adb_container(avm_id), 'adb', 'install', '-r', apk_path, log=log)
+
+    remote_path = '/data/local/tmp/{}'.format(Path(apk_path).name)
+
+    async def push(reader, size):
+        log.info('Pushing APK', avm_id=avm_id, path=remote_path, size=size)
+        try:
+            conn = await app.adb_pool.connection(avm_id, host)
+            await conn.push_stream(reader, size, remote_path)
+        except (AdbError, OSError, asyncio.TimeoutError) as exc:
+            raise adb_failure(app, avm_id, ['push', remote_path], exc)
+
+    await cmd_docker_read_stream(container=prj_container(project_id),
+                                 path=apk_path,
+                                 consumer=push,
+                                 log=log)
+
+    try:
+        return await adb_shell(app, avm_id, 'pm', 'install', '-r', remote_path, log=log)
+    finally:
+        try:
+            await adb_shell(app, avm_id, 'rm', '-f', remote_path, log=log)
+        except ProcessError:
+            pass
+
+
+async def container_apk_fingerprint(app, *, project_id, apk_path, log):
+    """
+    Fingerprint of an APK of a project container, copied to a temporary file
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, Path(apk_path).name)
+        await cmd_docker('cp', '{}:{}'.format(prj_container(project_id), apk_path), path,
+                         log=log)
+        return await run_blocking(app, apk_file_fingerprint, path)
+
+
+async def prepare_install(app, avm_id, *, log):
+    """
+    Allow the install of APKs from outside the store, once per boot
+    """
+    state = await app.device_state.state(avm_id, log=log)
+    avm = AndroidVM(avm_id=avm_id)
+    if state.boot_id and await avm.get_install_boot_id(app) == state.boot_id:
+        return
+
+    await adb_shell(app, avm_id, 'settings', 'put', 'global', 'install_non_market_apps', '1', log=log)
+    await adb_shell(app, avm_id, 'settings', 'put', 'global', 'package_verifier_enable', '0', log=log)
+
+    await avm.set_install_boot_id(app, state.boot_id)
+
+
+async def install_apk(app, avm_id, *, project_id, apk, package_name, apk_path, log):
+    """
+    Install an APK, unless the same build is already on the device.
+
+    Return a ProcWrap like adb_install(), whose output contains 'Success'
+    if the package is installed.
+    """
+    avm = AndroidVM(avm_id=avm_id)
+
+    fingerprint = await apk.get_fingerprint(app)
+    if fingerprint is None:
+        # uploaded before the fingerprints, or built from a test source
+        fingerprint = await container_apk_fingerprint(app, project_id=project_id,
+                                                      apk_path=apk_path, log=log)
+        await apk.set_fingerprint(app, fingerprint)
+
+    try:
+        proc = await adb_shell(app, avm_id, 'pm', 'path', package_name, log=log)
+        present = proc.out.startswith('package:')
+    except ProcessError:
+        present = False
+
+    # only what kyaraben installed is known, the user may have replaced it since
+    installed = await avm.get_installed_package(app, package_name) if present else None
+
+    if installed and installed.sha256 == fingerprint.sha256:
+        log.info('APK already installed', avm_id=avm_id, apk_id=apk.apk_id, package=package_name)
+        return ProcWrap(status=0,
+                        stdout=b'Success (already installed)',
+                        stderr=b'',
+                        strip=True)
+
+    await prepare_install(app, avm_id, log=log)
+
+    if present and (fingerprint.signer is None
+                    or installed is None
+                    or installed.signer != fingerprint.signer):
+        # install -r fails if the signature has changed
+        try:
+            await adb_shell(app, avm_id, 'pm', 'uninstall', package_name, log=log)
+        except ProcessError:
+            pass
+
+    await avm.forget_installed_package(app, package_name)
+
+    proc = await adb_install(app, avm_id, project_id=project_id, apk_path=apk_path, log=log)
+
+    if 'Success' in proc.out:
+        await avm.set_installed_package(app, package=package_name, apk_id=apk.apk_id,
+                                        fingerprint=fingerprint)
+
+    return proc
+
+
+_re_parse_property = re.compile('\[(?P<key>[a-zA-Z0-9\-\.\_]+)\]\s*:\s+\[(?P<value>.*)\]')
+
+
+def parse_properties(lines, log):
+    ret = {}
+    for line in lines:
+        m = _re_parse_property.match(line)
+        if not m:
+            log.warning('Property line does not match: %s', line)
+            continue
+        ret[m.group('key')] = m.group('value')
+    return ret
+
+
+DeviceState = namedtuple('DeviceState', 'boot_id boot_completed properties checked')
+
+
+class DeviceStateTracker:
+    """
+    The properties of a device are read once per boot, after it has
+    completed. A boot is identified by the kernel boot_id: as long as it
+    does not change, the properties are served from memory, or from the
+    database when another process has read them first. The boot_id itself
+    is checked again after state_ttl seconds.
+    """
+
+    def __init__(self, app, *, state_ttl, boot_poll_interval):
+        self.app = app
+        self.state_ttl = state_ttl
+        self.boot_poll_interval = boot_poll_interval
+        self.states = {}
+
+    async def load(self, avm_id):
+        row = await AndroidVM(avm_id=avm_id).get_device_state(self.app)
+        if row is None:
+            return None
+        return DeviceState(boot_id=row.boot_id,
+                           boot_completed=row.boot_completed,
+                           properties=row.properties or {},
+                           checked=0)
+
+    async def read_boot_id(self, avm_id, log):
+        proc = await adb_shell(self.app, avm_id, 'cat', '/proc/sys/kernel/random/boot_id', log=log)
+        return proc.out
+
+    async def state(self, avm_id, *, log):
+        now = time.monotonic()
+        known = self.states.get(avm_id)
+        if known and known.boot_completed and now - known.checked < self.state_ttl:
+            return known
+
+        boot_id = await self.read_boot_id(avm_id, log)
+
+        if known is None:
+            known = await self.load(avm_id)
+
+        if known and known.boot_completed and known.boot_id == boot_id:
+            state = known._replace(checked=now)
+        else:
+            proc = await adb_shell(self.app, avm_id, 'getprop', log=log)
+            properties = parse_properties(proc.out_lines, log=log)
+            # or sys.boot_completed, should be the same
+            state = DeviceState(boot_id=boot_id,
+                                boot_completed=properties.get('dev.bootcomplete') == '1',
+                                properties=properties,
+                                checked=now)
+            if state.boot_completed or not known or known.boot_id != boot_id:
+                await AndroidVM(avm_id=avm_id).update_device_state(self.app,
+                                                                   boot_id=state.boot_id,
+                                                                   boot_completed=state.boot_completed,
+                                                                   properties=state.properties)
+            log.debug('device state read', avm_id=avm_id, boot_id=boot_id,
+                      boot_completed=state.boot_completed)
+
+        self.states[avm_id] = state
+        return state
+
+    async def wait_boot_completed(self, avm_id, *, timeout, log):
+        """
+        Return True as soon as the device has booted, or False after timeout
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                proc = await adb_shell(self.app, avm_id, 'getprop', 'dev.bootcomplete', log=log)
+                if proc.out == '1':
+                    state = await self.state(avm_id, log=log)
+                    if state.boot_completed:
+                        return True
+            except ProcessError:
+                # adbd is not up yet
+                pass
+            if time.monotonic() + self.boot_poll_interval > deadline:
+                return False
+            await asyncio.sleep(self.boot_poll_interval)
+
+    def forget(self, avm_id):
+        self.states.pop(avm_id, None)
@@ -1,10 +1,14 @@
 
+import asyncio
+from asyncio.subprocess import DEVNULL, PIPE
+import hashlib
+import io
 import os
-import shutil
 import pkg_resources
-import tempfile
+import posixpath
+import tarfile
 
-from ats.kyaraben.process import aiorun
+from ats.kyaraben.process import ProcessError, ProcWrap, aiorun, aiorun_lines, quoted_cmdline
 
 
 def docker_env(env=None):
@@ -29,6 +33,15 @@ async def cmd_docker(*args, log):
     return ret
 
 
+async def cmd_docker_lines(*args, log, callback):
+    ret = await aiorun_lines('docker',
+                             *args,
+                             log=log,
+                             callback=callback,
+                             env=docker_env())
+    return ret
+
+
 async def cmd_docker_exec(*args, log, stdin_bytes=None):
     ret = await aiorun('docker', 'exec',
                        *args,
@@ -46,13 +59,219 @@ async def cmd_docker_run(*args, log, stdin_bytes=None):
                        env=docker_env())
     return ret
 
-async def cmd_docker_cp(*, log, from_container, from_file,
-                        to_container, to_file, tempdir):
-    local_dir = tempfile.mkdtemp(dir=tempdir)
-    local_file = os.path.join(local_dir, 'file')
-    await cmd_docker('cp', '{}:{}'.format(from_container, from_file), local_file, log=log)
-    await cmd_docker('cp', local_file, '{}:{}'.format(to_container, to_file), log=log)
-    shutil.rmtree(local_dir)
+
+TAR_BLOCK = 512
+
+# extended headers, which apply to the next entry of the archive
+TAR_EXTENDED_TYPES = (b'x', b'g', b'L', b'K')
+
+TAR_REGULAR_TYPES = (b'0', b'\0')
+
+
+def tar_padded(size):
+    return -(-size // TAR_BLOCK) * TAR_BLOCK
+
+
+def tar_header_size(header):
+    """
+    Size of the content of a tar entry, from its header block
+    """
+    field = header[124:136]
+    if field[0] & 0x80:
+        # base-256, for sizes of 8 GiB and more
+        return int.from_bytes(bytes([field[0] & 0x7f]) + field[1:], 'big')
+    return int(field.rstrip(b'\0 ') or b'0', 8)
+
+
+def tar_rename(header, name):
+    """
+    Header block of a tar entry, with its name changed and the checksum updated
+    """
+    encoded = name.encode('utf8')
+    if len(encoded) > 100:
+        raise ValueError('Name too long for a tar header: %s' % name)
+    header = bytearray(header)
+    header[0:100] = encoded.ljust(100, b'\0')
+    # ustar prefix of the name
+    header[345:500] = bytes(155)
+    header[148:156] = b' ' * 8
+    header[148:156] = '{:06o}\0 '.format(sum(header)).encode('ascii')
+    return bytes(header)
+
+
+async def tar_read_file_header(reader):
+    """
+    Read up to the header block of the first file in a tar stream.
+    Extended headers are skipped: they hold the attributes of a long name.
+    """
+    while True:
+        header = await reader.readexactly(TAR_BLOCK)
+        typeflag = header[156:157]
+        if typeflag in TAR_EXTENDED_TYPES:
+            await reader.readexactly(tar_padded(tar_header_size(header)))
+            continue
+        if typeflag not in TAR_REGULAR_TYPES or header == bytes(TAR_BLOCK):
+            raise ValueError('Not a regular file')
+        return header
+
+
+async def tar_copy_content(reader, writer, *, size, digest):
+    """
+    Copy the content of a tar entry, and its padding
+    """
+    remaining = size
+    while remaining:
+        chunk = await reader.read(min(remaining, 1024 * 1024))
+        if not chunk:
+            raise asyncio.IncompleteReadError(b'', remaining)
+        digest.update(chunk)
+        writer.write(chunk)
+        await writer.drain()
+        remaining -= len(chunk)
+    writer.write(await reader.readexactly(tar_padded(size) - size))
+
+
+async def cmd_docker_cp(*, log, from_container, from_file, to_container, to_file, sha256=None):
+    """
+    Copy a file from a container to another, and return the SHA-256 of its content.
+
+    The archive written by "docker cp <file> -" is piped to "docker cp - <dir>",
+    and the file renamed on the way: nothing is written on the host. With sha256,
+    the copy fails, and the file is removed, if the content is not the expected one.
+    """
+    env = docker_env()
+
+    source_args = ('docker', 'cp', '{}:{}'.format(from_container, from_file), '-')
+    dest_args = ('docker', 'cp', '-', '{}:{}'.format(to_container, posixpath.dirname(to_file)))
+
+    source = await asyncio.create_subprocess_exec(*source_args, stdin=DEVNULL, stdout=PIPE,
+                                                  stderr=PIPE, env=env)
+    dest = await asyncio.create_subprocess_exec(*dest_args, stdin=PIPE, stdout=PIPE,
+                                                stderr=PIPE, env=env)
+
+    log.info('Running process', pid=source.pid, command=quoted_cmdline(*source_args))
+    log.info('Running process', pid=dest.pid, command=quoted_cmdline(*dest_args))
+
+    digest = hashlib.sha256()
+    failure = None
+    mismatch = False
+    # a partial file may have been written
+    written = False
+
+    try:
+        header = await tar_read_file_header(source.stdout)
+        dest.stdin.write(tar_rename(header, posixpath.basename(to_file)))
+        written = True
+        await tar_copy_content(source.stdout, dest.stdin,
+                               size=tar_header_size(header),
+                               digest=digest)
+        if sha256 is not None and digest.hexdigest() != sha256:
+            mismatch = True
+            failure = 'Checksum mismatch: {} instead of {}'.format(digest.hexdigest(), sha256)
+        else:
+            # end of the archive
+            dest.stdin.write(await source.stdout.read())
+            await dest.stdin.drain()
+    except (ValueError, asyncio.IncompleteReadError, ConnectionError) as exc:
+        failure = '{}: {}'.format(exc.__class__.__name__, exc)
+    finally:
+        dest.stdin.close()
+
+    if failure:
+        for proc in (source, dest):
+            if proc.returncode is None:
+                proc.kill()
+
+    results = []
+    for args, proc in ((source_args, source), (dest_args, dest)):
+        status = await proc.wait()
+        ret = ProcWrap(status=status,
+                       stdout=b'',
+                       stderr=await proc.stderr.read(),
+                       strip=True)
+        log.debug('Process exited', pid=proc.pid, status=status,
+                  stderr=ret.err_bytes.decode('utf8', 'replace'))
+        results.append((args, ret))
+
+    if failure and written:
+        await cmd_docker_exec(to_container, 'rm', '-f', to_file, log=log)
+
+    if failure:
+        # unless the copy was stopped here, a process that failed tells why
+        for args, ret in results:
+            if ret.status > 0 and not mismatch:
+                raise ProcessError(args, ret)
+        ret = ProcWrap(status=1, stdout=b'', stderr=failure.encode('utf8'), strip=True)
+        raise ProcessError(source_args + ('|',) + dest_args, ret)
+
+    for args, ret in results:
+        if ret.status != 0:
+            raise ProcessError(args, ret)
+
+    return digest.hexdigest()
+
+
+async def cmd_docker_read_file(*, log, container, path):
+    """
+    Return the content of a file in a container, as bytes
+    """
+    ret = await aiorun('docker', 'cp', '{}:{}'.format(container, path), '-',
+                       log=log,
+                       env=docker_env(),
+                       log_output=False)
+    with tarfile.open(fileobj=io.BytesIO(ret.out_bytes), mode='r:') as tar:
+        member = tar.next()
+        return tar.extractfile(member).read()
+
+
+async def cmd_docker_read_stream(*, log, container, path, consumer):
+    """
+    Return await consumer(reader, size), with a StreamReader positioned at
+    the content of a file in a container, and its size: the file is read
+    from the archive of "docker cp <file> -" without holding it in memory.
+    """
+    args = ('docker', 'cp', '{}:{}'.format(container, path), '-')
+
+    proc = await asyncio.create_subprocess_exec(*args, stdin=DEVNULL, stdout=PIPE,
+                                                stderr=PIPE, env=docker_env())
+
+    log.info('Running process', pid=proc.pid, command=quoted_cmdline(*args))
+
+    failure = None
+
+    try:
+        header = await tar_read_file_header(proc.stdout)
+        ret = await consumer(proc.stdout, tar_header_size(header))
+        # end of the archive
+        await proc.stdout.read()
+    except (ValueError, asyncio.IncompleteReadError) as exc:
+        failure = '{}: {}'.format(exc.__class__.__name__, exc)
+    except Exception:
+        if proc.returncode is None:
+            proc.kill()
+        await proc.wait()
+        raise
+
+    if failure and proc.returncode is None:
+        proc.kill()
+
+    status = await proc.wait()
+    result = ProcWrap(status=status,
+                      stdout=b'',
+                      stderr=await proc.stderr.read(),
+                      strip=True)
+    log.debug('Process exited', pid=proc.pid, status=status,
+              stderr=result.err_bytes.decode('utf8', 'replace'))
+
+    # unless the read was stopped here, the process tells why it failed
+    if status > 0 or (status != 0 and not failure):
+        raise ProcessError(args, result)
+
+    if failure:
+        raise ProcessError(args, ProcWrap(status=1, stdout=b'',
+                                          stderr=failure.encode('utf8'), strip=True))
+
+    return ret
 
 
 async def cmd_docker_inspect(*args, log):
@@ -0,0 +1,90 @@
+"""
+
+Commands run on a fleet of AVMs.
+
+A fleet command is stored as a batch (fleet_batches) with one avm_commands
+row per AVM, and its task is queued for at most `concurrency` of them at a
+time, so that a command on hundreds of AVMs does not fill the queues of
+the workers. The handler queues the first ones; each command, once done
+(completed, failed, or dropped because its AVM was deleted), releases its
+slot by queueing the next one.
+
+Both are written with the outbox in a single transaction: a slot is not
+lost if a worker dies, nor released twice if a message is redelivered.
+
+"""
+
+from ats.util.db import sql
+
+from .db import Transaction
+from .outbox import outbox_add
+
+
+# command name in the API -> task and its parameters
+FLEET_COMMANDS = {
+    'monkey': ('avm_monkey', ['packages', 'event_count', 'throttle']),
+    'testrun': ('avm_test_run', ['package']),
+    'apk_install': ('apk_install', ['project_id', 'apk_id']),
+}
+
+
+async def dispatch_commands(tx, *, batch_id, count, log):
+    """
+    Queue the tasks of up to count commands of the batch, return how many
+    """
+    rows = await sql(tx, """
+        UPDATE avm_commands
+           SET ts_dispatched = CURRENT_TIMESTAMP
+         WHERE command_id IN (
+                SELECT command_id
+                  FROM avm_commands
+                 WHERE batch_id = %s
+                       AND ts_dispatched IS NULL
+              ORDER BY command_id
+                 LIMIT %s
+                   FOR UPDATE SKIP LOCKED)
+     RETURNING command_id,
+               avm_id
+        """, [batch_id, count])
+
+    if not rows:
+        return 0
+
+    batches = await sql(tx, """
+        SELECT userid,
+               task,
+               params
+          FROM fleet_batches
+         WHERE batch_id = %s
+        """, [batch_id])
+
+    batch = batches[0]
+
+    for row in rows:
+        msg = dict(batch.params,
+                   userid=batch.userid,
+                   avm_id=row.avm_id,
+                   command_id=row.command_id,
+                   batch_id=batch_id)
+        # a single message per command
+        await outbox_add(tx, batch.task, msg, log=log, message_id=row.command_id)
+
+    return len(rows)
+
+
+async def release_slot(app, *, batch_id, command_id, log):
+    """
+    Called when a command of the batch is done: queue the next one
+    """
+    async with Transaction(app.dbpool) as tx:
+        rows = await sql(tx, """
+            UPDATE avm_commands
+               SET slot_released = TRUE
+             WHERE command_id = %s
+                   AND batch_id = %s
+                   AND NOT slot_released
+         RETURNING command_id
+            """, [command_id, batch_id])
+
+        if rows:
+            await dispatch_commands(tx, batch_id=batch_id, count=1, log=log)
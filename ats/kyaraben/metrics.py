@@ -0,0 +1,76 @@
+"""
+
+Event counters and timings of a process, periodically reported through
+the log as totals, rates per second, and average/max timings.
+
+"""
+
+import asyncio
+from collections import Counter
+import os
+import socket
+import time
+
+
+def instance_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class Meter:
+    def __init__(self, name, *, sink=None):
+        """
+        sink: optional callable, receives every report as a dict
+        """
+        self.name = name
+        self.sink = sink
+        self.instance = instance_name()
+        self.counts = Counter()
+        self.reported = Counter()
+        self.ts_reported = time.monotonic()
+        # name -> [count, total, max] since the last report
+        self.timings = {}
+
+    def mark(self, event, count=1):
+        self.counts[event] += count
+
+    def observe(self, name, seconds):
+        timing = self.timings.setdefault(name, [0, 0, 0])
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+
+    def report(self, log, **gauges):
+        now = time.monotonic()
+        elapsed = max(now - self.ts_reported, 1e-6)
+        rates = {
+            '{}_per_sec'.format(event): round((count - self.reported[event]) / elapsed, 2)
+            for event, count in self.counts.items()
+        }
+        for name, (count, total, maximum) in self.timings.items():
+            rates['{}_avg'.format(name)] = round(total / count, 3)
+            rates['{}_max'.format(name)] = round(maximum, 3)
+        log.info('%s metrics' % self.name,
+                 instance=self.instance,
+                 totals=dict(self.counts),
+                 **dict(rates, **gauges))
+        if self.sink:
+            self.sink({
+                'instance': self.instance,
+                'totals': dict(self.counts),
+                'rates': rates,
+                'gauges': gauges,
+            })
+        self.reported = Counter(self.counts)
+        self.ts_reported = now
+        self.timings = {}
+
+    async def report_forever(self, interval, log, gauges=None):
+        """
+        gauges: optional coroutine function returning a dict of current values
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.report(log, **(await gauges() if gauges else {}))
+            except Exception:
+                log.exception('could not report metrics')
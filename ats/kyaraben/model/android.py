@@ -154,6 +154,131 @@ class AndroidVM:
              WHERE avm_id = %s
             """, [stack_name, self.avm_id])
 
+    async def get_instance_ip(self, dbh):
+        rows = await sql(dbh, """
+            SELECT instance_ip
+              FROM avms
+             WHERE avm_id = %s
+            """, [self.avm_id])
+
+        if not rows:
+            return None
+
+        return rows[0].instance_ip
+
+    async def update_instance_ip(self, dbh, *, instance_ip):
+        await sql(dbh, """
+            UPDATE avms
+               SET instance_ip = %s
+             WHERE avm_id = %s
+            """, [instance_ip, self.avm_id])
+
+    async def get_device_state(self, dbh):
+        rows = await sql(dbh, """
+            SELECT boot_id,
+                   boot_completed,
+                   properties
+              FROM avms
+             WHERE avm_id = %s
+                   AND boot_id IS NOT NULL
+            """, [self.avm_id])
+
+        if not rows:
+            return None
+
+        return rows[0]
+
+    async def update_device_state(self, dbh, *, boot_id, boot_completed, properties):
+        await sql(dbh, """
+            UPDATE avms
+               SET boot_id = %s,
+                   boot_completed = %s,
+                   properties = %s
+             WHERE avm_id = %s
+            """, [boot_id, boot_completed, Json(properties), self.avm_id])
+
+    async def get_installed_package(self, dbh, package):
+        rows = await sql(dbh, """
+            SELECT apk_id,
+                   sha256,
+                   signer
+              FROM avm_packages
+             WHERE avm_id = %s
+                   AND package = %s
+            """, [self.avm_id, package])
+
+        if not rows:
+            return None
+
+        return rows[0]
+
+    async def set_installed_package(self, dbh, *, package, apk_id, fingerprint):
+        await sql(dbh, """
+            INSERT INTO avm_packages (
+                    avm_id, package, apk_id, sha256, signer
+                ) VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (avm_id, package) DO UPDATE
+               SET apk_id = EXCLUDED.apk_id,
+                   sha256 = EXCLUDED.sha256,
+                   signer = EXCLUDED.signer,
+                   ts_installed = CURRENT_TIMESTAMP
+            """, [self.avm_id, package, apk_id, fingerprint.sha256, fingerprint.signer])
+
+    async def forget_installed_package(self, dbh, package):
+        await sql(dbh, """
+            DELETE FROM avm_packages
+             WHERE avm_id = %s
+                   AND package = %s
+            """, [self.avm_id, package])
+
+    async def forget_installed_packages(self, dbh):
+        await sql(dbh, """
+            DELETE FROM avm_packages
+             WHERE avm_id = %s
+            """, [self.avm_id])
+
+    async def get_install_boot_id(self, dbh):
+        rows = await sql(dbh, """
+            SELECT install_boot_id
+              FROM avms
+             WHERE avm_id = %s
+            """, [self.avm_id])
+
+        return rows[0].install_boot_id
+
+    async def set_install_boot_id(self, dbh, boot_id):
+        await sql(dbh, """
+            UPDATE avms
+               SET install_boot_id = %s
+             WHERE avm_id = %s
+            """, [boot_id, self.avm_id])
+
+    async def get_data_snapshot(self, dbh):
+        rows = await sql(dbh, """
+            SELECT server_id,
+                   data_volume_id,
+                   data_snapshot_id
+              FROM avms
+             WHERE avm_id = %s
+            """, [self.avm_id])
+
+        return rows[0]
+
+    async def update_data_volume(self, dbh, *, server_id, data_volume_id):
+        await sql(dbh, """
+            UPDATE avms
+               SET server_id = %s,
+                   data_volume_id = %s
+             WHERE avm_id = %s
+            """, [server_id, data_volume_id, self.avm_id])
+
+    async def set_data_snapshot(self, dbh, snapshot_id):
+        await sql(dbh, """
+            UPDATE avms
+               SET data_snapshot_id = %s
+             WHERE avm_id = %s
+            """, [snapshot_id, self.avm_id])
+
     async def update(self, dbh, *, avm_name):
         await sql(dbh, """
             UPDATE avms
@@ -170,6 +295,74 @@ class AndroidVM:
              WHERE avm_id = %s
             """, [status, reason, self.avm_id])
 
+    async def get_status(self, dbh):
+        rows = await sql(dbh, """
+            SELECT status, status_reason
+              FROM avms
+             WHERE avm_id = %s
+            """, [self.avm_id])
+
+        if not rows:
+            return None, ''
+
+        return rows[0].status, rows[0].status_reason
+
+    async def container_down(self, dbh, *, service, reason):
+        """
+        One of the player containers has stopped: a READY AVM becomes unusable.
+        """
+        await sql(dbh, """
+            UPDATE avms
+               SET status = 'ERROR',
+                   status_ts = transaction_timestamp(),
+                   status_reason = %s
+             WHERE avm_id = %s
+                   AND status = 'READY'
+            """, ['container {} {}'.format(service, reason), self.avm_id])
+
+    async def container_up(self, dbh, *, service, still_down=None):
+        """
+        A player container is running again: undo container_down(), unless
+        other containers are still down ({service: reason}), in which case
+        the reason names one of them.
+        """
+        if still_down:
+            other = sorted(still_down)[0]
+            await sql(dbh, """
+                UPDATE avms
+                   SET status_reason = %s
+                 WHERE avm_id = %s
+                       AND status = 'ERROR'
+                       AND status_reason LIKE %s
+                """, ['container {} {}'.format(other, still_down[other]),
+                      self.avm_id, 'container {} %'.format(service)])
+            return
+
+        await sql(dbh, """
+            UPDATE avms
+               SET status = 'READY',
+                   status_ts = transaction_timestamp(),
+                   status_reason = ''
+             WHERE avm_id = %s
+                   AND status = 'ERROR'
+                   AND status_reason LIKE %s
+            """, [self.avm_id, 'container {} %'.format(service)])
+
+    @classmethod
+    async def set_status_many(cls, dbh, avm_ids, status, reason=''):
+        """
+        Update the status of several AVMs with a single statement.
+        """
+        if not avm_ids:
+            return
+        await sql(dbh, """
+            UPDATE avms
+               SET status = %s,
+                   status_ts = transaction_timestamp(),
+                   status_reason = %s
+             WHERE avm_id = ANY(%s)
+            """, [status, reason, list(avm_ids)])
+
     @classmethod
     async def count(cls, dbh, *, uid_owner):
         rows = await sql(dbh, """
@@ -198,6 +391,17 @@ class AndroidVM:
              WHERE avm_id = %s
             """, [ts_stopped, self.avm_id])
 
+    @classmethod
+    async def stop_billing_many(cls, dbh, avm_ids):
+        if not avm_ids:
+            return
+        ts_stopped = datetime.datetime.now()
+        await sql(dbh, """
+            UPDATE billing
+               SET ts_stopped = %s
+             WHERE avm_id = ANY(%s)
+            """, [ts_stopped, list(avm_ids)])
+
     hwconfig_defaults = {
         'width': 800,
         'height': 600,
@@ -1,4 +1,7 @@
 
+from psycopg2.extras import Json
+
+from ats.kyaraben.apkinfo import APKFingerprint
 from ats.util.db import sql, asdicts
 
 
@@ -38,16 +41,42 @@ class APK:
             return None
 
     @classmethod
-    async def insert(cls, dbh, *, apk_id, filename, project_id, package=''):
+    async def insert(cls, dbh, *, apk_id, filename, project_id, package='', fingerprint=None,
+                     instrumentations=None):
         await sql(dbh, """
             DELETE FROM project_apks
                   WHERE apk_id = %s
             """, [apk_id])
         await sql(dbh, """
             INSERT INTO project_apks (
-                    apk_id, filename, project_id, package
-                ) VALUES (%s, %s, %s, %s)
-            """, [apk_id, filename, project_id, package])
+                    apk_id, filename, project_id, package, sha256, signer, instrumentations
+                ) VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """, [apk_id, filename, project_id, package,
+                  fingerprint and fingerprint.sha256,
+                  fingerprint and fingerprint.signer,
+                  None if instrumentations is None else Json(instrumentations)])
+
+    @classmethod
+    async def instrumentations_many(cls, dbh, apk_ids):
+        """
+        The instrumentations declared by the APKs, in order, or None if
+        they are not known for one of them
+        """
+        rows = await sql(dbh, """
+            SELECT apk_id,
+                   instrumentations
+              FROM project_apks
+             WHERE apk_id = ANY(%s)
+            """, [list(apk_ids)])
+
+        declared = {row.apk_id: row.instrumentations for row in rows}
+
+        ret = []
+        for apk_id in apk_ids:
+            if declared.get(apk_id) is None:
+                return None
+            ret.extend(name for name in declared[apk_id] if name not in ret)
+        return ret
 
     @classmethod
     async def list(cls, dbh, *, userid, project_id):
@@ -97,6 +126,36 @@ class APK:
              WHERE apk_id = %s
             """, [package, self.apk_id])
 
+    async def get_fingerprint(self, dbh):
+        """
+        Return an APKFingerprint, or None if it has not been computed
+        """
+        rows = await sql(dbh, """
+            SELECT sha256,
+                   signer
+              FROM project_apks
+             WHERE apk_id = %s
+                   AND sha256 IS NOT NULL
+            """, [self.apk_id])
+
+        if not rows:
+            return None
+
+        return APKFingerprint(sha256=rows[0].sha256, signer=rows[0].signer)
+
+    async def set_fingerprint(self, dbh, fingerprint):
+        """
+        fingerprint=None when the file has changed, to compute it again
+        """
+        await sql(dbh, """
+            UPDATE project_apks
+               SET sha256 = %s,
+                   signer = %s
+             WHERE apk_id = %s
+            """, [fingerprint and fingerprint.sha256,
+                  fingerprint and fingerprint.signer,
+                  self.apk_id])
+
     async def set_status(self, dbh, status, reason=''):
         await sql(dbh, """
             UPDATE project_apks
@@ -51,7 +51,8 @@ class Camera:
             SELECT camera_id,
                    filename,
                    project_id,
-                   status
+                   status,
+                   transcode_seconds
               FROM project_camera
              WHERE project_id = %s
                    AND status <> 'DELETED'
@@ -68,3 +69,62 @@ class Camera:
                    status_reason = %s
              WHERE camera_id = %s
             """, [status, reason, self.camera_id])
+
+    async def set_transcode_seconds(self, dbh, seconds):
+        await sql(dbh, """
+            UPDATE project_camera
+               SET transcode_seconds = %s
+             WHERE camera_id = %s
+            """, [seconds, self.camera_id])
+
+
+class CameraCache:
+    """
+    The camera file converted from an uploaded file, by SHA-256 and extension
+    of the upload and output format of the conversion. An entry is removed
+    when its camera file is deleted.
+    """
+
+    @classmethod
+    async def get(cls, dbh, *, source_sha256, extension, output_format):
+        rows = await sql(dbh, """
+            SELECT camera_cache.camera_id,
+                   camera_cache.project_id
+              FROM camera_cache
+              JOIN project_camera ON project_camera.camera_id = camera_cache.camera_id
+             WHERE source_sha256 = %s
+                   AND extension = %s
+                   AND output_format = %s
+                   AND project_camera.status = 'READY'
+            """, [source_sha256, extension, output_format])
+
+        if not rows:
+            return None
+
+        return rows[0]
+
+    @classmethod
+    async def add(cls, dbh, *, source_sha256, extension, output_format, camera_id, project_id):
+        await sql(dbh, """
+            INSERT INTO camera_cache (
+                    source_sha256, extension, output_format, camera_id, project_id
+                ) VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (source_sha256, extension, output_format) DO UPDATE
+               SET camera_id = EXCLUDED.camera_id,
+                   project_id = EXCLUDED.project_id,
+                   ts_created = CURRENT_TIMESTAMP
+            """, [source_sha256, extension, output_format, camera_id, project_id])
+
+    @classmethod
+    async def forget_camera(cls, dbh, camera_id):
+        await sql(dbh, """
+            DELETE FROM camera_cache
+                  WHERE camera_id = %s
+            """, [camera_id])
+
+    @classmethod
+    async def forget_project(cls, dbh, project_id):
+        await sql(dbh, """
+            DELETE FROM camera_cache
+                  WHERE project_id = %s
+            """, [project_id])
@@ -143,6 +143,17 @@ class Campaign:
              WHERE campaign_id = %s
             """, [status, reason, self.campaign_id])
 
+    async def set_testrun_avm(self, dbh, *, testrun_id, avm_id):
+        """
+        Record the AVM that runs a testrun
+        """
+        await sql(dbh, """
+            UPDATE testruns
+               SET avm_id = %s
+             WHERE testrun_id = %s
+                   AND campaign_id = %s
+            """, [avm_id, testrun_id, self.campaign_id])
+
     async def command_statuses(self, dbh):
         """
         Query the status of all the test commands. Used to know
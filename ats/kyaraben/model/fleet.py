@@ -0,0 +1,92 @@
+from psycopg2.extras import Json
+
+from ats.util.db import sql, asdicts
+
+
+class FleetBatch:
+    def __init__(self, *, batch_id):
+        self.batch_id = batch_id
+
+    @classmethod
+    async def get(cls, dbh, *, batch_id, userid):
+        """
+        Async method to check for existence, which can't be done in __init__.
+        """
+
+        rows = await sql(dbh, """
+            SELECT 1 AS dummy
+              FROM fleet_batches
+             WHERE batch_id = %s
+                   AND userid = %s
+            """, [batch_id, userid])
+
+        if len(rows):
+            return cls(batch_id=batch_id)
+        else:
+            return None
+
+    @classmethod
+    async def insert(cls, dbh, *, batch_id, userid, task, params, concurrency,
+                     avm_commands, ts_request):
+        """
+        avm_commands: list of (avm_id, command_id)
+        """
+        await sql(dbh, """
+            INSERT INTO fleet_batches (
+                    batch_id, userid, task, params, concurrency
+                ) VALUES (%s, %s, %s, %s, %s)
+            """, [batch_id, userid, task, Json(params), concurrency])
+
+        values = []
+        params = []
+        for avm_id, command_id in avm_commands:
+            values.append('(%s, %s, %s, %s)')
+            params.extend([avm_id, command_id, ts_request, batch_id])
+
+        await sql(dbh, """
+            INSERT INTO avm_commands (
+                    avm_id, command_id, ts_request, batch_id
+                ) VALUES {}
+            """.format(', '.join(values)), params)
+
+    async def select(self, dbh):
+        rows = await sql(dbh, """
+            SELECT batch_id,
+                   task,
+                   params,
+                   concurrency,
+                   iso_timestamp(ts_created) AS ts_created
+              FROM fleet_batches
+             WHERE batch_id = %s
+            """, [self.batch_id])
+
+        batch = asdicts(rows)[0]
+
+        rows = await sql(dbh, """
+            SELECT avm_id,
+                   command_id,
+                   status,
+                   status_reason,
+                   COALESCE(proc_returncode::TEXT, '') AS returncode,
+                   COALESCE(proc_stdout, '') AS stdout,
+                   COALESCE(proc_stderr, '') AS stderr
+              FROM avm_commands
+             WHERE batch_id = %s
+          ORDER BY command_id
+            """, [self.batch_id])
+
+        commands = asdicts(rows)
+
+        counts = {status: 0 for status in ('QUEUED', 'RUNNING', 'READY', 'ERROR')}
+        for command in commands:
+            counts[command['status']] += 1
+
+        if counts['QUEUED'] == len(commands):
+            status = 'QUEUED'
+        elif counts['QUEUED'] or counts['RUNNING']:
+            status = 'RUNNING'
+        else:
+            status = 'FINISHED'
+
+        batch.update(status=status, counts=counts, commands=commands)
+        return batch
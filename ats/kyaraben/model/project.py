@@ -108,3 +108,29 @@ class Project:
                        AND status in ('QUEUED', 'RUNNING')
         """, [self.project_id, self.project_id])
         return bool(rows)
+
+    async def live_avms(self, dbh):
+        """
+        The AVMs of the project that have not been deleted.
+        """
+        rows = await sql(dbh, """
+            SELECT avm_id, project_id, stack_name
+              FROM avms
+             WHERE project_id = %s
+                   AND status <> 'DELETED'
+            """, [self.project_id])
+        return rows
+
+    async def cancel_campaigns(self, dbh):
+        """
+        Mark the queued and running campaigns as deleted, so that they
+        don't create new VMs.
+        """
+        await sql(dbh, """
+            UPDATE campaigns
+               SET status = 'DELETED',
+                   status_ts = transaction_timestamp(),
+                   status_reason = ''
+             WHERE project_id = %s
+                   AND status IN ('QUEUED', 'RUNNING')
+            """, [self.project_id])
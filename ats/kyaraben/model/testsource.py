@@ -130,3 +130,54 @@ class Testsource:
                    status_reason = %s
              WHERE testsource_id = %s
             """, [status, reason, self.testsource_id])
+
+
+class CompileCache:
+    """
+    The APK compiled from a DSL source, by SHA-256 of the source. An entry
+    is removed when the file of its APK is replaced or deleted.
+    """
+
+    @classmethod
+    async def get(cls, dbh, source_sha256):
+        rows = await sql(dbh, """
+            SELECT compile_cache.apk_id,
+                   compile_cache.project_id,
+                   compile_cache.package
+              FROM compile_cache
+              JOIN project_apks ON project_apks.apk_id = compile_cache.apk_id
+             WHERE source_sha256 = %s
+                   AND project_apks.status <> 'DELETED'
+            """, [source_sha256])
+
+        if not rows:
+            return None
+
+        return rows[0]
+
+    @classmethod
+    async def add(cls, dbh, *, source_sha256, apk_id, project_id, package):
+        await sql(dbh, """
+            INSERT INTO compile_cache (
+                    source_sha256, apk_id, project_id, package
+                ) VALUES (%s, %s, %s, %s)
+            ON CONFLICT (source_sha256) DO UPDATE
+               SET apk_id = EXCLUDED.apk_id,
+                   project_id = EXCLUDED.project_id,
+                   package = EXCLUDED.package,
+                   ts_created = CURRENT_TIMESTAMP
+            """, [source_sha256, apk_id, project_id, package])
+
+    @classmethod
+    async def forget_apk(cls, dbh, apk_id):
+        await sql(dbh, """
+            DELETE FROM compile_cache
+                  WHERE apk_id = %s
+            """, [apk_id])
+
+    @classmethod
+    async def forget_project(cls, dbh, project_id):
+        await sql(dbh, """
+            DELETE FROM compile_cache
+                  WHERE project_id = %s
+            """, [project_id])
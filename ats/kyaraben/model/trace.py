@@ -0,0 +1,172 @@
+from psycopg2.extras import Json
+
+from ats.util.db import sql, asdicts
+
+
+class Trace:
+    def __init__(self, *, trace_id):
+        self.trace_id = trace_id
+
+    @classmethod
+    async def get(cls, dbh, *, trace_id, project_id, userid):
+        """
+        Async method to check for existence, which can't be done in __init__.
+        """
+
+        rows = await sql(dbh, """
+            SELECT 1 AS dummy
+              FROM project_traces
+             WHERE trace_id = %s
+                   AND project_id = %s
+                   AND status <> 'DELETED'
+                   AND project_id IN (SELECT project_id FROM permission_projects WHERE userid = %s)
+            """, [trace_id, project_id, userid])
+
+        if len(rows):
+            return cls(trace_id=trace_id)
+        else:
+            return None
+
+    @classmethod
+    async def insert(cls, dbh, *, trace_id, trace_name, project_id, events):
+        await sql(dbh, """
+            INSERT INTO project_traces (
+                    trace_id, trace_name, project_id, events, event_count, duration
+                ) VALUES (%s, %s, %s, %s, %s, %s)
+            """, [trace_id, trace_name, project_id, Json(events), len(events), events[-1][0]])
+
+    @classmethod
+    async def list(cls, dbh, *, userid, project_id):
+        rows = await sql(dbh, """
+            SELECT trace_id,
+                   trace_name,
+                   project_id,
+                   event_count,
+                   duration,
+                   iso_timestamp(ts_created) AS ts_created,
+                   status
+              FROM project_traces
+             WHERE project_id = %s
+                   AND status <> 'DELETED'
+                   AND project_id IN (SELECT project_id FROM permission_projects WHERE userid = %s)
+          ORDER BY ts_created
+            """, [project_id, userid])
+
+        return asdicts(rows)
+
+    async def events(self, dbh):
+        rows = await sql(dbh, """
+            SELECT events
+              FROM project_traces
+             WHERE trace_id = %s
+            """, [self.trace_id])
+
+        return rows[0].events
+
+    async def set_status(self, dbh, status, reason=''):
+        await sql(dbh, """
+            UPDATE project_traces
+               SET status = %s,
+                   status_ts = transaction_timestamp(),
+                   status_reason = %s
+             WHERE trace_id = %s
+            """, [status, reason, self.trace_id])
+
+
+class TraceReplay:
+    def __init__(self, *, replay_id):
+        self.replay_id = replay_id
+
+    @classmethod
+    async def get(cls, dbh, *, replay_id, project_id, userid):
+        rows = await sql(dbh, """
+            SELECT 1 AS dummy
+              FROM trace_replays
+              JOIN project_traces USING (trace_id)
+             WHERE replay_id = %s
+                   AND project_id = %s
+                   AND project_id IN (SELECT project_id FROM permission_projects WHERE userid = %s)
+            """, [replay_id, project_id, userid])
+
+        if len(rows):
+            return cls(replay_id=replay_id)
+        else:
+            return None
+
+    @classmethod
+    async def insert(cls, dbh, *, replay_id, trace_id, avm_ids, time_scale):
+        await sql(dbh, """
+            INSERT INTO trace_replays (
+                    replay_id, trace_id, avm_ids, time_scale
+                ) VALUES (%s, %s, %s, %s)
+            """, [replay_id, trace_id, avm_ids, time_scale])
+
+    @classmethod
+    async def stop_many(cls, dbh, *, trace_id):
+        """
+        Ask the running replays of a trace to stop
+        """
+        await sql(dbh, """
+            UPDATE trace_replays
+               SET status = 'STOPPING',
+                   status_ts = transaction_timestamp()
+             WHERE trace_id = %s
+                   AND status IN ('QUEUED', 'RUNNING')
+            """, [trace_id])
+
+    async def select(self, dbh):
+        rows = await sql(dbh, """
+            SELECT replay_id,
+                   trace_id,
+                   avm_ids,
+                   time_scale,
+                   position,
+                   duration,
+                   events_published,
+                   max_lag,
+                   iso_timestamp(trace_replays.ts_created) AS ts_created,
+                   trace_replays.status,
+                   iso_timestamp(trace_replays.status_ts) AS status_ts,
+                   trace_replays.status_reason
+              FROM trace_replays
+              JOIN project_traces USING (trace_id)
+             WHERE replay_id = %s
+            """, [self.replay_id])
+
+        return asdicts(rows)[0]
+
+    async def get_status(self, dbh):
+        rows = await sql(dbh, """
+            SELECT status
+              FROM trace_replays
+             WHERE replay_id = %s
+            """, [self.replay_id])
+
+        return rows[0].status
+
+    async def set_status(self, dbh, status, reason=''):
+        await sql(dbh, """
+            UPDATE trace_replays
+               SET status = %s,
+                   status_ts = transaction_timestamp(),
+                   status_reason = %s
+             WHERE replay_id = %s
+            """, [status, reason, self.replay_id])
+
+    async def stop(self, dbh):
+        await sql(dbh, """
+            UPDATE trace_replays
+               SET status = 'STOPPING',
+                   status_ts = transaction_timestamp()
+             WHERE replay_id = %s
+                   AND status IN ('QUEUED', 'RUNNING')
+            """, [self.replay_id])
+
+    async def update_progress(self, dbh, *, position, events_published, max_lag):
+        await sql(dbh, """
+            UPDATE trace_replays
+               SET position = %s,
+                   events_published = %s,
+                   max_lag = %s
+             WHERE replay_id = %s
+            """, [position, events_published, max_lag, self.replay_id])
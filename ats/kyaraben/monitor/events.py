@@ -0,0 +1,149 @@
+"""
+
+Follow the Docker event stream of the host, and reflect the state of the
+player containers in the status of their AVM as soon as it changes.
+
+Once a player container is down, the events of the other ones don't change
+the AVM, which stays in ERROR. When a container is up again, the AVM is
+READY only if all its player containers are running: otherwise the reason
+names one of those still down.
+
+"""
+
+import asyncio
+import json
+import re
+import time
+
+from ats.kyaraben.docker import cmd_docker, cmd_docker_lines
+from ats.kyaraben.model.android import AndroidVM
+
+
+re_player_container = re.compile('^(?P<avm_id>[a-f0-9]{32})_(?P<service>[a-z]+)$')
+
+re_exited = re.compile(r'^Exited \((?P<code>-?\d+)\)')
+
+WATCHED_EVENTS = ['start', 'die', 'oom', 'health_status']
+
+
+def container_state(action, attributes):
+    """
+    Translate a container event to (is_up, reason), or None if the
+    event does not change the usability of the AVM.
+    """
+    if action == 'start':
+        return True, ''
+    if action == 'die':
+        return False, 'died (exit code {})'.format(attributes.get('exitCode', '?'))
+    if action == 'oom':
+        return False, 'ran out of memory'
+    if action == 'health_status: unhealthy':
+        return False, 'is unhealthy'
+    if action == 'health_status: healthy':
+        return True, ''
+    return None
+
+
+def down_containers(ps_lines):
+    """
+    Return {service: reason} for the player containers listed by docker ps
+    (name and status) that are not running, or unhealthy.
+    """
+    down = {}
+    for line in ps_lines:
+        if not line:
+            continue
+        name, status = line.split('\t', 1)
+        m = re_player_container.match(name)
+        if not m:
+            continue
+        m_exit = re_exited.match(status)
+        if m_exit:
+            down[m.group('service')] = 'died (exit code {})'.format(m_exit.group('code'))
+        elif not status.startswith('Up'):
+            down[m.group('service')] = 'is not running'
+        elif '(unhealthy)' in status:
+            down[m.group('service')] = 'is unhealthy'
+    return down
+
+
+class ContainerEventWatcher:
+    def __init__(self, app, *, restart_delay=5):
+        self.app = app
+        self.restart_delay = restart_delay
+        # resume from the last event after the stream is interrupted
+        self.since = None
+
+    def docker_args(self):
+        args = ['events',
+                '--filter', 'type=container',
+                '--filter', 'label=com.docker.compose.project',
+                '--format', '{{json .}}']
+        for event in WATCHED_EVENTS:
+            args.extend(['--filter', 'event=%s' % event])
+        if self.since:
+            args.extend(['--since', str(self.since)])
+        return args
+
+    async def list_containers(self, avm_id, log):
+        """
+        Return the lines "name<TAB>status" of the player containers of an AVM
+        """
+        proc = await cmd_docker('ps', '--all',
+                                '--filter', 'name=^{}_'.format(avm_id),
+                                '--format', '{{.Names}}\t{{.Status}}',
+                                log=log)
+        return proc.out_lines
+
+    async def handle_event(self, line, log):
+        try:
+            event = json.loads(line)
+        except ValueError:
+            log.warning('cannot decode docker event', line=line)
+            return
+
+        self.since = event.get('time', self.since)
+
+        actor = event.get('Actor', {})
+        attributes = actor.get('Attributes', {})
+        m = re_player_container.match(attributes.get('name', ''))
+        if not m:
+            return
+
+        state = container_state(event.get('Action', ''), attributes)
+        if state is None:
+            return
+
+        is_up, reason = state
+        avm = AndroidVM(avm_id=m.group('avm_id'))
+        service = m.group('service')
+
+        log.info('container event', avm_id=avm.avm_id, service=service,
+                 action=event.get('Action'), is_up=is_up)
+
+        if is_up:
+            still_down = down_containers(await self.list_containers(avm.avm_id, log))
+            # docker ps may not show the new state yet
+            still_down.pop(service, None)
+            await avm.container_up(self.app, service=service, still_down=still_down)
+        else:
+            await avm.container_down(self.app, service=service, reason=reason)
+
+    async def run_forever(self, log):
+        while True:
+            if self.since is None:
+                self.since = int(time.time())
+
+            async def callback(line):
+                try:
+                    await self.handle_event(line, log)
+                except Exception:
+                    log.exception('could not handle docker event', line=line)
+
+            try:
+                status = await cmd_docker_lines(*self.docker_args(), log=log, callback=callback)
+                log.warning('docker event stream ended', status=status)
+            except Exception:
+                log.exception('docker event stream failed')
+
+            await asyncio.sleep(self.restart_delay)
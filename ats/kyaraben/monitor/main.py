@@ -0,0 +1,109 @@
+import argparse
+import asyncio
+import os
+import sys
+import warnings
+
+import aiopg
+import psycopg2.extras
+import structlog
+
+from ats.kyaraben.blocking import setup_loop_debug
+from ats.kyaraben.config import config_get
+from ats.util.logging import setup_logging, setup_structlog
+from ats.kyaraben.tasks import ConnectionFactory
+from ats.kyaraben.lock import get_lock
+from ats.kyaraben.worker.amqp.admin import AMQPAdminGateway
+from ats.kyaraben.worker.openstack.cinderclient import CinderClient
+from ats.kyaraben.worker.openstack.gateway import OpenStackGateway
+from ats.kyaraben.worker.openstack.heatclient import HeatClient
+
+from .events import ContainerEventWatcher
+from .reconcile import Reconciler
+
+psycopg2.extras.register_uuid()
+# this definitely indicates a bug that must be fixed
+warnings.filterwarnings('error', 'coroutine .* was never awaited.*', category=RuntimeWarning)
+
+
+class App:
+    def __init__(self, *, config, args, loop):
+        self.config = config
+        self.args = args
+        self.loop = loop
+        self.log = structlog.get_logger()
+        self.dbpool = None
+        osgw = OpenStackGateway(config_os=config['openstack'], logger=self.log)
+        self.heat = HeatClient(osgw, config)
+        # the snapshots are removed with the stacks of the AVMs
+        self.cinder = CinderClient(osgw, config)
+        self.amqp_admin = None
+        self.reconciler = None
+        self.event_watcher = None
+
+    async def setup(self):
+        self.dbpool = await aiopg.create_pool(self.config['db']['dsn'])
+        self.amqp_connection_factory = ConnectionFactory(host=self.config['amqp']['hostname'],
+                                                         login=self.config['amqp']['admin_username'],
+                                                         password=self.config['amqp']['admin_password'])
+        self.amqp_admin = AMQPAdminGateway(config_amqp=self.config['amqp'], logger=self.log)
+        config_monitor = self.config['monitor']
+        self.reconciler = Reconciler(self,
+                                     batch_size=config_monitor['batch_size'],
+                                     batch_interval=config_monitor['batch_interval'],
+                                     stuck_timeout=config_monitor['stuck_timeout'],
+                                     ledger_retention=self.config['worker']['ledger_retention'],
+                                     dry_run=self.args.dry_run)
+        self.event_watcher = ContainerEventWatcher(self)
+
+    async def run(self):
+        log = self.log.bind(component='reconciler')
+        if self.args.once:
+            await self.reconciler.reconcile(log)
+        else:
+            self.loop.create_task(
+                self.reconciler.run_forever(self.config['monitor']['reconcile_interval'], log))
+            self.loop.create_task(
+                self.event_watcher.run_forever(self.log.bind(component='events')))
+
+
+async def init(*, loop, config, args):
+    app = App(config=config, args=args, loop=loop)
+    await app.setup()
+    await app.run()
+
+
+def get_parser():
+    ap = argparse.ArgumentParser()
+
+    ap.add_argument('--once',
+                    action='store_true',
+                    help='Run a single reconciliation, then quit')
+
+    ap.add_argument('--dry-run',
+                    action='store_true',
+                    help='Report the leaked resources without removing them')
+
+    return ap
+
+
+def main(argv=sys.argv[1:]):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+
+    config = config_get(environ=os.environ)
+    setup_logging(config)
+    setup_structlog(config)
+
+    loop = asyncio.get_event_loop()
+    setup_loop_debug(loop, config)
+
+    with get_lock('monitor', log=structlog.get_logger()):
+        loop.run_until_complete(init(loop=loop, config=config, args=args))
+        if args.once:
+            return
+        try:
+            loop.run_forever()
+            loop.close()
+        except KeyboardInterrupt:
+            pass
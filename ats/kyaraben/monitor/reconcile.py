@@ -0,0 +1,245 @@
+"""
+
+Compare the resources that exist on Docker, Heat and RabbitMQ with the
+status of AVMs and projects in the database, and clean up what has leaked:
+orphaned containers, stacks and AMQP users, and AVMs stuck in a transient
+state after a worker crash.
+
+"""
+
+import asyncio
+from collections import namedtuple
+import re
+
+from ats.kyaraben.docker import cmd_docker
+from ats.kyaraben.worker.amqp.admin import AMQPRestError
+from ats.kyaraben.worker.amqp.queues import delete_event_queues_many
+from ats.kyaraben.worker.ledger import purge_ledger
+from ats.kyaraben.worker.openstack.exceptions import AVMNotFoundError
+from ats.kyaraben.worker.tasks import avms_teardown
+from ats.util.db import sql
+
+
+re_buuid = re.compile('^[a-f0-9]{32}$')
+re_event_queue = re.compile('^android-events\.(?P<avm_id>[a-f0-9]{32})(\.|$)')
+re_compose_project = re.compile('^(?P<kind>avm|project)-(?P<entity_id>[a-f0-9]{32})$')
+re_stack_avm_id = re.compile('-[a-f0-9]{32}$')
+
+# an AVM is not supposed to stay long in these states.
+# A QUEUED AVM is not among them: its avm_create message is in the outbox
+# or the broker, maybe behind a busy shard, and will be delivered.
+TRANSIENT_STATUSES = ('CREATING', 'RESETTING', 'DELETING')
+
+AVMResources = namedtuple('AVMResources', 'avm_id project_id stack_name')
+
+Plan = namedtuple('Plan', 'containers stacks amqp_users stuck_deleting stuck_creating')
+
+
+class Reconciler:
+    def __init__(self, app, *, batch_size, batch_interval, stuck_timeout, ledger_retention, dry_run=False):
+        self.app = app
+        self.ledger_retention = ledger_retention
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.stuck_timeout = stuck_timeout
+        self.dry_run = dry_run
+        self.stack_prefix = app.config['orchestration']['stackprefix']
+
+    async def list_containers(self, log):
+        """
+        Return the containers created by docker-compose, by (kind, entity_id)
+        """
+        proc = await cmd_docker('ps', '--all',
+                                '--filter', 'label=com.docker.compose.project',
+                                '--format', '{{.Names}}\t{{.Label "com.docker.compose.project"}}',
+                                log=log)
+        containers = {}
+        for line in proc.out_lines:
+            if not line:
+                continue
+            name, compose_project = line.split('\t')
+            m = re_compose_project.match(compose_project)
+            if m:
+                containers.setdefault((m.group('kind'), m.group('entity_id')), []).append(name)
+        return containers
+
+    async def list_stacks(self, log):
+        return [stack['stack_name'] for stack in await self.app.heat.stack_list(log=log)]
+
+    async def list_amqp_users(self):
+        """
+        Return the avm_ids that own AMQP resources: a user named after the
+        avm_id, or event queues (with shared credentials there is no user)
+        """
+        avm_ids = {user for user in await self.app.amqp_admin.list_users() if re_buuid.match(user)}
+        for queue_name in await self.app.amqp_admin.list_queues('/'):
+            m = re_event_queue.match(queue_name)
+            if m:
+                avm_ids.add(m.group('avm_id'))
+        return sorted(avm_ids)
+
+    async def load_db_state(self, *, avm_ids, stack_names, project_ids):
+        """
+        Load in one query the live AVMs, and the status of every AVM and
+        project that owns an external resource.
+
+        An AVM has a pending task if one is still in the outbox, or has
+        not completed and was running or delivered again within
+        stuck_timeout: a task that waits (TaskDelay, busy device) or whose
+        worker died takes the ledger lease again on each delivery.
+        """
+        return await sql(self.app, """
+            SELECT 'avm' AS kind,
+                   avm_id AS entity_id,
+                   project_id,
+                   status,
+                   stack_name,
+                   EXTRACT(EPOCH FROM (CURRENT_TIMESTAMP - status_ts)) AS status_age,
+                   (EXISTS (SELECT 1
+                              FROM task_outbox
+                             WHERE task_outbox.body->>'avm_id' = avms.avm_id)
+                    OR EXISTS (SELECT 1
+                                 FROM task_ledger
+                                WHERE task_ledger.avm_id = avms.avm_id
+                                      AND NOT task_ledger.completed
+                                      AND (task_ledger.ts_lease_expires > CURRENT_TIMESTAMP
+                                           OR task_ledger.ts_updated > CURRENT_TIMESTAMP
+                                              - %s * INTERVAL '1 second'))) AS pending
+              FROM avms
+             WHERE status <> 'DELETED'
+                   OR avm_id = ANY(%s)
+                   OR stack_name = ANY(%s)
+         UNION ALL
+            SELECT 'project',
+                   project_id,
+                   project_id,
+                   status,
+                   NULL,
+                   EXTRACT(EPOCH FROM (CURRENT_TIMESTAMP - status_ts)),
+                   FALSE
+              FROM projects
+             WHERE project_id = ANY(%s)
+            """, [self.stuck_timeout, list(avm_ids), list(stack_names), list(project_ids)])
+
+    def plan(self, *, containers, stacks, amqp_users, rows):
+        avms = {row.entity_id: row for row in rows if row.kind == 'avm'}
+        projects = {row.entity_id: row for row in rows if row.kind == 'project'}
+
+        def gone(row):
+            return row is None or row.status == 'DELETED'
+
+        orphan_containers = []
+        for (kind, entity_id), names in sorted(containers.items()):
+            owners = avms if kind == 'avm' else projects
+            if gone(owners.get(entity_id)):
+                orphan_containers.extend(names)
+
+        stack_owners = {row.stack_name: row for row in avms.values() if row.stack_name}
+        orphan_stacks = []
+        for stack_name in stacks:
+            if stack_name in stack_owners:
+                if gone(stack_owners[stack_name]):
+                    orphan_stacks.append(stack_name)
+            elif self.stack_prefix and stack_name.startswith(self.stack_prefix + '-') \
+                    and re_stack_avm_id.search(stack_name):
+                # named like ours, but unknown to the database.
+                # Without a prefix we can't tell our stacks from the others.
+                orphan_stacks.append(stack_name)
+
+        orphan_users = [user for user in amqp_users if gone(avms.get(user))]
+
+        stuck = [row for row in avms.values()
+                 if row.status in TRANSIENT_STATUSES and row.status_age > self.stuck_timeout
+                 and not row.pending]
+
+        return Plan(containers=orphan_containers,
+                    stacks=orphan_stacks,
+                    amqp_users=orphan_users,
+                    stuck_deleting=[AVMResources(row.entity_id, row.project_id, row.stack_name)
+                                    for row in stuck if row.status == 'DELETING'],
+                    stuck_creating=[AVMResources(row.entity_id, row.project_id, row.stack_name)
+                                    for row in stuck if row.status != 'DELETING'])
+
+    async def in_batches(self, items, action):
+        """
+        Apply action to the items, batch_size at a time, pausing between batches
+        to avoid flooding Docker, Heat or RabbitMQ.
+        """
+        for idx in range(0, len(items), self.batch_size):
+            if idx:
+                await asyncio.sleep(self.batch_interval)
+            await action(items[idx:idx + self.batch_size])
+
+    async def remove_containers(self, names, log):
+        await cmd_docker('rm', '--force', '--volumes', *names, log=log)
+
+    async def remove_stacks(self, stack_names, log):
+        async def remove_stack(stack_name):
+            try:
+                await self.app.heat.stack_delete(stack_name=stack_name, log=log)
+            except AVMNotFoundError:
+                log.warning('stack already removed', stack_name=stack_name)
+
+        results = await asyncio.gather(*[remove_stack(stack_name) for stack_name in stack_names],
+                                       return_exceptions=True)
+        for stack_name, result in zip(stack_names, results):
+            if isinstance(result, Exception):
+                log.error('could not remove stack', stack_name=stack_name, exception=repr(result))
+
+    async def remove_amqp_users(self, avm_ids, log):
+        await delete_event_queues_many(self.app, log, avm_ids=avm_ids)
+        try:
+            await self.app.amqp_admin.delete_users(avm_ids)
+        except AMQPRestError as exc:
+            log.error('Could not remove AMQP users (%s)', exc)
+
+    async def reconcile(self, log):
+        # external resources are listed before reading the database, so that
+        # an AVM created in between is already known when its resources are.
+        containers = await self.list_containers(log)
+        stacks = await self.list_stacks(log)
+        amqp_users = await self.list_amqp_users()
+
+        rows = await self.load_db_state(
+            avm_ids={entity_id for kind, entity_id in containers if kind == 'avm'} | set(amqp_users),
+            stack_names=stacks,
+            project_ids={entity_id for kind, entity_id in containers if kind == 'project'})
+
+        plan = self.plan(containers=containers, stacks=stacks, amqp_users=amqp_users, rows=rows)
+
+        log.info('reconciliation plan',
+                 containers=len(plan.containers),
+                 stacks=len(plan.stacks),
+                 amqp_users=len(plan.amqp_users),
+                 stuck_deleting=len(plan.stuck_deleting),
+                 stuck_creating=len(plan.stuck_creating),
+                 dry_run=self.dry_run)
+
+        if self.dry_run:
+            log.info('reconciliation details', **plan._asdict())
+            return plan
+
+        await self.in_batches(plan.containers,
+                              lambda batch: self.remove_containers(batch, log))
+        await self.in_batches(plan.stacks,
+                              lambda batch: self.remove_stacks(batch, log))
+        await self.in_batches(plan.amqp_users,
+                              lambda batch: self.remove_amqp_users(batch, log))
+        await self.in_batches(plan.stuck_deleting,
+                              lambda batch: avms_teardown(self.app, log, avms=batch))
+        # removed rather than set in ERROR, which would keep their resources
+        await self.in_batches(plan.stuck_creating,
+                              lambda batch: avms_teardown(self.app, log, avms=batch,
+                                                          reason='stuck, no task in progress'))
+
+        await purge_ledger(self.app, retention=self.ledger_retention)
+
+        return plan
+
+    async def run_forever(self, interval, log):
+        while True:
+            try:
+                await self.reconcile(log)
+            except Exception:
+                log.exception('reconciliation failed')
+            await asyncio.sleep(interval)
@@ -0,0 +1,117 @@
+"""
+
+Transactional outbox of the tasks published by the server.
+
+A handler writes its tasks to the task_outbox table in the transaction of
+its model changes (see db.Transaction): if the transaction is rolled back,
+no task is published, and once it is committed the task will be, even if
+the broker is down at that time. The HTTP request does not wait for the
+broker either.
+
+OutboxRelay, run by the server, sends the outbox to the broker in batches
+(TaskBroker.publish_many) and deletes the rows once the broker has
+confirmed them. A crash in between publishes them again, with the same
+message ids, which the task ledger of the workers deduplicates. The relay
+is woken up by a notification when a transaction adds tasks, and polls the
+table in case a notification is lost.
+
+"""
+
+import asyncio
+import time
+import uuid
+
+from psycopg2.extras import Json
+import structlog
+
+from ats.util.db import sql
+
+from .db import Transaction
+from .tasks import OutgoingTask
+
+
+NOTIFY_CHANNEL = 'task_outbox'
+
+
+async def outbox_add(tx, task_name, msg, *, log, message_id=None):
+    """
+    Publish a task when the transaction tx is committed
+    """
+    message_id = message_id or uuid.uuid1().hex
+    log.info('queue task', msg, task=task_name, message_id=message_id)
+    await sql(tx, """
+        INSERT INTO task_outbox (
+            task, message_id, body, published
+        ) VALUES (%s, %s, %s, %s)
+        """, [task_name, message_id, Json(msg), time.time()])
+    # delivered on commit, once per transaction
+    await sql(tx, "SELECT pg_notify(%s, '') AS dummy", [NOTIFY_CHANNEL])
+    return message_id
+
+
+class OutboxRelay:
+    def __init__(self, app, *, batch_size, poll_interval):
+        self.app = app
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.log = structlog.get_logger()
+        self.listen_conn = None
+
+    async def setup(self):
+        self.listen_conn = await self.app.dbpool.acquire()
+        with (await self.listen_conn.cursor()) as cur:
+            await cur.execute('LISTEN {}'.format(NOTIFY_CHANNEL))
+
+    async def relay_batch(self):
+        """
+        Publish the oldest tasks of the outbox, return how many.
+
+        The rows stay locked until the broker confirms them, so that
+        several servers can relay the same outbox.
+        """
+        async with Transaction(self.app.dbpool) as tx:
+            rows = await sql(tx, """
+                SELECT outbox_id,
+                       task,
+                       message_id,
+                       body,
+                       published
+                  FROM task_outbox
+                 ORDER BY outbox_id
+                 LIMIT %s
+                   FOR UPDATE SKIP LOCKED
+                """, [self.batch_size])
+
+            if not rows:
+                return 0
+
+            await self.app.task_broker.publish_many([
+                OutgoingTask(row.task, row.body, message_id=row.message_id, published=row.published)
+                for row in rows
+            ], log=self.log)
+
+            await sql(tx, """
+                DELETE FROM task_outbox
+                 WHERE outbox_id = ANY(%s)
+                """, [[row.outbox_id for row in rows]])
+
+        self.log.debug('outbox relayed', count=len(rows))
+        return len(rows)
+
+    async def wait_notify(self):
+        await self.listen_conn.notifies.get()
+        while not self.listen_conn.notifies.empty():
+            self.listen_conn.notifies.get_nowait()
+
+    async def run_forever(self):
+        while True:
+            try:
+                while await self.relay_batch() == self.batch_size:
+                    pass
+            except Exception:
+                # the rows are still there, they will be sent on the next round
+                self.log.exception('outbox relay failed')
+            try:
+                await asyncio.wait_for(self.wait_notify(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
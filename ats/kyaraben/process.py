@@ -1,6 +1,6 @@
 
 import asyncio
-from asyncio.subprocess import PIPE
+from asyncio.subprocess import DEVNULL, PIPE
 import re
 import shlex
 
@@ -55,7 +55,8 @@ async def aiorun(*args,
                  strip=True,
                  ignore_errors=False,
                  env=None,
-                 cwd=None):
+                 cwd=None,
+                 log_output=True):
 
     proc = await asyncio.create_subprocess_exec(
         *args,
@@ -85,10 +86,13 @@ async def aiorun(*args,
         stderr=stderr,
         strip=strip)
 
-    try:
-        log_out = ret.out
-    except UnicodeDecodeError:
-        log_out = 'Could not decode: ' + str(ret.out_bytes)
+    if not log_output:
+        log_out = '%d bytes' % len(ret.out_bytes)
+    else:
+        try:
+            log_out = ret.out
+        except UnicodeDecodeError:
+            log_out = 'Could not decode: ' + str(ret.out_bytes)
 
     try:
         log_err = ret.err
@@ -101,3 +105,57 @@ async def aiorun(*args,
         raise ProcessError(args, ret)
     else:
         return ret
+
+
+# bytes of stderr logged at once by aiorun_lines
+STDERR_CHUNK = 4096
+
+
+async def aiorun_lines(*args,
+                       log,
+                       callback,
+                       env=None,
+                       cwd=None):
+    """
+    Run a long-lived process, and await callback() for each line it writes
+    on stdout. Return the exit status once the process terminates.
+
+    stderr is read, and logged, while the process runs: a process that
+    filled the pipe would stop.
+    """
+
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=DEVNULL,
+        stdout=PIPE,
+        stderr=PIPE,
+        env=env,
+        cwd=cwd)
+
+    log.info('Running process', pid=proc.pid, command=quoted_cmdline(*args))
+
+    async def read_stderr():
+        while True:
+            data = await proc.stderr.read(STDERR_CHUNK)
+            if not data:
+                break
+            log.warning('Process stderr', pid=proc.pid, stderr=data.decode('utf8', 'replace'))
+
+    stderr_reader = asyncio.ensure_future(read_stderr())
+
+    try:
+        while True:
+            line = await proc.stdout.readline()
+            if not line:
+                break
+            await callback(line.decode('utf8').rstrip('\n'))
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+
+    status = await proc.wait()
+    await stderr_reader
+
+    log.debug('Process exited', pid=proc.pid, status=status)
+
+    return status
@@ -6,13 +6,17 @@ import sys
 import time
 import warnings
 
+import aiopg
 import psycopg2.extras
 import structlog
 
+from ats.kyaraben.blocking import setup_loop_debug
 from ats.kyaraben.config import config_get
 from ats.util.logging import setup_logging, setup_structlog
-from ats.kyaraben.tasks import ConnectionFactory
-from ats.kyaraben.lock import get_lock
+from ats.kyaraben.tasks import ConnectionFactory, all_routing_keys
+from ats.kyaraben.metrics import Meter
+
+from .schedule import RetrySchedule, backoff_delay
 
 psycopg2.extras.register_uuid()
 # this definitely indicates a bug that must be fixed
@@ -20,10 +24,38 @@ warnings.filterwarnings('error', 'coroutine .* was never awaited.*', category=Ru
 
 
 class TaskCollector:
-    def __init__(self, connection_factory, delay_min, delay_max):
+    """
+    Collect the failed tasks from the dead-letter queue, and publish them
+    again when their retry is due.
+
+    Incoming messages are acknowledged in batches, once their schedule is
+    stored: a message that can't be scheduled must be rejected before the
+    batch is acknowledged. Due messages are published back to their
+    original exchange.
+
+    Any number of collectors can run: RabbitMQ spreads the failed messages
+    among them, and each due message is claimed in the database by the
+    collector that publishes it.
+    """
+
+    def __init__(self, connection_factory, schedule, meter, *, delay_min, delay_max, jitter,
+                 prefetch, batch_size, flush_interval, poll_interval, claim_timeout, routing_keys):
         self.connection_factory = connection_factory
-        self.delay_min_ms = delay_min * 1000
-        self.delay_max_ms = delay_max * 1000
+        self.routing_keys = routing_keys
+        self.schedule = schedule
+        self.meter = meter
+        self.delay_min = delay_min
+        self.delay_max = delay_max
+        self.jitter = jitter
+        self.prefetch = prefetch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.poll_interval = poll_interval
+        self.claim_timeout = claim_timeout
+        # (delivery_tag, schedule entry) received but not stored yet
+        self.pending = []
+        self.flush_lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
 
     async def setup(self):
         transport, protocol = await self.connection_factory()
@@ -37,7 +69,7 @@ class TaskCollector:
                                                     type_name='direct',
                                                     durable=True,
                                                     auto_delete=False)
-        await self.consume_channel.basic_qos(prefetch_count=1,
+        await self.consume_channel.basic_qos(prefetch_count=self.prefetch,
                                              prefetch_size=0,
                                              connection_global=False)
         await self.consume_channel.queue_declare(queue_name='orchestration.retry',
@@ -46,34 +78,111 @@ class TaskCollector:
                                                  arguments={
                                                      'x-dead-letter-exchange': 'orchestration.failed'
                                                  })
-        await self.consume_channel.queue_bind(queue_name='orchestration.retry',
-                                              exchange_name='orchestration.retry',
-                                              routing_key='orchestration')
+        # the dead-lettered messages keep the routing key of their queue
+        for routing_key in self.routing_keys:
+            await self.consume_channel.queue_bind(queue_name='orchestration.retry',
+                                                  exchange_name='orchestration.retry',
+                                                  routing_key=routing_key)
         await self.consume_channel.queue_declare(queue_name='orchestration.failed',
                                                  durable=True,
                                                  exclusive=False)
-        await self.consume_channel.queue_bind(queue_name='orchestration.failed',
-                                              exchange_name='orchestration.failed',
-                                              routing_key='orchestration')
+        for routing_key in self.routing_keys:
+            await self.consume_channel.queue_bind(queue_name='orchestration.failed',
+                                                  exchange_name='orchestration.failed',
+                                                  routing_key=routing_key)
 
-    async def repost(self, body, properties, log):
-        headers = properties.headers
+    def schedule_entry(self, body, properties, log):
+        headers = dict(properties.headers)
         retries = headers.get('x-kyaraben-retries', 0) + 1
-        headers['x-delay'] = min(self.delay_max_ms, int(self.delay_min_ms * 1.5 ** retries))
+        delay = backoff_delay(retries,
+                              delay_min=self.delay_min,
+                              delay_max=self.delay_max,
+                              jitter=self.jitter)
         headers['x-kyaraben-retries'] = retries
-        log.info('repost task with delay %s msecs', headers['x-delay'])
+        # retries don't go through the delayed-message exchange
+        headers.pop('x-delay', None)
+        log.info('retry task in %.1f secs', delay, retries=retries)
         death = headers.pop('x-death')[0]
         properties = {
             'message_id': properties.message_id,
             'timestamp': properties.timestamp,
             'content_type': properties.content_type,
             'delivery_mode': properties.delivery_mode,
-            'headers': properties.headers,
+            'headers': headers,
         }
-        await self.publish_channel.publish(payload=body,
-                                           exchange_name=death['exchange'],
-                                           properties=properties,
-                                           routing_key=death['routing-keys'][0])
+        return (time.time() + delay, death['exchange'], death['routing-keys'][0], body, properties)
+
+    async def collect(self, delivery_tag, entry):
+        self.pending.append((delivery_tag, entry))
+        if len(self.pending) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.pending:
+                return
+            pending, self.pending = self.pending, []
+            last_tag = max(delivery_tag for delivery_tag, _ in pending)
+            try:
+                await self.schedule.add_many([entry for _, entry in pending])
+            except Exception:
+                await self.consume_channel.basic_client_nack(delivery_tag=last_tag, multiple=True, requeue=True)
+                raise
+            await self.consume_channel.basic_client_ack(delivery_tag=last_tag, multiple=True)
+            self.meter.mark('received', len(pending))
+            self.wakeup.set()
+
+    async def flush_forever(self, log):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception('could not store the retry schedule')
+
+    async def release(self, log):
+        """
+        Publish the due messages, batch_size at a time. Return the number of
+        published messages.
+        """
+        rows = await self.schedule.claim_due(time.time(), self.batch_size,
+                                             owner=self.meter.instance,
+                                             claim_timeout=self.claim_timeout)
+        published = []
+        try:
+            for row in rows:
+                await self.publish_channel.publish(payload=bytes(row.body),
+                                                   exchange_name=row.exchange,
+                                                   properties=row.properties,
+                                                   routing_key=row.routing_key)
+                published.append(row.retry_id)
+        finally:
+            # not published, let any instance try again
+            await self.schedule.unclaim_many([row.retry_id for row in rows[len(published):]])
+            await self.schedule.remove_many(published)
+        self.meter.mark('released', len(published))
+        if published:
+            log.info('tasks released', count=len(published))
+        return len(published)
+
+    async def release_forever(self, log):
+        while True:
+            self.wakeup.clear()
+            next_due = self.schedule.next_due()
+            # the messages stored by other instances are due at most poll_interval late
+            timeout = self.poll_interval if next_due is None else next_due - time.time()
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), min(timeout, self.poll_interval))
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+            try:
+                while await self.release(log) == self.batch_size:
+                    pass
+            except Exception:
+                log.exception('could not release tasks')
+                await asyncio.sleep(self.poll_interval)
 
     async def consume(self, callback):
         await self.consume_channel.basic_consume(callback,
@@ -87,15 +196,32 @@ class App:
         self.args = args
         self.loop = loop
         self.log = structlog.get_logger()
+        self.dbpool = None
         self.task_collector = None
+        self.meter = Meter('retry')
 
     async def setup(self):
+        self.dbpool = await aiopg.create_pool(self.config['db']['dsn'])
         self.amqp_connection_factory = ConnectionFactory(host=self.config['amqp']['hostname'],
                                                          login=self.config['amqp']['admin_username'],
                                                          password=self.config['amqp']['admin_password'])
+        config_retry = self.config['retry']
+        schedule = RetrySchedule(self)
+        count = await schedule.load()
+        self.log.info('retry schedule loaded', scheduled=count)
         self.task_collector = TaskCollector(self.amqp_connection_factory,
-                                            delay_min=self.config['retry']['delay_min'],
-                                            delay_max=self.config['retry']['delay_max'])
+                                            schedule,
+                                            self.meter,
+                                            delay_min=config_retry['delay_min'],
+                                            delay_max=config_retry['delay_max'],
+                                            jitter=config_retry['jitter'],
+                                            prefetch=config_retry['prefetch'],
+                                            batch_size=config_retry['batch_size'],
+                                            flush_interval=config_retry['flush_interval'],
+                                            poll_interval=config_retry['poll_interval'],
+                                            claim_timeout=config_retry['claim_timeout'],
+                                            routing_keys=all_routing_keys(
+                                                self.config['orchestration']['avm_shards']))
         await self.task_collector.setup()
 
     async def consume(self, channel, body, envelope, properties):
@@ -103,11 +229,20 @@ class App:
             log = self.log.bind(delivery_tag=envelope.delivery_tag, message_id=properties.message_id)
             if time.time() - properties.timestamp > self.config['retry']['fail_timeout']:
                 log.warning('message discarded (fail timeout)')
+                self.meter.mark('discarded')
                 await channel.basic_client_nack(delivery_tag=envelope.delivery_tag, multiple=False, requeue=False)
             else:
                 log.debug('got message', headers=properties.headers, body=body.decode('utf8'))
-                await self.task_collector.repost(body, properties, log=log)
-                await channel.basic_client_ack(delivery_tag=envelope.delivery_tag)
+                try:
+                    entry = self.task_collector.schedule_entry(body, properties, log=log)
+                except Exception:
+                    # otherwise acknowledged, and lost, with the next batch
+                    log.exception('message cannot be scheduled, sent to orchestration.failed')
+                    self.meter.mark('discarded')
+                    await channel.basic_client_nack(delivery_tag=envelope.delivery_tag,
+                                                    multiple=False, requeue=False)
+                    return
+                await self.task_collector.collect(envelope.delivery_tag, entry)
         except Exception:
             log.exception()
             raise
@@ -115,6 +250,14 @@ class App:
     async def run(self):
         self.log.info('waiting for messages')
         await self.task_collector.consume(callback=self.consume)
+        self.loop.create_task(self.task_collector.flush_forever(self.log))
+        self.loop.create_task(self.task_collector.release_forever(self.log))
+        self.loop.create_task(self.meter.report_forever(self.config['retry']['metrics_interval'],
+                                                        self.log,
+                                                        gauges=self.gauges))
+
+    async def gauges(self):
+        return {'backlog': await self.task_collector.schedule.backlog()}
 
 
 async def init(loop, config, args):
@@ -134,17 +277,15 @@ def main(argv=sys.argv[1:]):
     setup_structlog(config)
 
     loop = asyncio.get_event_loop()
-    # asyncio debugging
-    loop.set_debug(enabled=False)
+    setup_loop_debug(loop, config)
 
     parser = get_parser()
     args = parser.parse_args(argv)
 
     loop.run_until_complete(init(loop=loop, config=config, args=args))
 
-    with get_lock('retry', log=structlog.get_logger()):
-        try:
-            loop.run_forever()
-            loop.close()
-        except KeyboardInterrupt:
-            pass
+    try:
+        loop.run_forever()
+        loop.close()
+    except KeyboardInterrupt:
+        pass
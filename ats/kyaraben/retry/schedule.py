@@ -0,0 +1,156 @@
+"""
+
+Due times of the failed tasks waiting to be retried.
+
+The messages are stored in PostgreSQL, so that they survive a restart of
+kyaraben-retry and can be shared by several instances. Each instance keeps
+the due times of the messages it stored in a heap, to release them on time;
+the messages stored by the other instances are found by polling.
+
+"""
+
+import datetime
+import heapq
+import random
+import time
+
+from psycopg2.extras import Json
+
+from ats.util.db import sql
+
+
+def backoff_delay(retries, *, delay_min, delay_max, jitter):
+    """
+    Exponential backoff in seconds, with a random part to spread the
+    retries of tasks that failed together.
+    """
+    delay = min(delay_max, delay_min * 1.5 ** retries)
+    return max(delay_min, delay * (1 - jitter * random.random()))
+
+
+class DueHeap:
+    """
+    (due timestamp, retry_id) ordered by due time
+    """
+
+    def __init__(self):
+        self.heap = []
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, due, retry_id):
+        heapq.heappush(self.heap, (due, retry_id))
+
+    def next_due(self):
+        if not self.heap:
+            return None
+        return self.heap[0][0]
+
+    def pop_due(self, now, limit):
+        ret = []
+        while self.heap and self.heap[0][0] <= now and len(ret) < limit:
+            ret.append(heapq.heappop(self.heap)[1])
+        return ret
+
+
+class RetrySchedule:
+    def __init__(self, dbh):
+        self.dbh = dbh
+        self.due = DueHeap()
+
+    async def load(self):
+        rows = await sql(self.dbh, """
+            SELECT retry_id,
+                   EXTRACT(EPOCH FROM ts_due) AS due
+              FROM retry_schedule
+            """)
+        for row in rows:
+            self.due.push(float(row.due), row.retry_id)
+        return len(rows)
+
+    async def add_many(self, entries):
+        """
+        entries: list of (due, exchange, routing_key, body, properties)
+        """
+        if not entries:
+            return
+        values = []
+        params = []
+        for due, exchange, routing_key, body, properties in entries:
+            values.append('(%s, %s, %s, %s, %s)')
+            params.extend([datetime.datetime.utcfromtimestamp(due),
+                           exchange, routing_key, body, Json(properties)])
+        rows = await sql(self.dbh, """
+            INSERT INTO retry_schedule (
+                ts_due, exchange, routing_key, body, properties
+            ) VALUES {}
+            RETURNING retry_id
+            """.format(', '.join(values)), params)
+        for (due, *_), row in zip(entries, rows):
+            self.due.push(due, row.retry_id)
+
+    def next_due(self):
+        return self.due.next_due()
+
+    async def claim_due(self, now, limit, *, owner, claim_timeout):
+        """
+        Reserve and return the messages due at the given time, at most limit.
+
+        Several instances share the table: a message is claimed by a single
+        one, unless the claim is older than claim_timeout (the instance
+        likely died before publishing it).
+        """
+        rows = await sql(self.dbh, """
+            UPDATE retry_schedule
+               SET claimed_by = %s,
+                   ts_claimed = CURRENT_TIMESTAMP
+             WHERE retry_id IN (
+                    SELECT retry_id
+                      FROM retry_schedule
+                     WHERE ts_due <= %s
+                           AND (claimed_by IS NULL
+                                OR ts_claimed < CURRENT_TIMESTAMP - %s * INTERVAL '1 second')
+                     ORDER BY ts_due
+                     LIMIT %s
+                       FOR UPDATE SKIP LOCKED)
+         RETURNING retry_id,
+                   exchange,
+                   routing_key,
+                   body,
+                   properties
+            """, [owner, datetime.datetime.utcfromtimestamp(now), claim_timeout, limit])
+
+        # the heap only tells when to look, the rows are claimed in the table.
+        # Past a failed claim, the due entries are kept to try again.
+        self.due.pop_due(now, len(self.due))
+
+        return rows
+
+    async def unclaim_many(self, retry_ids):
+        """
+        Release the claim of messages that could not be published: they are
+        due again at once
+        """
+        await sql(self.dbh, """
+            UPDATE retry_schedule
+               SET claimed_by = NULL,
+                   ts_claimed = NULL
+             WHERE retry_id = ANY(%s)
+            """, [list(retry_ids)])
+        now = time.time()
+        for retry_id in retry_ids:
+            self.due.push(now, retry_id)
+
+    async def remove_many(self, retry_ids):
+        await sql(self.dbh, """
+            DELETE FROM retry_schedule
+             WHERE retry_id = ANY(%s)
+            """, [list(retry_ids)])
+
+    async def backlog(self):
+        rows = await sql(self.dbh, """
+            SELECT COUNT(*) AS count
+              FROM retry_schedule
+            """)
+        return rows[0].count
@@ -2,8 +2,12 @@
 import aiopg
 from aiohttp import web
 
+from ats.kyaraben.adb import AdbPool
+from ats.kyaraben.blocking import io_executor
+from ats.kyaraben.device import DeviceStateTracker
 from ats.kyaraben.model.android import AndroidVM
 from ats.kyaraben.model.project import Project
+from ats.kyaraben.outbox import OutboxRelay
 from ats.kyaraben.tasks import TaskBroker, ConnectionFactory
 
 from .handlers.gateway import GatewayHandler
@@ -11,9 +15,11 @@ from .handlers.android import AndroidHandler
 from .handlers.apk import APKHandler
 from .handlers.camera import CameraFileHandler
 from .handlers.campaign import CampaignHandler
+from .handlers.fleet import FleetHandler
 from .handlers.image import ImageHandler
 from .handlers.project import ProjectHandler
 from .handlers.testsource import TestsourceHandler
+from .handlers.trace import TraceHandler
 from .handlers.user import UserHandler
 
 
@@ -23,6 +29,13 @@ class KyarabenApp(web.Application):
         self.config = config
         self.dbpool = None
         self.task_broker = None
+        self.outbox_relay = None
+        self.executor = io_executor(config)
+        self.adb_pool = AdbPool(port=config['adb']['port'],
+                                connect_timeout=config['adb']['connect_timeout'])
+        self.device_state = DeviceStateTracker(self,
+                                               state_ttl=config['device']['state_ttl'],
+                                               boot_poll_interval=config['device']['boot_poll_interval'])
 
     async def setup(self):
         await self.setup_db()
@@ -36,9 +49,11 @@ class KyarabenApp(web.Application):
         APKHandler().setup_routes(app=self)
         CameraFileHandler().setup_routes(app=self)
         CampaignHandler().setup_routes(app=self)
+        FleetHandler().setup_routes(app=self)
         ImageHandler().setup_routes(app=self)
         ProjectHandler().setup_routes(app=self)
         TestsourceHandler().setup_routes(app=self)
+        TraceHandler().setup_routes(app=self)
         UserHandler().setup_routes(app=self)
 
     async def setup_amqp(self):
@@ -46,8 +61,15 @@ class KyarabenApp(web.Application):
         connection_factory = ConnectionFactory(host=self.config['amqp']['hostname'],
                                                login=self.config['amqp']['admin_username'],
                                                password=self.config['amqp']['admin_password'])
-        self.task_broker = TaskBroker(connection_factory=connection_factory)
+        self.task_broker = TaskBroker(connection_factory=connection_factory,
+                                      shards=self.config['orchestration']['avm_shards'],
+                                      publish_channels=self.config['amqp']['publish_channels'])
         await self.task_broker.setup()
+        self.outbox_relay = OutboxRelay(self,
+                                        batch_size=self.config['outbox']['batch_size'],
+                                        poll_interval=self.config['outbox']['poll_interval'])
+        await self.outbox_relay.setup()
+        self.loop.create_task(self.outbox_relay.run_forever())
 
     async def setup_db(self):
         self.logger.debug('Set up DBMS connection pool...')
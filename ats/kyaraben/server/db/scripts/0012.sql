@@ -0,0 +1,4 @@
+
+ALTER TABLE avms ADD COLUMN instance_ip VARCHAR(64);
+
+COMMENT ON COLUMN avms.instance_ip IS 'address of the android instance, for direct adb connections';
@@ -0,0 +1,6 @@
+
+ALTER TABLE avms ADD COLUMN boot_id VARCHAR(64);
+ALTER TABLE avms ADD COLUMN boot_completed BOOLEAN NOT NULL DEFAULT FALSE;
+ALTER TABLE avms ADD COLUMN properties JSONB;
+
+COMMENT ON COLUMN avms.boot_id IS 'kernel boot_id of the device when the properties were read';
@@ -0,0 +1,14 @@
+
+-- failed tasks waiting for kyaraben-retry to publish them again
+
+CREATE TABLE retry_schedule (
+    retry_id BIGSERIAL PRIMARY KEY,
+    ts_due TIMESTAMP NOT NULL,
+    exchange VARCHAR NOT NULL,
+    routing_key VARCHAR NOT NULL,
+    body BYTEA NOT NULL,
+    properties JSONB NOT NULL,
+    ts_created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX ON retry_schedule (ts_due);
@@ -0,0 +1,5 @@
+
+-- several kyaraben-retry instances can share the schedule
+
+ALTER TABLE retry_schedule ADD COLUMN claimed_by VARCHAR;
+ALTER TABLE retry_schedule ADD COLUMN ts_claimed TIMESTAMP;
@@ -0,0 +1,13 @@
+
+-- steps completed by the tasks, to resume them when their message is delivered again
+
+CREATE TABLE task_ledger (
+    message_id VARCHAR PRIMARY KEY,
+    task VARCHAR NOT NULL,
+    steps JSONB NOT NULL DEFAULT '{}',
+    completed BOOLEAN NOT NULL DEFAULT FALSE,
+    ts_created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    ts_updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX ON task_ledger (ts_updated);
@@ -0,0 +1,12 @@
+
+-- tasks published by the handlers, written in the transaction of their
+-- model changes and sent to the broker by the outbox relay
+
+CREATE TABLE task_outbox (
+    outbox_id BIGSERIAL PRIMARY KEY,
+    task VARCHAR NOT NULL,
+    message_id VARCHAR NOT NULL,
+    body JSONB NOT NULL,
+    published DOUBLE PRECISION NOT NULL,
+    ts_created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,35 @@
+
+-- recordings of player events (GPS routes, sensor readings...), replayed on
+-- the android-events exchange.
+-- events is an array of [offset in seconds, routing key suffix, base64 payload]
+
+CREATE TABLE project_traces (
+    trace_id buuid PRIMARY KEY,
+    trace_name VARCHAR(128) NOT NULL CHECK (trace_name <> ''),
+    project_id buuid NOT NULL REFERENCES projects,
+    events JSONB NOT NULL,
+    event_count INTEGER NOT NULL,
+    duration DOUBLE PRECISION NOT NULL,
+    ts_created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    status VARCHAR(20) NOT NULL DEFAULT 'READY' CHECK (status IN ('READY', 'DELETED')),
+    status_ts TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    status_reason VARCHAR(50) NOT NULL DEFAULT ''
+);
+
+CREATE TABLE trace_replays (
+    replay_id buuid PRIMARY KEY,
+    trace_id buuid NOT NULL REFERENCES project_traces,
+    avm_ids VARCHAR(32)[] NOT NULL,
+    time_scale DOUBLE PRECISION NOT NULL DEFAULT 1 CHECK (time_scale > 0),
+    -- offset in the trace of the last published events
+    position DOUBLE PRECISION NOT NULL DEFAULT 0,
+    events_published BIGINT NOT NULL DEFAULT 0,
+    -- worst delay between the due time of an event and its publication
+    max_lag DOUBLE PRECISION NOT NULL DEFAULT 0,
+    ts_created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    status VARCHAR(20) NOT NULL DEFAULT 'QUEUED' CHECK (status IN ('QUEUED', 'RUNNING', 'STOPPING', 'FINISHED', 'STOPPED', 'ERROR')),
+    status_ts TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    status_reason VARCHAR(50) NOT NULL DEFAULT ''
+);
+
+CREATE INDEX ON trace_replays (trace_id);
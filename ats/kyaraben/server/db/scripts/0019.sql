@@ -0,0 +1,20 @@
+
+-- one command run on a set of AVMs. The task is published for at most
+-- concurrency of its avm_commands at a time, see ats/kyaraben/fleet.py
+
+CREATE TABLE fleet_batches (
+    batch_id buuid PRIMARY KEY,
+    userid VARCHAR NOT NULL,
+    task VARCHAR NOT NULL,
+    params JSONB NOT NULL,
+    concurrency INTEGER NOT NULL CHECK (concurrency > 0),
+    ts_created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+ALTER TABLE avm_commands ADD COLUMN batch_id buuid REFERENCES fleet_batches;
+-- when the task of the command was queued
+ALTER TABLE avm_commands ADD COLUMN ts_dispatched TIMESTAMP;
+-- the command is done and the next one of the batch has been queued
+ALTER TABLE avm_commands ADD COLUMN slot_released BOOLEAN NOT NULL DEFAULT FALSE;
+
+CREATE INDEX ON avm_commands (batch_id);
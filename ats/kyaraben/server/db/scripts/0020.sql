@@ -0,0 +1,22 @@
+ALTER TABLE project_apks ADD COLUMN sha256 VARCHAR(64);
+ALTER TABLE project_apks ADD COLUMN signer VARCHAR(64);
+
+COMMENT ON COLUMN project_apks.sha256 IS 'SHA-256 of the APK file';
+COMMENT ON COLUMN project_apks.signer IS 'SHA-256 of the signing certificate, NULL if unknown';
+
+-- the packages installed by kyaraben on each device, to skip the install
+-- of an APK that is already there
+
+CREATE TABLE avm_packages (
+    avm_id buuid NOT NULL REFERENCES avms,
+    package VARCHAR NOT NULL,
+    apk_id buuid NOT NULL,
+    sha256 VARCHAR(64) NOT NULL,
+    signer VARCHAR(64),
+    ts_installed TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (avm_id, package)
+);
+
+ALTER TABLE avms ADD COLUMN install_boot_id VARCHAR(64);
+
+COMMENT ON COLUMN avms.install_boot_id IS 'boot_id of the device when it was last prepared for APK installs';
@@ -0,0 +1,3 @@
+ALTER TABLE project_apks ADD COLUMN instrumentations JSONB;
+
+COMMENT ON COLUMN project_apks.instrumentations IS 'test packages declared in the manifest, NULL if unknown';
@@ -0,0 +1,13 @@
+-- a snapshot of the data volume, taken after the first boot, to reset an
+-- AVM without creating a new stack
+
+ALTER TABLE avms ADD COLUMN server_id VARCHAR(64);
+ALTER TABLE avms ADD COLUMN data_volume_id VARCHAR(64);
+ALTER TABLE avms ADD COLUMN data_snapshot_id VARCHAR(64);
+
+COMMENT ON COLUMN avms.server_id IS 'nova server of the stack, NULL if not known';
+COMMENT ON COLUMN avms.data_volume_id IS 'cinder volume of the data partition, NULL if not known';
+COMMENT ON COLUMN avms.data_snapshot_id IS 'cinder snapshot of the data volume after the first boot';
+
+ALTER TABLE avms DROP CONSTRAINT avms_status_check;
+ALTER TABLE avms ADD CONSTRAINT avms_status_check CHECK (status IN ('QUEUED', 'CREATING', 'READY', 'RESETTING', 'DELETING', 'DELETED', 'ERROR'));
@@ -0,0 +1,13 @@
+-- the APK compiled from each DSL source, to skip the compilation of a
+-- source that has not changed
+
+CREATE TABLE compile_cache (
+    source_sha256 VARCHAR(64) PRIMARY KEY,
+    apk_id buuid NOT NULL,
+    project_id buuid NOT NULL,
+    package VARCHAR NOT NULL,
+    ts_created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX compile_cache_apk_id ON compile_cache (apk_id);
+CREATE INDEX compile_cache_project_id ON compile_cache (project_id);
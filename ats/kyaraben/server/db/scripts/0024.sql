@@ -0,0 +1,17 @@
+-- the camera file converted from each uploaded file, to skip the conversion
+-- of a file that was already uploaded
+
+CREATE TABLE camera_cache (
+    source_sha256 VARCHAR(64) NOT NULL,
+    extension VARCHAR(16) NOT NULL,
+    output_format VARCHAR(32) NOT NULL,
+    camera_id buuid NOT NULL,
+    project_id buuid NOT NULL,
+    ts_created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (source_sha256, extension, output_format)
+);
+
+CREATE INDEX camera_cache_camera_id ON camera_cache (camera_id);
+CREATE INDEX camera_cache_project_id ON camera_cache (project_id);
+
+ALTER TABLE project_camera ADD COLUMN transcode_seconds REAL;
@@ -0,0 +1,5 @@
+-- a lease on the ledger entry of a running task, instead of a session
+-- advisory lock that held a connection for the whole task
+
+ALTER TABLE task_ledger ADD COLUMN lease_owner VARCHAR;
+ALTER TABLE task_ledger ADD COLUMN ts_lease_expires TIMESTAMP;
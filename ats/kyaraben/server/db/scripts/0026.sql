@@ -0,0 +1,4 @@
+-- a lease on the device of an AVM, held by the task that runs commands on it
+
+ALTER TABLE avms ADD COLUMN device_lease_owner VARCHAR;
+ALTER TABLE avms ADD COLUMN ts_device_lease_expires TIMESTAMP;
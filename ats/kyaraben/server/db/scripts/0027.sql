@@ -0,0 +1,6 @@
+-- the AVM of a task, so that the monitor can tell a stuck AVM from one
+-- that still has a task to run
+
+ALTER TABLE task_ledger ADD COLUMN avm_id buuid;
+
+CREATE INDEX ON task_ledger (avm_id) WHERE NOT completed;
@@ -0,0 +1,17 @@
+-- the AVM of each testrun: a campaign AVM runs a chain of testruns, and
+-- avms.testrun_id only keeps the first one
+
+ALTER TABLE testruns ADD COLUMN avm_id buuid REFERENCES avms;
+
+UPDATE testruns
+   SET avm_id = avms.avm_id
+  FROM avms
+ WHERE avms.testrun_id = testruns.testrun_id;
+
+CREATE OR REPLACE VIEW campaign_resources AS
+    SELECT testruns.campaign_id,
+           testruns.testrun_id,
+           avms.avm_id,
+           avms.stack_name
+      FROM testruns
+ LEFT JOIN avms ON avms.avm_id = testruns.avm_id;
@@ -7,9 +7,11 @@ import uuid
 from aiohttp import web
 from oath import totp
 
-from ats.kyaraben.docker import cmd_docker_exec
+from ats.kyaraben.db import Transaction
+from ats.kyaraben.device import adb_shell
 from ats.kyaraben.model.android import AndroidVM
 from ats.kyaraben.model.apk import APK
+from ats.kyaraben.outbox import outbox_add
 from ats.kyaraben.password import generate_password
 from ats.kyaraben.process import ProcessError
 from ats.util.helpers import authenticated_userid, json_request
@@ -31,6 +33,7 @@ class AndroidHandler:
         router.add_route('POST', '/android', self.create)
         router.add_route('PUT', '/android/{avm_id}', self.update)
         router.add_route('DELETE', '/android/{avm_id}', self.delete)
+        router.add_route('POST', '/android/{avm_id}/reset', self.reset)
         router.add_route('GET', '/android/{avm_id}/apk', self.apk_list)
         router.add_route('POST', '/android/{avm_id}/apk/{apk_id}', self.apk_install)
 
@@ -133,24 +136,25 @@ class AndroidHandler:
 
         vnc_secret = generate_password(128, password_chars='01234567890abcdef')
 
-        await AndroidVM.insert(request,
-                               avm_id=avm_id,
-                               avm_name=avm_name,
-                               userid=userid,
-                               project_id=project.project_id,
-                               image=image,
-                               hwconfig=hwconfig,
-                               testrun_id=None,
-                               vnc_secret=vnc_secret)
-
-        await request.app.task_broker.publish('avm_create', {
-            'userid': userid,
-            'image': image,
-            'project_id': project.project_id,
-            'avm_id': avm_id,
-            'hwconfig': hwconfig,
-            'vnc_secret': vnc_secret,
-        }, log=log)
+        async with Transaction(request.app.dbpool) as tx:
+            await AndroidVM.insert(tx,
+                                   avm_id=avm_id,
+                                   avm_name=avm_name,
+                                   userid=userid,
+                                   project_id=project.project_id,
+                                   image=image,
+                                   hwconfig=hwconfig,
+                                   testrun_id=None,
+                                   vnc_secret=vnc_secret)
+
+            await outbox_add(tx, 'avm_create', {
+                'userid': userid,
+                'image': image,
+                'project_id': project.project_id,
+                'avm_id': avm_id,
+                'hwconfig': hwconfig,
+                'vnc_secret': vnc_secret,
+            }, log=log)
 
         response_js = {
             'avm_id': avm_id
@@ -203,27 +207,51 @@ class AndroidHandler:
         if stack_name is None:
             raise web.HTTPNotFound()
 
-        await request.app.task_broker.publish('avm_delete', {
-            'userid': userid,
-            'avm_id': avm.avm_id,
-            'stack_name': stack_name,
-        }, log=log)
+        async with Transaction(request.app.dbpool) as tx:
+            await avm.set_status(tx, status='DELETING')
 
-        await avm.set_status(request, status='DELETING')
+            await outbox_add(tx, 'avm_delete', {
+                'userid': userid,
+                'avm_id': avm.avm_id,
+                'stack_name': stack_name,
+            }, log=log)
 
         return web.HTTPAccepted()
 
-    _re_parse_property = re.compile('\[(?P<key>[a-zA-Z0-9\-\.\_]+)\]\s*:\s+\[(?P<value>.*)\]')
+    async def reset(self, request):
+        """
+        Revert the data of the VM to the snapshot taken after its first boot
+        """
+        userid = await authenticated_userid(request)
+        avm = await request.app.context_avm(request, userid)
 
-    def _parse_properties(self, lines, log):
-        ret = {}
-        for line in lines:
-            m = self._re_parse_property.match(line)
-            if not m:
-                log.warning('Property line does not match: %s', line)
-                continue
-            ret[m.group('key')] = m.group('value')
-        return ret
+        log = request['slog']
+        log.debug('request: android reset')
+
+        await self._require_ready(avm, request)
+
+        row = await avm.get_data_snapshot(request)
+        if not row.data_snapshot_id:
+            raise web.HTTPConflict(text='The VM has no snapshot to be reset to.')
+
+        async with Transaction(request.app.dbpool) as tx:
+            await avm.set_status(tx, status='RESETTING')
+
+            await outbox_add(tx, 'avm_reset', {
+                'userid': userid,
+                'avm_id': avm.avm_id,
+            }, log=log)
+
+        return web.HTTPAccepted()
+
+    async def _require_ready(self, avm, request):
+        """
+        The player containers are watched by kyaraben-monitor, which reflects
+        their state in the AVM status: no need to probe them here.
+        """
+        status, reason = await avm.get_status(request)
+        if status != 'READY':
+            raise web.HTTPConflict(text='The VM is not available (%s %s)' % (status, reason))
 
     async def properties(self, request):
         userid = await authenticated_userid(request)
@@ -232,21 +260,16 @@ class AndroidHandler:
         log = request['slog']
         log.debug('Property list requested')
 
+        await self._require_ready(avm, request)
+
         try:
-            proc = await cmd_docker_exec('{.avm_id}_adb'.format(avm),
-                                         'adb', 'shell', 'getprop', log=nullog)
-            properties = self._parse_properties(proc.out_lines, log=log)
+            state = await request.app.device_state.state(avm.avm_id, log=nullog)
+            properties = state.properties
         except ProcessError:
             properties = {}
 
         return web.json_response({'properties': properties})
 
-    async def _bootcomplete(self, avm, *, log):
-        # or sys.boot_completed, should be the same
-        proc = await cmd_docker_exec('{.avm_id}_adb'.format(avm),
-                                     'adb', 'shell', 'getprop', 'dev.bootcomplete', log=log)
-        return proc.out == '1'
-
     async def apk_install(self, request):
         userid = await authenticated_userid(request)
         avm = await request.app.context_avm(request, userid)
@@ -272,33 +295,37 @@ class AndroidHandler:
         log = request['slog']
         log.debug('request: APK install', apk_id=apk_id)
 
+        await self._require_ready(avm, request)
+
         # XXX checking here is not enough, the vm could be unavailable when
         # the task is executed.
-        if not await self._bootcomplete(avm, log=log):
+        state = await request.app.device_state.state(avm.avm_id, log=log)
+        if not state.boot_completed:
             raise web.HTTPConflict(text='The VM cannot install packages now.')
 
         command_id = uuid.uuid1().hex
 
-        await request.app.task_broker.publish('apk_install', {
-            'userid': userid,
-            'project_id': project_id,
-            'avm_id': avm.avm_id,
-            'command_id': command_id,
-            'apk_id': apk_id,
-        }, log=log)
+        ts_request = datetime.datetime.now()
+
+        async with Transaction(request.app.dbpool) as tx:
+            await sql(tx, """
+                INSERT INTO avm_commands (
+                    avm_id, command_id, ts_request
+                ) VALUES (%s, %s, %s)
+                """, [avm.avm_id, command_id, ts_request])
+
+            await outbox_add(tx, 'apk_install', {
+                'userid': userid,
+                'project_id': project_id,
+                'avm_id': avm.avm_id,
+                'command_id': command_id,
+                'apk_id': apk_id,
+            }, log=log)
 
         response_js = {
             'command_id': command_id
         }
 
-        ts_request = datetime.datetime.now()
-
-        await sql(request, """
-            INSERT INTO avm_commands (
-                avm_id, command_id, ts_request
-            ) VALUES (%s, %s, %s)
-            """, [avm.avm_id, command_id, ts_request])
-
         return web.json_response(response_js, status=HTTPStatus.ACCEPTED)
 
     async def apk_list(self, request):
@@ -308,9 +335,9 @@ class AndroidHandler:
         log = request['slog']
         log.debug('Package list requested')
 
-        proc = await cmd_docker_exec('{.avm_id}_adb'.format(avm),
-                                     'adb', 'shell',
-                                     'pm', 'list', 'packages', '-3', '-e', log=log)
+        await self._require_ready(avm, request)
+
+        proc = await adb_shell(request.app, avm.avm_id, 'pm', 'list', 'packages', '-3', '-e', log=log)
 
         packages = [
             line.split('package:')[1]
@@ -336,22 +363,23 @@ class AndroidHandler:
 
         command_id = uuid.uuid1().hex
 
-        await request.app.task_broker.publish('avm_monkey', {
-            'userid': userid,
-            'avm_id': avm.avm_id,
-            'command_id': command_id,
-            'packages': packages,
-            'event_count': event_count,
-            'throttle': throttle,
-        }, log=log)
-
         ts_request = datetime.datetime.now()
 
-        await sql(request, """
-            INSERT INTO avm_commands (
-                avm_id, command_id, ts_request
-            ) VALUES (%s, %s, %s)
-            """, [avm.avm_id, command_id, ts_request])
+        async with Transaction(request.app.dbpool) as tx:
+            await sql(tx, """
+                INSERT INTO avm_commands (
+                    avm_id, command_id, ts_request
+                ) VALUES (%s, %s, %s)
+                """, [avm.avm_id, command_id, ts_request])
+
+            await outbox_add(tx, 'avm_monkey', {
+                'userid': userid,
+                'avm_id': avm.avm_id,
+                'command_id': command_id,
+                'packages': packages,
+                'event_count': event_count,
+                'throttle': throttle,
+            }, log=log)
 
         response_js = {
             'command_id': command_id
@@ -407,20 +435,21 @@ class AndroidHandler:
 
         command_id = uuid.uuid1().hex
 
-        await request.app.task_broker.publish('avm_test_run', {
-            'userid': userid,
-            'avm_id': avm.avm_id,
-            'package': package,
-            'command_id': command_id,
-        }, log=log)
-
         ts_request = datetime.datetime.now()
 
-        await sql(request, """
-            INSERT INTO avm_commands (
-                avm_id, command_id, ts_request
-            ) VALUES (%s, %s, %s)
-            """, [avm.avm_id, command_id, ts_request])
+        async with Transaction(request.app.dbpool) as tx:
+            await sql(tx, """
+                INSERT INTO avm_commands (
+                    avm_id, command_id, ts_request
+                ) VALUES (%s, %s, %s)
+                """, [avm.avm_id, command_id, ts_request])
+
+            await outbox_add(tx, 'avm_test_run', {
+                'userid': userid,
+                'avm_id': avm.avm_id,
+                'package': package,
+                'command_id': command_id,
+            }, log=log)
 
         response_js = {
             'command_id': command_id
@@ -441,8 +470,9 @@ class AndroidHandler:
         log = request['slog']
         log.debug('Test package list requested')
 
-        proc = await cmd_docker_exec('{.avm_id}_adb'.format(avm),
-                                     'adb', 'shell', 'pm', 'list', 'instrumentation', log=log)
+        await self._require_ready(avm, request)
+
+        proc = await adb_shell(request.app, avm.avm_id, 'pm', 'list', 'instrumentation', log=log)
 
         packages = {}
         for line in proc.out_lines:
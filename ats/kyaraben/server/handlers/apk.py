@@ -6,9 +6,13 @@ import uuid
 from aiohttp import web
 
 from ats.util.helpers import authenticated_userid
+from ats.kyaraben.apkinfo import apk_file_fingerprint, parse_instrumentations
+from ats.kyaraben.blocking import run_blocking
+from ats.kyaraben.db import Transaction
 from ats.kyaraben.process import aiorun, ProcessError
 
 from ats.kyaraben.model.apk import APK
+from ats.kyaraben.outbox import outbox_add
 from ats.kyaraben.server.handlers.misc import dump_stream
 
 
@@ -42,7 +46,8 @@ class APKHandler:
 
         config = request.app.config
 
-        tmppath = dump_stream(config['media']['tempdir'], upload_stream)
+        tmppath = await run_blocking(request.app, dump_stream,
+                                     config['media']['tempdir'], upload_stream)
 
         try:
             ret = await aiorun('aapt', 'dump', 'badging', tmppath, log=log)
@@ -56,21 +61,34 @@ class APKHandler:
             if m:
                 package = m.group('package')
 
-        log.debug('file dump', apk_id=apk_id, tmppath=tmppath)
-
-        await APK.insert(request,
-                         apk_id=apk_id,
-                         filename=filename,
-                         project_id=project.project_id,
-                         package=package)
-
-        await request.app.task_broker.publish('apk_upload', {
-            'userid': userid,
-            'project_id': project.project_id,
-            'apk_id': apk_id,
-            'tmppath': tmppath,
-            'filename': filename
-        }, log=log)
+        try:
+            ret = await aiorun('aapt', 'dump', 'xmltree', tmppath, 'AndroidManifest.xml',
+                              log=log, log_output=False)
+            instrumentations = parse_instrumentations(ret.out_lines)
+        except (ProcessError, ValueError):
+            # listed on the device when the tests are run
+            instrumentations = None
+
+        fingerprint = await run_blocking(request.app, apk_file_fingerprint, tmppath)
+
+        log.debug('file dump', apk_id=apk_id, tmppath=tmppath, sha256=fingerprint.sha256)
+
+        async with Transaction(request.app.dbpool) as tx:
+            await APK.insert(tx,
+                             apk_id=apk_id,
+                             filename=filename,
+                             project_id=project.project_id,
+                             package=package,
+                             fingerprint=fingerprint,
+                             instrumentations=instrumentations)
+
+            await outbox_add(tx, 'apk_upload', {
+                'userid': userid,
+                'project_id': project.project_id,
+                'apk_id': apk_id,
+                'tmppath': tmppath,
+                'filename': filename
+            }, log=log)
 
         response_js = {
             'apk_id': apk_id
@@ -100,13 +118,14 @@ class APKHandler:
         if not apk:
             raise web.HTTPNotFound(text="APK '%s' not found" % apk_id)
 
-        await request.app.task_broker.publish('apk_delete', {
-            'userid': userid,
-            'project_id': project.project_id,
-            'apk_id': apk_id,
-        }, log=log)
+        async with Transaction(request.app.dbpool) as tx:
+            await apk.set_status(tx, 'DELETING')
 
-        await apk.set_status(request, 'DELETING')
+            await outbox_add(tx, 'apk_delete', {
+                'userid': userid,
+                'project_id': project.project_id,
+                'apk_id': apk_id,
+            }, log=log)
 
         return web.HTTPNoContent()
 
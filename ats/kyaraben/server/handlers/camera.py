@@ -7,7 +7,10 @@ import uuid
 from aiohttp import web
 
 from ats.util.helpers import authenticated_userid
+from ats.kyaraben.blocking import run_blocking
+from ats.kyaraben.db import Transaction
 from ats.kyaraben.model.camera import Camera
+from ats.kyaraben.outbox import outbox_add
 from ats.kyaraben.server.handlers.misc import dump_stream
 
 
@@ -47,22 +50,24 @@ class CameraFileHandler:
 
         config = request.app.config
 
-        tmppath = dump_stream(config['media']['tempdir'], upload_stream)
+        tmppath = await run_blocking(request.app, dump_stream,
+                                     config['media']['tempdir'], upload_stream)
 
         log.debug('file dump', camera_id=camera_id, tmppath=tmppath)
 
-        await Camera.insert(request,
-                            camera_id=camera_id,
-                            filename=filename,
-                            project_id=project.project_id)
+        async with Transaction(request.app.dbpool) as tx:
+            await Camera.insert(tx,
+                                camera_id=camera_id,
+                                filename=filename,
+                                project_id=project.project_id)
 
-        await request.app.task_broker.publish('camera_upload', {
-            'userid': userid,
-            'project_id': project.project_id,
-            'camera_id': camera_id,
-            'tmppath': tmppath,
-            'filename': filename
-        }, log=log)
+            await outbox_add(tx, 'camera_upload', {
+                'userid': userid,
+                'project_id': project.project_id,
+                'camera_id': camera_id,
+                'tmppath': tmppath,
+                'filename': filename
+            }, log=log)
 
         response_js = {
             'camera_file_id': camera_id
@@ -92,13 +97,14 @@ class CameraFileHandler:
         if not camera:
             raise web.HTTPNotFound(text="Camera file '%s' not found" % camera_id)
 
-        await request.app.task_broker.publish('camera_delete', {
-            'userid': userid,
-            'project_id': project.project_id,
-            'camera_id': camera_id,
-        }, log=log)
+        async with Transaction(request.app.dbpool) as tx:
+            await camera.set_status(tx, 'DELETING')
 
-        await camera.set_status(request, 'DELETING')
+            await outbox_add(tx, 'camera_delete', {
+                'userid': userid,
+                'project_id': project.project_id,
+                'camera_id': camera_id,
+            }, log=log)
 
         return web.HTTPNoContent()
 
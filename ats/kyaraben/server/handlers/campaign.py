@@ -5,8 +5,10 @@ import uuid
 from aiohttp import web
 
 from ats.util.helpers import authenticated_userid, json_request
+from ats.kyaraben.db import Transaction
 from ats.kyaraben.model.apk import APK
 from ats.kyaraben.model.campaign import Campaign
+from ats.kyaraben.outbox import outbox_add
 
 import petname
 
@@ -64,17 +66,18 @@ class CampaignHandler:
                 if not apk:
                     raise web.HTTPNotFound(text="APK '%s' not found" % apk_id)
 
-        await Campaign.insert(request,
-                              campaign_id=campaign_id,
-                              campaign_name=campaign_name,
-                              project_id=project.project_id,
-                              tests=tests)
+        async with Transaction(request.app.dbpool) as tx:
+            await Campaign.insert(tx,
+                                  campaign_id=campaign_id,
+                                  campaign_name=campaign_name,
+                                  project_id=project.project_id,
+                                  tests=tests)
 
-        await request.app.task_broker.publish('campaign_run', {
-            'campaign_id': campaign_id,
-            'userid': userid,
-            'project_id': project.project_id,
-        }, log=log)
+            await outbox_add(tx, 'campaign_run', {
+                'campaign_id': campaign_id,
+                'userid': userid,
+                'project_id': project.project_id,
+            }, log=log)
 
         response_js = {
             'campaign_id': campaign_id
@@ -120,12 +123,13 @@ class CampaignHandler:
         if not campaign:
             raise web.HTTPNotFound(text="Campaign '%s' not found" % campaign_id)
 
-        await request.app.task_broker.publish('campaign_delete', {
-            'userid': userid,
-            'project_id': project.project_id,
-            'campaign_id': campaign_id,
-        }, log=log)
+        async with Transaction(request.app.dbpool) as tx:
+            await campaign.set_status(tx, 'DELETING')
 
-        await campaign.set_status(request, 'DELETING')
+            await outbox_add(tx, 'campaign_delete', {
+                'userid': userid,
+                'project_id': project.project_id,
+                'campaign_id': campaign_id,
+            }, log=log)
 
         return web.HTTPNoContent()
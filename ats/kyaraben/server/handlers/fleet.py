@@ -0,0 +1,179 @@
+import datetime
+from http import HTTPStatus
+import uuid
+
+from aiohttp import web
+
+from ats.kyaraben.db import Transaction
+from ats.kyaraben.fleet import FLEET_COMMANDS, dispatch_commands
+from ats.kyaraben.model.apk import APK
+from ats.kyaraben.model.fleet import FleetBatch
+from ats.util.db import sql
+from ats.util.helpers import authenticated_userid, json_request
+
+
+class FleetHandler:
+    def setup_routes(self, app):
+        router = app.router
+        router.add_route('POST', '/fleet/commands', self.create)
+        router.add_route('GET', '/fleet/commands/{batch_id}', self.show)
+
+    async def select_avms(self, request, userid, js):
+        """
+        Return the (avm_id, project_id) of the AVMs selected by the request
+        """
+        if 'avm_ids' in js:
+            avm_ids = sorted(set(js['avm_ids']))
+            rows = await sql(request, """
+                SELECT avm_id,
+                       project_id
+                  FROM avms
+                 WHERE avm_id = ANY(%s)
+                       AND status <> 'DELETED'
+                       AND avm_id IN (SELECT avm_id FROM permission_avms WHERE userid = %s)
+                """, [avm_ids, userid])
+            missing = set(avm_ids) - {row.avm_id for row in rows}
+            if missing:
+                raise web.HTTPNotFound(text='AVM not found: %s' % ', '.join(sorted(missing)))
+        elif 'project_id' in js:
+            project = await request.app.context_project(request, userid,
+                                                        project_id=js['project_id'])
+            rows = await sql(request, """
+                SELECT avm_id,
+                       project_id
+                  FROM avms
+                 WHERE project_id = %s
+                       AND status = 'READY'
+                """, [project.project_id])
+        elif 'campaign_id' in js:
+            rows = await sql(request, """
+                SELECT avms.avm_id,
+                       avms.project_id
+                  FROM avms
+                  JOIN testruns ON testruns.testrun_id = avms.testrun_id
+                 WHERE testruns.campaign_id = %s
+                       AND avms.status = 'READY'
+                       AND avms.avm_id IN (SELECT avm_id FROM permission_avms WHERE userid = %s)
+                """, [js['campaign_id'], userid])
+        else:
+            raise web.HTTPBadRequest(text='One of avm_ids, project_id or campaign_id is required')
+
+        return [(row.avm_id, row.project_id) for row in rows]
+
+    async def create(self, request):
+        """
+        Run a command on a set of AVMs
+        """
+
+        request_schema = {
+            'type': 'object',
+            'properties': {
+                'command': {'enum': sorted(FLEET_COMMANDS)},
+                'avm_ids': {
+                    'type': 'array',
+                    'items': {'type': 'string'},
+                    'minItems': 1,
+                },
+                'project_id': {'type': 'string'},
+                'campaign_id': {'type': 'string'},
+                'concurrency': {'type': 'integer', 'minimum': 1},
+                'packages': {
+                    'type': 'array',
+                    'items': {'type': 'string'},
+                    'minItems': 1,
+                },
+                'event_count': {'type': 'integer', 'minimum': 1},
+                'throttle': {'type': 'integer', 'minimum': 0},
+                'package': {'type': 'string'},
+                'apk_id': {'type': 'string'},
+            },
+            'required': ['command']
+        }
+
+        userid = await authenticated_userid(request)
+
+        js = await json_request(request, schema=request_schema)
+
+        config = request.app.config['fleet']
+
+        command = js['command']
+        concurrency = js.get('concurrency', config['concurrency'])
+        concurrency = min(concurrency, config['max_concurrency'])
+
+        log = request['slog']
+        log.debug('request: fleet command', command=command, concurrency=concurrency)
+
+        avms = await self.select_avms(request, userid, js)
+
+        if not avms:
+            raise web.HTTPNotFound(text='No AVM selected')
+
+        if len(avms) > config['max_avms']:
+            raise web.HTTPBadRequest(text='Too many vms, max allowed is %d'
+                                          % config['max_avms'])
+
+        task, param_names = FLEET_COMMANDS[command]
+
+        if command == 'apk_install':
+            project_ids = {project_id for avm_id, project_id in avms}
+            if len(project_ids) > 1:
+                raise web.HTTPBadRequest(text='The AVMs must belong to the project of the APK')
+            js['project_id'] = project_ids.pop()
+            apk = await APK.get(request,
+                                apk_id=js.get('apk_id'),
+                                project_id=js['project_id'],
+                                userid=userid)
+            if not apk:
+                raise web.HTTPNotFound(text="APK '%s' not found" % js.get('apk_id'))
+        elif command == 'monkey':
+            if 'packages' not in js or 'event_count' not in js:
+                raise web.HTTPBadRequest(text='packages and event_count are required')
+        elif command == 'testrun':
+            if 'package' not in js:
+                raise web.HTTPBadRequest(text='package is required')
+
+        params = {name: js.get(name) for name in param_names}
+
+        batch_id = uuid.uuid1().hex
+
+        avm_commands = [(avm_id, uuid.uuid1().hex) for avm_id, project_id in avms]
+
+        async with Transaction(request.app.dbpool) as tx:
+            await FleetBatch.insert(tx,
+                                    batch_id=batch_id,
+                                    userid=userid,
+                                    task=task,
+                                    params=params,
+                                    concurrency=concurrency,
+                                    avm_commands=avm_commands,
+                                    ts_request=datetime.datetime.now())
+
+            await dispatch_commands(tx, batch_id=batch_id, count=concurrency, log=log)
+
+        response_js = {
+            'batch_id': batch_id,
+            'avm_count': len(avm_commands),
+        }
+
+        return web.json_response(response_js, status=HTTPStatus.ACCEPTED)
+
+    async def show(self, request):
+        """
+        Status of a fleet command, with the results of each AVM
+        """
+
+        userid = await authenticated_userid(request)
+
+        batch_id = request.match_info['batch_id']
+
+        request['slog'].debug('request: fleet command status', batch_id=batch_id)
+
+        batch = await FleetBatch.get(request, batch_id=batch_id, userid=userid)
+        if not batch:
+            raise web.HTTPNotFound(text="Fleet command '%s' not found" % batch_id)
+
+        response_js = {
+            'batch': await batch.select(request)
+        }
+
+        return web.json_response(response_js)
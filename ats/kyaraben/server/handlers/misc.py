@@ -12,3 +12,7 @@ def dump_stream(tempdir, stream):
             fout.write(b)
         fout.flush()
         return fout.name
+
+
+def read_utf8(stream):
+    return stream.read().decode('utf8')
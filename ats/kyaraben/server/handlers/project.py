@@ -5,7 +5,9 @@ import uuid
 from aiohttp import web
 
 from ats.util.helpers import authenticated_userid, json_request
+from ats.kyaraben.db import Transaction
 from ats.kyaraben.model.project import Project
+from ats.kyaraben.outbox import outbox_add
 
 
 class ProjectHandler:
@@ -58,15 +60,16 @@ class ProjectHandler:
         except KeyError:
             raise web.HTTPBadRequest(text='project_name is required')
 
-        await Project.insert(request,
-                             project_id=project_id,
-                             project_name=project_name,
-                             userid=userid)
+        async with Transaction(request.app.dbpool) as tx:
+            await Project.insert(tx,
+                                 project_id=project_id,
+                                 project_name=project_name,
+                                 userid=userid)
 
-        await request.app.task_broker.publish('project_container_create', {
-            'userid': userid,
-            'project_id': project_id,
-        }, log=log)
+            await outbox_add(tx, 'project_container_create', {
+                'userid': userid,
+                'project_id': project_id,
+            }, log=log)
 
         response_js = {
             'project_id': project_id
@@ -100,17 +103,21 @@ class ProjectHandler:
         userid = await authenticated_userid(request)
         project = await request.app.context_project(request, userid)
 
+        force = request.GET.get('force', '').lower() in ('1', 'true', 'yes')
+
         log = request['slog']
-        log.debug('request: project delete')
+        log.debug('request: project delete', force=force)
 
-        if await project.is_active(request):
+        if not force and await project.is_active(request):
             raise web.HTTPConflict(text='cannot delete project with active vms or campaigns')
 
-        await request.app.task_broker.publish('project_container_delete', {
-            'userid': userid,
-            'project_id': project.project_id,
-        }, log=log)
+        async with Transaction(request.app.dbpool) as tx:
+            await project.set_status(tx, status='DELETING')
 
-        await project.set_status(request, status='DELETING')
+            await outbox_add(tx, 'project_container_delete', {
+                'userid': userid,
+                'project_id': project.project_id,
+                'force': force,
+            }, log=log)
 
         return web.HTTPAccepted()
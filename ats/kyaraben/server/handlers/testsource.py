@@ -7,8 +7,12 @@ import uuid
 from aiohttp import web
 
 from ats.util.helpers import authenticated_userid
+from ats.kyaraben.blocking import run_blocking
+from ats.kyaraben.db import Transaction
 from ats.kyaraben.model.testsource import Testsource
 from ats.kyaraben.model.apk import APK
+from ats.kyaraben.outbox import outbox_add
+from ats.kyaraben.server.handlers.misc import read_utf8
 
 
 class TestsourceHandler:
@@ -39,7 +43,7 @@ class TestsourceHandler:
         upload_stream = payload['file'].file
 
         try:
-            content = upload_stream.read().decode('utf8')
+            content = await run_blocking(request.app, read_utf8, upload_stream)
         except UnicodeDecodeError:
             raise web.HTTPBadRequest(text='not utf8 or binary file')
 
@@ -90,7 +94,7 @@ class TestsourceHandler:
         upload_stream = payload['file'].file
 
         try:
-            content = upload_stream.read().decode('utf8')
+            content = await run_blocking(request.app, read_utf8, upload_stream)
         except UnicodeDecodeError:
             raise web.HTTPBadRequest(text='not utf8 or binary file')
 
@@ -128,20 +132,21 @@ class TestsourceHandler:
 
         apk_id = await testsource.apk_id(request)
 
-        if apk_id:
-            apk = await APK.get(request,
-                                apk_id=apk_id,
-                                project_id=project.project_id,
-                                userid=userid)
-            if apk:
-                await apk.set_status(request, 'DELETING')
-                await request.app.task_broker.publish('apk_delete', {
-                    'userid': userid,
-                    'project_id': project.project_id,
-                    'apk_id': apk_id,
-                }, log=log)
-
-        await testsource.delete(request)
+        async with Transaction(request.app.dbpool) as tx:
+            if apk_id:
+                apk = await APK.get(tx,
+                                    apk_id=apk_id,
+                                    project_id=project.project_id,
+                                    userid=userid)
+                if apk:
+                    await apk.set_status(tx, 'DELETING')
+                    await outbox_add(tx, 'apk_delete', {
+                        'userid': userid,
+                        'project_id': project.project_id,
+                        'apk_id': apk_id,
+                    }, log=log)
+
+            await testsource.delete(tx)
 
         return web.HTTPNoContent()
 
@@ -230,30 +235,31 @@ class TestsourceHandler:
 
         basename, extension = os.path.splitext(filename)
 
-        await testsource.update_apk(request, apk_id=None)
+        async with Transaction(request.app.dbpool) as tx:
+            await testsource.update_apk(tx, apk_id=None)
 
-        await APK.insert(request,
-                         apk_id=apk_id,
-                         filename='{}.apk'.format(basename),
-                         project_id=project.project_id)
+            await APK.insert(tx,
+                             apk_id=apk_id,
+                             filename='{}.apk'.format(basename),
+                             project_id=project.project_id)
 
-        await testsource.update_apk(request, apk_id=apk_id)
+            await testsource.update_apk(tx, apk_id=apk_id)
 
-        apk = await APK.get(request,
-                            apk_id=apk_id,
-                            project_id=project.project_id,
-                            userid=userid)
+            apk = await APK.get(tx,
+                                apk_id=apk_id,
+                                project_id=project.project_id,
+                                userid=userid)
 
-        await apk.set_status(request, 'QUEUED')
+            await apk.set_status(tx, 'QUEUED')
 
-        await testsource.update_apk(request,
-                                    apk_id=apk_id)
+            await testsource.update_apk(tx,
+                                        apk_id=apk_id)
 
-        await request.app.task_broker.publish('testsource_compile', {
-            'userid': userid,
-            'project_id': project.project_id,
-            'testsource_id': testsource_id,
-        }, log=request['slog'])
+            await outbox_add(tx, 'testsource_compile', {
+                'userid': userid,
+                'project_id': project.project_id,
+                'testsource_id': testsource_id,
+            }, log=request['slog'])
 
         response_js = {
             'apk_id': apk_id
@@ -0,0 +1,213 @@
+
+import functools
+from http import HTTPStatus
+import os
+import uuid
+
+from aiohttp import web
+
+from ats.util.db import sql
+from ats.util.helpers import authenticated_userid, json_request
+from ats.kyaraben.blocking import run_blocking
+from ats.kyaraben.db import Transaction
+from ats.kyaraben.model.trace import Trace, TraceReplay
+from ats.kyaraben.outbox import outbox_add
+from ats.kyaraben.trace import TraceError, parse_trace
+
+
+class TraceHandler:
+    def setup_routes(self, app):
+        router = app.router
+        router.add_route('POST', '/projects/{project_id}/traces', self.upload)
+        router.add_route('GET', '/projects/{project_id}/traces', self.list)
+        router.add_route('DELETE', '/projects/{project_id}/traces/{trace_id}', self.delete)
+        router.add_route('POST', '/projects/{project_id}/traces/{trace_id}/replays', self.replay)
+        router.add_route('GET', '/projects/{project_id}/replays/{replay_id}', self.replay_show)
+        router.add_route('DELETE', '/projects/{project_id}/replays/{replay_id}', self.replay_stop)
+
+    async def upload(self, request):
+        """
+        Upload a trace of player events to a project
+        """
+
+        userid = await authenticated_userid(request)
+        project = await request.app.context_project(request, userid)
+
+        payload = await request.post()
+
+        filename = payload['file'].filename
+        trace_name = payload.get('trace_name') or os.path.splitext(filename)[0]
+
+        log = request['slog']
+        log.debug('request: trace upload', filename=filename)
+
+        parse = functools.partial(parse_trace,
+                                  max_events=request.app.config['trace']['max_events'])
+
+        try:
+            events = await run_blocking(request.app, parse, payload['file'].file)
+        except TraceError as exc:
+            raise web.HTTPBadRequest(text='Invalid trace: %s' % exc)
+
+        trace_id = uuid.uuid1().hex
+
+        await Trace.insert(request,
+                           trace_id=trace_id,
+                           trace_name=trace_name[:128],
+                           project_id=project.project_id,
+                           events=events)
+
+        response_js = {
+            'trace_id': trace_id,
+            'event_count': len(events),
+            'duration': events[-1][0],
+        }
+
+        return web.json_response(response_js, status=HTTPStatus.CREATED)
+
+    async def list(self, request):
+        """
+        List the traces in a project
+        """
+
+        userid = await authenticated_userid(request)
+        project = await request.app.context_project(request, userid)
+
+        request['slog'].debug('Trace list requested')
+
+        response_js = {
+            'traces': await Trace.list(request, userid=userid, project_id=project.project_id)
+        }
+
+        return web.json_response(response_js)
+
+    async def context_trace(self, request, userid, project):
+        trace_id = request.match_info['trace_id']
+
+        trace = await Trace.get(request,
+                                trace_id=trace_id,
+                                project_id=project.project_id,
+                                userid=userid)
+        if not trace:
+            raise web.HTTPNotFound(text="Trace '%s' not found" % trace_id)
+        return trace
+
+    async def delete(self, request):
+        """
+        Remove a trace, and stop its replays
+        """
+
+        userid = await authenticated_userid(request)
+        project = await request.app.context_project(request, userid)
+        trace = await self.context_trace(request, userid, project)
+
+        request['slog'].debug('request: trace delete', trace_id=trace.trace_id)
+
+        async with Transaction(request.app.dbpool) as tx:
+            await trace.set_status(tx, 'DELETED')
+            await TraceReplay.stop_many(tx, trace_id=trace.trace_id)
+
+        return web.HTTPNoContent()
+
+    async def replay(self, request):
+        """
+        Replay a trace on some AVMs of the project
+        """
+
+        request_schema = {
+            'type': 'object',
+            'properties': {
+                'avm_ids': {
+                    'type': 'array',
+                    'items': {'type': 'string'},
+                    'minItems': 1,
+                },
+                'time_scale': {'type': 'number', 'exclusiveMinimum': True, 'minimum': 0},
+            },
+            'required': ['avm_ids']
+        }
+
+        userid = await authenticated_userid(request)
+        project = await request.app.context_project(request, userid)
+        trace = await self.context_trace(request, userid, project)
+
+        js = await json_request(request, schema=request_schema)
+
+        avm_ids = sorted(set(js['avm_ids']))
+        time_scale = js.get('time_scale', 1)
+
+        log = request['slog']
+        log.debug('request: trace replay', trace_id=trace.trace_id,
+                  avm_count=len(avm_ids), time_scale=time_scale)
+
+        max_avms = request.app.config['trace']['max_avms']
+        if len(avm_ids) > max_avms:
+            raise web.HTTPBadRequest(text='Too many vms, max allowed is %d' % max_avms)
+
+        rows = await sql(request, """
+            SELECT avm_id
+              FROM avms
+             WHERE avm_id = ANY(%s)
+                   AND project_id = %s
+                   AND status <> 'DELETED'
+                   AND avm_id IN (SELECT avm_id FROM permission_avms WHERE userid = %s)
+            """, [avm_ids, project.project_id, userid])
+
+        missing = set(avm_ids) - {row.avm_id for row in rows}
+        if missing:
+            raise web.HTTPNotFound(text='AVM not found in the project: %s' % ', '.join(sorted(missing)))
+
+        replay_id = uuid.uuid1().hex
+
+        async with Transaction(request.app.dbpool) as tx:
+            await TraceReplay.insert(tx,
+                                     replay_id=replay_id,
+                                     trace_id=trace.trace_id,
+                                     avm_ids=avm_ids,
+                                     time_scale=time_scale)
+
+            await outbox_add(tx, 'trace_replay', {
+                'userid': userid,
+                'project_id': project.project_id,
+                'trace_id': trace.trace_id,
+                'replay_id': replay_id,
+            }, log=log)
+
+        response_js = {
+            'replay_id': replay_id
+        }
+
+        return web.json_response(response_js, status=HTTPStatus.ACCEPTED)
+
+    async def context_replay(self, request, userid, project):
+        replay_id = request.match_info['replay_id']
+
+        replay = await TraceReplay.get(request,
+                                       replay_id=replay_id,
+                                       project_id=project.project_id,
+                                       userid=userid)
+        if not replay:
+            raise web.HTTPNotFound(text="Replay '%s' not found" % replay_id)
+        return replay
+
+    async def replay_show(self, request):
+        userid = await authenticated_userid(request)
+        project = await request.app.context_project(request, userid)
+        replay = await self.context_replay(request, userid, project)
+
+        response_js = {
+            'replay': await replay.select(request)
+        }
+
+        return web.json_response(response_js)
+
+    async def replay_stop(self, request):
+        userid = await authenticated_userid(request)
+        project = await request.app.context_project(request, userid)
+        replay = await self.context_replay(request, userid, project)
+
+        request['slog'].debug('request: replay stop', replay_id=replay.replay_id)
+
+        await replay.stop(request)
+
+        return web.HTTPAccepted()
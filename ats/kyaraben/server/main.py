@@ -9,6 +9,7 @@ import aiopg
 import psycopg2.extras
 import structlog
 
+from ats.kyaraben.blocking import setup_loop_debug
 from ats.kyaraben.config import config_get, ConfigPrinter
 from ats.kyaraben.docker import cmd_docker_compose
 from ats.util.logging import setup_logging, setup_structlog, structlog_middleware
@@ -97,8 +98,7 @@ def main(argv=sys.argv[1:]):
                     key_order=['delivery_tag', 'task'])
 
     loop = asyncio.get_event_loop()
-    # asyncio debugging
-    loop.set_debug(enabled=False)
+    setup_loop_debug(loop, config)
 
     pool = loop.run_until_complete(aiopg.create_pool(config['db']['dsn']))
 
@@ -1,7 +1,10 @@
 
+import asyncio
+from collections import namedtuple
 import json
 import time
 import uuid
+import zlib
 
 import aioamqp
 import structlog
@@ -31,14 +34,148 @@ class ConnectionFactory:
         return transport, protocol
 
 
+# Tasks started by a user on a live AVM, delivered on their own queues so
+# that they don't wait behind the campaign tasks, in order for each AVM.
+INTERACTIVE_TASKS = frozenset([
+    'avm_create',
+    'avm_containers_create',
+    'avm_delete',
+    'apk_install',
+])
+
+# Tasks on a live AVM that run for minutes, kept out of the ordered queues
+# of the interactive lane, where they would hold the other AVMs of a shard.
+DEVICE_TASKS = frozenset([
+    'avm_snapshot_create',
+    'avm_reset',
+    'avm_monkey',
+    'avm_test_run',
+])
+
+# Tasks that use the device of an AVM, which run one at a time under a
+# lease on the AVM (see worker/ledger.py)
+DEVICE_LEASE_TASKS = DEVICE_TASKS | {'apk_install'}
+
+# Tasks that run as long as the trace they replay, kept apart so that they
+# don't hold the slots of the batch lane.
+REPLAY_TASKS = frozenset([
+    'trace_replay',
+])
+
+LANES = ('interactive', 'device', 'batch', 'replay')
+
+BATCH_QUEUE = 'orchestration'
+
+DEVICE_QUEUE = 'orchestration.device'
+
+REPLAY_QUEUE = 'orchestration.replay'
+
+
+def task_lane(task_name):
+    if task_name in INTERACTIVE_TASKS:
+        return 'interactive'
+    if task_name in DEVICE_TASKS:
+        return 'device'
+    if task_name in REPLAY_TASKS:
+        return 'replay'
+    return 'batch'
+
+
+def avm_shard(avm_id, shards):
+    # must be the same in every process, unlike hash()
+    return zlib.crc32(avm_id.encode('utf8')) % shards
+
+
+def avm_queue(shard):
+    return 'orchestration.avm.{}'.format(shard)
+
+
+def lane_queues(lane, shards):
+    """
+    Names of the queues of a lane, which are also their routing keys.
+
+    The interactive lane is split by avm_id in shards, each consumed by a
+    single worker at a time, so that the tasks of an AVM run one after
+    the other.
+    """
+    if lane == 'batch':
+        return [BATCH_QUEUE]
+    if lane == 'device':
+        return [DEVICE_QUEUE]
+    if lane == 'replay':
+        return [REPLAY_QUEUE]
+    return [avm_queue(shard) for shard in range(shards)]
+
+
+# a message for TaskBroker.publish_many()
+OutgoingTask = namedtuple('OutgoingTask', 'task_name msg message_id delay published')
+OutgoingTask.__new__.__defaults__ = (None, 0, None)
+
+
+class ChannelPool:
+    """
+    Channels in confirm mode: a publish returns once the broker has taken
+    responsibility for the message. Each publisher borrows a channel, so
+    that concurrent publishers don't wait on each other's confirms.
+    """
+
+    def __init__(self, protocol, *, size):
+        self.protocol = protocol
+        self.size = size
+        self.channels = asyncio.Queue()
+
+    async def open_channel(self):
+        channel = await self.protocol.channel()
+        await channel.confirm_select()
+        return channel
+
+    async def setup(self):
+        for _ in range(self.size):
+            self.channels.put_nowait(await self.open_channel())
+
+    async def acquire(self):
+        return await self.channels.get()
+
+    async def release(self, channel):
+        if not channel.is_open:
+            # closed by the broker after an error
+            try:
+                channel = await self.open_channel()
+            except Exception:
+                # don't lose a slot of the pool
+                self.channels.put_nowait(channel)
+                raise
+        self.channels.put_nowait(channel)
+
+
 class TaskBroker:
-    def __init__(self, connection_factory):
+    """
+    Messages are published on their own connection, so that they are not
+    slowed down by the deliveries to the consumers, or blocked when the
+    broker throttles the consumers' connection.
+    """
+
+    def __init__(self, connection_factory, *, shards, batch_prefetch=1, device_prefetch=1,
+                 replay_prefetch=1, publish_channels=4):
         self.connection_factory = connection_factory
+        self.shards = shards
+        self.batch_prefetch = batch_prefetch
+        self.device_prefetch = device_prefetch
+        self.replay_prefetch = replay_prefetch
+        self.publish_channels = publish_channels
+        self.protocol = None
+        self.publish_protocol = None
+        self.channel_pool = None
+        # (channel, consumer_tag)
+        self.consumers = []
 
     async def setup(self):
         transport, protocol = await self.connection_factory()
+        self.publish_protocol = protocol
+        self.channel_pool = ChannelPool(protocol, size=self.publish_channels)
+        await self.channel_pool.setup()
+        # declarations and queue depths
         self.publish_channel = await protocol.channel()
-        self.consume_channel = await protocol.channel()
         await self.publish_channel.exchange_declare(exchange_name='orchestration',
                                                     type_name='x-delayed-message',
                                                     durable=True,
@@ -46,38 +183,127 @@ class TaskBroker:
                                                     arguments={
                                                         'x-delayed-type': 'direct'
                                                     })
-        await self.consume_channel.basic_qos(prefetch_count=1,
-                                             prefetch_size=0,
-                                             connection_global=False)
-        await self.consume_channel.queue_declare(queue_name='orchestration',
-                                                 durable=True,
-                                                 exclusive=False,
-                                                 arguments={
-                                                     'x-dead-letter-exchange': 'orchestration.retry'
-                                                 })
-        await self.consume_channel.queue_bind(queue_name='orchestration',
-                                              exchange_name='orchestration',
-                                              routing_key='orchestration')
-
-    async def publish(self, task_name, msg, log, delay=0):
+        for lane in LANES:
+            arguments = {
+                'x-dead-letter-exchange': 'orchestration.retry'
+            }
+            if lane == 'interactive':
+                arguments['x-single-active-consumer'] = True
+            for queue_name in lane_queues(lane, self.shards):
+                await self.publish_channel.queue_declare(queue_name=queue_name,
+                                                         durable=True,
+                                                         exclusive=False,
+                                                         arguments=arguments)
+                await self.publish_channel.queue_bind(queue_name=queue_name,
+                                                      exchange_name='orchestration',
+                                                      routing_key=queue_name)
+
+    def routing_key(self, task_name, msg):
+        lane = task_lane(task_name)
+        if lane == 'interactive':
+            return avm_queue(avm_shard(msg['avm_id'], self.shards))
+        return lane_queues(lane, self.shards)[0]
+
+    def properties(self, task_name, *, message_id=None, delay=0, published=None):
+        if published is None:
+            published = time.time()
         properties = {
-            'message_id': uuid.uuid1().hex,
-            'timestamp': int(time.time()),
+            'message_id': message_id or uuid.uuid1().hex,
+            'timestamp': int(published),
             'content_type': 'application/json',
             'delivery_mode': 2,
             'headers': {
-                'x-kyaraben-task': task_name
+                'x-kyaraben-task': task_name,
+                # for the latency metrics, timestamp has a 1s resolution
+                'x-kyaraben-published': '%.3f' % published,
             }
         }
         if delay:
             properties['headers']['x-delay'] = delay
-        log.info('publish task', msg, properties=properties)
-        await self.publish_channel.publish(payload=json.dumps(msg),
-                                           exchange_name='orchestration',
-                                           properties=properties,
-                                           routing_key='orchestration')
-
-    async def consume(self, callback):
-        await self.consume_channel.basic_consume(callback,
-                                                 queue_name='orchestration',
-                                                 no_ack=False)
+        return properties
+
+    async def publish(self, task_name, msg, log, delay=0, message_id=None):
+        await self.publish_many([OutgoingTask(task_name, msg, message_id=message_id, delay=delay)], log=log)
+
+    async def publish_many(self, tasks, *, log):
+        """
+        Publish a list of OutgoingTask on a single channel without waiting
+        for each confirm, then wait for all of them. Raise if the broker
+        did not confirm every message; some may have been published.
+        """
+        if not tasks:
+            return
+
+        async def publish_one(channel, task):
+            properties = self.properties(task.task_name,
+                                         message_id=task.message_id,
+                                         delay=task.delay,
+                                         published=task.published)
+            log.info('publish task', task.msg, properties=properties)
+            await channel.publish(payload=json.dumps(task.msg),
+                                  exchange_name='orchestration',
+                                  properties=properties,
+                                  routing_key=self.routing_key(task.task_name, task.msg))
+
+        channel = await self.channel_pool.acquire()
+        try:
+            results = await asyncio.gather(*[publish_one(channel, task) for task in tasks],
+                                           return_exceptions=True)
+        finally:
+            await self.channel_pool.release(channel)
+
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+    async def consume(self, callback, lanes=LANES, rotate=0):
+        """
+        Consume every queue on its own channel. The shards of the
+        interactive lane have a prefetch of 1, to keep the tasks of an AVM
+        in order. The first worker to subscribe to a shard is its active
+        consumer: rotate makes workers started together subscribe in a
+        different order.
+        """
+        if self.protocol is None:
+            transport, self.protocol = await self.connection_factory()
+        prefetch = {
+            'batch': self.batch_prefetch,
+            'device': self.device_prefetch,
+            'replay': self.replay_prefetch,
+        }
+        for lane in lanes:
+            queue_names = lane_queues(lane, self.shards)
+            offset = rotate % len(queue_names)
+            for queue_name in queue_names[offset:] + queue_names[:offset]:
+                channel = await self.protocol.channel()
+                await channel.basic_qos(prefetch_count=prefetch.get(lane, 1),
+                                        prefetch_size=0,
+                                        connection_global=False)
+                consumer = await channel.basic_consume(callback,
+                                                       queue_name=queue_name,
+                                                       no_ack=False)
+                self.consumers.append((channel, consumer['consumer_tag']))
+
+    async def cancel(self):
+        """
+        Stop receiving messages. The unacknowledged ones can still be acked.
+        """
+        consumers, self.consumers = self.consumers, []
+        for channel, consumer_tag in consumers:
+            await channel.basic_cancel(consumer_tag)
+
+    async def queue_depths(self):
+        """
+        Number of messages waiting in each lane
+        """
+        ret = {}
+        for lane in LANES:
+            ret[lane] = 0
+            for queue_name in lane_queues(lane, self.shards):
+                queue = await self.publish_channel.queue_declare(queue_name=queue_name, passive=True)
+                ret[lane] += queue['message_count']
+        return ret
+
+
+def all_routing_keys(shards):
+    return [queue_name for lane in LANES for queue_name in lane_queues(lane, shards)]
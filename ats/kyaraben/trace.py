@@ -0,0 +1,90 @@
+"""
+
+Traces of player events (GPS routes, sensor readings...), to be replayed on
+the android-events exchange.
+
+A trace is uploaded as a file of JSON lines, one event per line:
+
+    {"t": 0.0, "key": "gps", "payload": "<base64>"}
+    {"t": 0.02, "key": "sensors.accelerometer", "text": "<utf-8 payload>"}
+
+t is the offset of the event in seconds, key is appended to
+android-events.{avm_id}. to build the routing key, and the payload, given
+in base64 or as text, is published as is: it must be encoded the way the
+player container expects.
+
+"""
+
+import base64
+import binascii
+import json
+import math
+import re
+
+from ats.kyaraben.worker.amqp.queues import EVENT_SERVICES
+
+
+class TraceError(Exception):
+    pass
+
+
+re_event_key = re.compile('^[a-z0-9_]+(\.[a-z0-9_]+)*$')
+
+
+def parse_event(line):
+    try:
+        js = json.loads(line)
+    except ValueError:
+        raise TraceError('invalid JSON') from None
+
+    if not isinstance(js, dict):
+        raise TraceError('an event must be an object')
+
+    t = js.get('t')
+    # json accepts NaN and Infinity
+    if not isinstance(t, (int, float)) or isinstance(t, bool) or not math.isfinite(t) or t < 0:
+        raise TraceError('t must be a positive number')
+
+    key = js.get('key')
+    if not isinstance(key, str) or not re_event_key.match(key) \
+            or key.split('.')[0] not in EVENT_SERVICES:
+        raise TraceError('key must start with one of %s' % ', '.join(EVENT_SERVICES))
+
+    if 'payload' in js:
+        try:
+            base64.b64decode(js['payload'], validate=True)
+        except (TypeError, binascii.Error):
+            raise TraceError('payload is not valid base64') from None
+        payload = js['payload']
+    elif isinstance(js.get('text'), str):
+        payload = base64.b64encode(js['text'].encode('utf8')).decode('ascii')
+    else:
+        raise TraceError('payload or text is required')
+
+    return [float(t), key, payload]
+
+
+def parse_trace(lines, *, max_events):
+    """
+    Return the events of a trace as [offset, key, base64 payload], in
+    chronological order. Raise TraceError on the first invalid line.
+    """
+    events = []
+    for lineno, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode('utf8', errors='replace')
+        if not line.strip():
+            continue
+        try:
+            events.append(parse_event(line))
+        except TraceError as exc:
+            raise TraceError('line %d: %s' % (lineno, exc)) from None
+        if len(events) > max_events:
+            raise TraceError('too many events (max %d)' % max_events)
+
+    if not events:
+        raise TraceError('the trace has no event')
+
+    # stable: events recorded at the same time keep their order
+    events.sort(key=lambda event: event[0])
+    return events
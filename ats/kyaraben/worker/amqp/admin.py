@@ -64,20 +64,74 @@ class AMQPAdminGateway:
             error = await res.json()
             raise AMQPRestError(res.status, error['reason'])
 
+    async def list_users(self):
+        res = await self('get', ['users'])
+        if res.status != HTTPStatus.OK:
+            error = await res.json()
+            raise AMQPRestError(res.status, error['reason'])
+        return [user['name'] for user in await res.json()]
+
     async def delete_user(self, username):
         res = await self('delete', ['users', username], '')
         if res.status != HTTPStatus.NO_CONTENT:
             error = await res.json()
             raise AMQPRestError(res.status, error['reason'])
 
+    async def delete_users(self, usernames):
+        """
+        Remove several users with one request. Users that don't exist are ignored.
+        """
+        if not usernames:
+            return
+        js = {'users': list(usernames)}
+        self.log.debug('Removing RabbitMQ users', count=len(usernames))
+
+        res = await self('post', ['users', 'bulk-delete'], json.dumps(js))
+        if res.status != HTTPStatus.NO_CONTENT:
+            error = await res.json()
+            raise AMQPRestError(res.status, error['reason'])
+
     async def set_user_permissions(self, vhost, username, avm_id):
+        await self.set_permissions(vhost, username, read='android-events.{}.*'.format(avm_id))
+
+    async def set_permissions(self, vhost, username, *, read):
         js = {
             "configure": "",
             "write": "",
-            "read": "android-events.{}.*".format(avm_id)
+            "read": read
         }
         quoted_vhost = urllib.parse.quote_plus(vhost)
         res = await self('put', ['permissions', quoted_vhost, username], json.dumps(js))
-        if res.status != HTTPStatus.NO_CONTENT:
+        # 201 when the permissions are created, 204 when they are updated
+        if res.status not in (HTTPStatus.CREATED, HTTPStatus.NO_CONTENT):
             error = await res.json()
             raise AMQPRestError(res.status, error['reason'])
+
+    async def list_queues(self, vhost):
+        quoted_vhost = urllib.parse.quote_plus(vhost)
+        res = await self('get', ['queues', quoted_vhost])
+        if res.status != HTTPStatus.OK:
+            error = await res.json()
+            raise AMQPRestError(res.status, error['reason'])
+        return [queue['name'] for queue in await res.json()]
+
+    async def overview(self):
+        """
+        Object totals and memory use of the broker nodes
+        """
+        res = await self('get', ['overview'])
+        if res.status != HTTPStatus.OK:
+            error = await res.json()
+            raise AMQPRestError(res.status, error['reason'])
+        overview = await res.json()
+
+        res = await self('get', ['nodes'])
+        if res.status != HTTPStatus.OK:
+            error = await res.json()
+            raise AMQPRestError(res.status, error['reason'])
+        nodes = await res.json()
+
+        return {
+            'object_totals': overview.get('object_totals', {}),
+            'mem_used': sum(node.get('mem_used', 0) for node in nodes),
+        }
@@ -0,0 +1,147 @@
+"""
+
+Measure the cost of the event queues and users of the AVMs on RabbitMQ.
+
+Provisions the AMQP configuration of a number of fake AVMs, the same way
+the worker does, with the topology and credentials of the configuration or
+of the command line, and reports the time it took and the memory used by
+the broker before and after. Everything is removed at the end.
+
+    $ python -m ats.kyaraben.worker.amqp.bench --avms 500 --topology per_avm --credentials shared
+
+Run it against a test broker: the management API must be enabled, and the
+memory figures are only meaningful if nothing else uses the broker.
+
+"""
+
+import argparse
+import asyncio
+import copy
+import os
+import sys
+import time
+import uuid
+
+import structlog
+
+from ats.kyaraben.config import config_get
+from ats.kyaraben.password import generate_password
+from ats.kyaraben.tasks import ConnectionFactory
+from ats.util.logging import setup_logging, setup_structlog
+
+from .admin import AMQPAdminGateway
+from .queues import EVENT_TOPOLOGIES, create_event_queues, delete_event_queues_many
+
+
+class BenchApp:
+    """
+    What create_event_queues() and friends need from the worker app
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.log = structlog.get_logger()
+        self.amqp_connection_factory = ConnectionFactory(host=config['amqp']['hostname'],
+                                                         login=config['amqp']['admin_username'],
+                                                         password=config['amqp']['admin_password'])
+        self.amqp_admin = AMQPAdminGateway(config_amqp=config['amqp'], logger=self.log)
+
+
+async def provision(app, avm_ids, *, concurrency, log):
+    shared = app.config['amqp']['event_credentials'] == 'shared'
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def provision_one(avm_id):
+        async with semaphore:
+            await create_event_queues(app, log, avm_id=avm_id)
+            if not shared:
+                await app.amqp_admin.create_user(avm_id, generate_password(32))
+                await app.amqp_admin.set_user_permissions('/', avm_id, avm_id)
+
+    await asyncio.gather(*[provision_one(avm_id) for avm_id in avm_ids])
+
+
+async def teardown(app, avm_ids, *, batch_size, log):
+    for idx in range(0, len(avm_ids), batch_size):
+        batch = avm_ids[idx:idx + batch_size]
+        await delete_event_queues_many(app, log, avm_ids=batch)
+        await app.amqp_admin.delete_users(batch)
+
+
+async def run(app, args):
+    log = app.log.bind(topology=app.config['amqp']['event_topology'],
+                       credentials=app.config['amqp']['event_credentials'],
+                       avms=args.avms)
+
+    avm_ids = [uuid.uuid4().hex for _ in range(args.avms)]
+
+    before = await app.amqp_admin.overview()
+
+    ts_start = time.monotonic()
+    try:
+        await provision(app, avm_ids, concurrency=args.concurrency, log=log)
+        provision_time = time.monotonic() - ts_start
+
+        # let the broker settle before reading its memory
+        await asyncio.sleep(args.settle)
+        after = await app.amqp_admin.overview()
+    finally:
+        ts_teardown = time.monotonic()
+        await teardown(app, avm_ids, batch_size=args.batch_size, log=log)
+        teardown_time = time.monotonic() - ts_teardown
+
+    queues = after['object_totals'].get('queues', 0) - before['object_totals'].get('queues', 0)
+    mem = after['mem_used'] - before['mem_used']
+
+    log.info('amqp provisioning benchmark',
+             provision_secs=round(provision_time, 2),
+             provision_per_avm_msecs=round(provision_time * 1000 / args.avms, 1),
+             teardown_secs=round(teardown_time, 2),
+             queues_added=queues,
+             mem_added_bytes=mem,
+             mem_per_avm_bytes=mem // args.avms)
+
+
+def get_parser():
+    ap = argparse.ArgumentParser(description='Benchmark the AMQP configuration of the AVMs')
+
+    ap.add_argument('--avms', type=int, default=100,
+                    help='number of fake AVMs to provision')
+
+    ap.add_argument('--topology', choices=EVENT_TOPOLOGIES,
+                    help='override amqp.event_topology')
+
+    ap.add_argument('--credentials', choices=['per_avm', 'shared'],
+                    help='override amqp.event_credentials')
+
+    ap.add_argument('--concurrency', type=int, default=10,
+                    help='number of AVMs provisioned at the same time')
+
+    ap.add_argument('--batch-size', type=int, default=50,
+                    help='number of AVMs removed at once')
+
+    ap.add_argument('--settle', type=float, default=5,
+                    help='seconds to wait before reading the memory use')
+
+    return ap
+
+
+def main(argv=sys.argv[1:]):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+
+    config = copy.deepcopy(config_get(environ=os.environ))
+    if args.topology:
+        config['amqp']['event_topology'] = args.topology
+    if args.credentials:
+        config['amqp']['event_credentials'] = args.credentials
+
+    setup_logging(config)
+    setup_structlog(config)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(BenchApp(config), args))
+
+
+if __name__ == '__main__':
+    main()
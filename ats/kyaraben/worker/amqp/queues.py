@@ -3,11 +3,30 @@
 Provide functions to update the RabbitMQ configuration
 when creating and destroying AVMs.
 
+The player containers receive their events from the android-events topic
+exchange, with the routing keys android-events.{avm_id}.{service}[.*].
+Two topologies of queues are supported (amqp.event_topology):
+
+per_service
+    one queue per AVM and service, seven per AVM.
+
+per_avm
+    a single queue per AVM, bound to android-events.{avm_id}.#; the
+    player dispatches the events by their routing key.
+
 """
 
+EVENT_SERVICES = ['sensors', 'battery', 'gps', 'recording', 'gsm', 'camera', 'nfc']
+
+EVENT_TOPOLOGIES = ('per_service', 'per_avm')
 
-def queues_routing(avm_id):
-    for shortname in ['sensors', 'battery', 'gps', 'recording', 'gsm', 'camera', 'nfc']:
+
+def queues_routing(avm_id, topology='per_service'):
+    if topology == 'per_avm':
+        yield 'android-events.{}'.format(avm_id), 'android-events.{}.#'.format(avm_id)
+        return
+
+    for shortname in EVENT_SERVICES:
         queue_tpl = 'android-events.{avm_id}.{shortname}'
 
         if shortname == 'sensors':
@@ -19,21 +38,36 @@ def queues_routing(avm_id):
         yield queue_tpl.format(**d), routing_tpl.format(**d)
 
 
+def event_queue_names(avm_id):
+    """
+    The queues an AVM may have, whatever the topology it was created with
+    """
+    return [queue_name
+            for topology in EVENT_TOPOLOGIES
+            for queue_name, _ in queues_routing(avm_id, topology)]
+
+
 async def create_event_queues(app, log, *, avm_id):
     """
     Create exchange and queues for an AVM
     """
+    topology = app.config['amqp']['event_topology']
     transport, protocol = await app.amqp_connection_factory()
-    channel = await protocol.channel()
-    log.debug('Creating event queues', avm_id=avm_id)
-    for queue_name, routing_key in queues_routing(avm_id):
-        log.debug(queue_name=queue_name, routing_key=routing_key)
-        await channel.queue_declare(queue_name=queue_name,
-                                    durable=True,
-                                    auto_delete=False)
-        await channel.queue_bind(queue_name=queue_name,
-                                 exchange_name='android-events',
-                                 routing_key=routing_key)
+    try:
+        channel = await protocol.channel()
+        log.debug('Creating event queues', avm_id=avm_id, topology=topology)
+        for queue_name, routing_key in queues_routing(avm_id, topology):
+            log.debug(queue_name=queue_name, routing_key=routing_key)
+            await channel.queue_declare(queue_name=queue_name,
+                                        durable=True,
+                                        auto_delete=False)
+            await channel.queue_bind(queue_name=queue_name,
+                                     exchange_name='android-events',
+                                     routing_key=routing_key)
+    finally:
+        await protocol.close()
+        transport.close()
+
 
 async def delete_event_queues(app, log, *, avm_id):
     """
@@ -44,7 +78,28 @@ async def delete_event_queues(app, log, *, avm_id):
     # of the service, but listing them requires admin API
 
     transport, protocol = await app.amqp_connection_factory()
-    channel = await protocol.channel()
-    log.debug('Removing event queues', avm_id=avm_id)
-    for queue_name, _ in queues_routing(avm_id):
-        await channel.queue_delete(queue_name)
+    try:
+        channel = await protocol.channel()
+        log.debug('Removing event queues', avm_id=avm_id)
+        # deleting a queue that does not exist is not an error
+        for queue_name in event_queue_names(avm_id):
+            await channel.queue_delete(queue_name)
+    finally:
+        await protocol.close()
+        transport.close()
+
+
+async def delete_event_queues_many(app, log, *, avm_ids):
+    """
+    Remove the queues of several AVMs over a single connection
+    """
+    transport, protocol = await app.amqp_connection_factory()
+    try:
+        channel = await protocol.channel()
+        log.debug('Removing event queues', avm_count=len(avm_ids))
+        for avm_id in avm_ids:
+            for queue_name in event_queue_names(avm_id):
+                await channel.queue_delete(queue_name)
+    finally:
+        await protocol.close()
+        transport.close()
@@ -0,0 +1,114 @@
+"""
+
+Warm containers of the DSL and Java compilers.
+
+Rather than a new container of aic.dslcc and aic.testcc for each
+testsource, the compile scripts are run with docker exec in long-lived
+containers, started on first use: the container startup is paid once, and a
+build daemon started by a script stays up between compilations.
+
+The scripts write to fixed paths, so a container runs one compilation at a
+time, and the number of containers of an image bounds the compilations a
+worker runs at once. Past queue_max compilations waiting for a container,
+CompilerBusy is raised and the task is delayed, rather than holding a slot
+of the batch lane.
+
+The containers sleep for lifetime seconds and remove themselves: those of a
+worker that crashed do not outlive it for long. They are not used past half
+their lifetime, nor after max_uses compilations.
+
+"""
+
+import asyncio
+import time
+import uuid
+
+from ats.kyaraben.docker import cmd_docker, cmd_docker_run
+from ats.kyaraben.process import ProcessError
+
+
+class CompilerBusy(Exception):
+    pass
+
+
+def container_gone(exc):
+    """
+    True if docker exec failed because the container has stopped
+    """
+    return 'No such container' in exc.proc.err or 'is not running' in exc.proc.err
+
+
+class CompilerPool:
+    def __init__(self, *, image, size, queue_max, lifetime, max_uses):
+        self.image = image
+        self.semaphore = asyncio.Semaphore(size)
+        self.queue_max = queue_max
+        self.lifetime = lifetime
+        self.max_uses = max_uses
+        # (ts_started, uses, name) of the containers waiting for a compilation
+        self.idle = []
+        self.waiting = 0
+
+    def retired(self, ts_started, uses):
+        return uses >= self.max_uses or time.monotonic() - ts_started > self.lifetime / 2
+
+    async def start(self, log):
+        name = 'compiler-{}'.format(uuid.uuid1().hex)
+        log.info('starting compiler container', image=self.image, container=name)
+        await cmd_docker_run('-d', '--rm', '--name', name, '--restart=no', self.image,
+                             'sleep', str(self.lifetime),
+                             log=log)
+        return time.monotonic(), 0, name
+
+    async def remove(self, name, log):
+        try:
+            await cmd_docker('rm', '-f', name, log=log)
+        except ProcessError:
+            log.warning('could not remove compiler container', container=name)
+
+    async def take(self, log):
+        while self.idle:
+            ts_started, uses, name = self.idle.pop()
+            if not self.retired(ts_started, uses):
+                return ts_started, uses, name
+            await self.remove(name, log)
+        return await self.start(log)
+
+    async def run(self, func, *, log):
+        """
+        Return await func(container), with a container of the pool.
+
+        A ProcessError raised by func is a failed compilation: the container
+        is used again, unless it has stopped.
+        """
+        if self.waiting >= self.queue_max:
+            raise CompilerBusy('%d compilations waiting for %s' % (self.waiting, self.image))
+
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        try:
+            ts_started, uses, name = await self.take(log)
+            reusable = False
+            try:
+                ret = await func(name)
+                reusable = True
+                return ret
+            except ProcessError as exc:
+                reusable = not container_gone(exc)
+                raise
+            finally:
+                if reusable and not self.retired(ts_started, uses + 1):
+                    self.idle.append((ts_started, uses + 1, name))
+                else:
+                    await self.remove(name, log)
+        finally:
+            self.semaphore.release()
+
+    async def close(self, log):
+        idle, self.idle = self.idle, []
+        for ts_started, uses, name in idle:
+            await self.remove(name, log)
@@ -36,7 +36,8 @@ async def project_down(project_id):
 
 
 async def player_up(*, project_id, avm_id, instance_ip, hwconfig,
-                    amqp_host, amqp_user, amqp_password, android_version, vnc_secret):
+                    amqp_host, amqp_user, amqp_password, amqp_topology,
+                    android_version, vnc_secret):
     log = structlog.get_logger()
     log.debug('creating player containers', avm_id=avm_id)
 
@@ -50,6 +51,7 @@ async def player_up(*, project_id, avm_id, instance_ip, hwconfig,
         'AIC_PLAYER_AMQP_HOST': amqp_host,
         'AIC_PLAYER_AMQP_USERNAME': amqp_user,
         'AIC_PLAYER_AMQP_PASSWORD': amqp_password,
+        'AIC_PLAYER_AMQP_TOPOLOGY': amqp_topology,
         'AIC_PLAYER_WIDTH': str(hc['width']),
         'AIC_PLAYER_HEIGHT': str(hc['height']),
         'AIC_PLAYER_MAX_DIMENSION': str(max(int(hc['width']), int(hc['height']))),
@@ -0,0 +1,165 @@
+"""
+
+Snapshot of the entities referenced by a task message.
+
+A single query loads, for every entity id in the message, its status and
+whether the user of the task has access to it. The worker uses it to drop
+obsolete tasks, and the handlers get their entities from it instead of
+querying them again.
+
+"""
+
+from ats.kyaraben.model.android import AndroidVM
+from ats.kyaraben.model.apk import APK
+from ats.kyaraben.model.camera import Camera
+from ats.kyaraben.model.campaign import Campaign
+from ats.kyaraben.model.project import Project
+from ats.kyaraben.model.testsource import Testsource
+from ats.util.db import sql
+
+from .ledger import child_message_id
+
+
+# a task is obsolete when one of these has been deleted.
+# not avm_command because it has no status=DELETED
+OBSOLETE_WHEN_DELETED = ('avm', 'project', 'apk', 'camera')
+
+
+async def load_snapshot(app, *, userid=None, avm_id=None, project_id=None, apk_id=None,
+                        camera_id=None, campaign_id=None, testsource_id=None, **kw):
+    """
+    For each entity: <entity>_status is NULL if it does not exist,
+    <entity>_allowed replicates the check done by the get() of its model.
+    """
+    rows = await sql(app, """
+        SELECT (SELECT status FROM avms WHERE avm_id = %s) AS avm_status,
+               EXISTS (SELECT 1
+                         FROM permission_avms
+                        WHERE avm_id = %s
+                              AND userid = %s) AS avm_allowed,
+               (SELECT status FROM projects WHERE project_id = %s) AS project_status,
+               EXISTS (SELECT 1
+                         FROM permission_projects
+                        WHERE project_id = %s
+                              AND userid = %s) AS project_allowed,
+               (SELECT status FROM project_apks WHERE apk_id = %s) AS apk_status,
+               EXISTS (SELECT 1
+                         FROM project_apks
+                        WHERE apk_id = %s
+                              AND project_id = %s
+                              AND status <> 'DELETED'
+                              AND project_id IN (SELECT project_id FROM permission_projects WHERE userid = %s)
+                      ) AS apk_allowed,
+               (SELECT status FROM project_camera WHERE camera_id = %s) AS camera_status,
+               EXISTS (SELECT 1
+                         FROM project_camera
+                        WHERE camera_id = %s
+                              AND project_id = %s
+                              AND status <> 'DELETED'
+                              AND project_id IN (SELECT project_id FROM permission_projects WHERE userid = %s)
+                      ) AS camera_allowed,
+               (SELECT status FROM campaigns WHERE campaign_id = %s) AS campaign_status,
+               EXISTS (SELECT 1
+                         FROM campaigns
+                        WHERE campaign_id = %s
+                              AND project_id = %s
+                              AND status <> 'DELETED'
+                              AND project_id IN (SELECT project_id FROM permission_projects WHERE userid = %s)
+                      ) AS campaign_allowed,
+               (SELECT status FROM testsources WHERE testsource_id = %s) AS testsource_status,
+               EXISTS (SELECT 1
+                         FROM testsources
+                        WHERE testsource_id = %s
+                              AND project_id = %s
+                              AND status <> 'DELETED'
+                              AND project_id IN (SELECT project_id FROM permission_projects WHERE userid = %s)
+                      ) AS testsource_allowed
+        """, [avm_id, avm_id, userid,
+              project_id, project_id, userid,
+              apk_id, apk_id, project_id, userid,
+              camera_id, camera_id, project_id, userid,
+              campaign_id, campaign_id, project_id, userid,
+              testsource_id, testsource_id, project_id, userid])
+
+    return rows[0]
+
+
+class TaskContext:
+    """
+    Passed to the task handlers as ctx.
+
+    The getters have the same signature and result as the get() of the
+    models. They answer from the snapshot when it was loaded for the same
+    ids and the entity existed; otherwise (e.g. an entity created by the
+    task itself) they query the database.
+    """
+
+    def __init__(self, app, *, message_id, msg, snapshot):
+        self.app = app
+        self.message_id = message_id
+        self.msg = msg
+        self.snapshot = snapshot
+        # set by the worker, see ledger.py
+        self.ledger = None
+
+    @classmethod
+    async def load(cls, app, *, message_id, msg):
+        snapshot = await load_snapshot(app, **msg)
+        return cls(app, message_id=message_id, msg=msg, snapshot=snapshot)
+
+    async def checkpoint(self, step, func):
+        if self.ledger is None:
+            return await func()
+        return await self.ledger.checkpoint(step, func)
+
+    def child_message_id(self, key):
+        """
+        Message id of a task published by this one. A duplicate of this
+        message publishes children with the same ids.
+        """
+        return child_message_id(self.message_id, key)
+
+    def is_obsolete(self):
+        return any(getattr(self.snapshot, '%s_status' % entity) == 'DELETED'
+                   for entity in OBSOLETE_WHEN_DELETED)
+
+    def _known(self, entity, **ids):
+        """
+        True if the snapshot answers for these ids
+        """
+        if any(self.msg.get(key) != value for key, value in ids.items()):
+            return False
+        return getattr(self.snapshot, '%s_status' % entity) is not None
+
+    def _allowed(self, entity):
+        return getattr(self.snapshot, '%s_allowed' % entity)
+
+    async def avm(self, *, avm_id, userid):
+        if self._known('avm', avm_id=avm_id, userid=userid):
+            return AndroidVM(avm_id=avm_id) if self._allowed('avm') else None
+        return await AndroidVM.get(self.app, avm_id=avm_id, userid=userid)
+
+    async def project(self, *, project_id, userid):
+        if self._known('project', project_id=project_id, userid=userid):
+            return Project(project_id=project_id) if self._allowed('project') else None
+        return await Project.get(self.app, project_id=project_id, userid=userid)
+
+    async def apk(self, *, apk_id, project_id, userid):
+        if self._known('apk', apk_id=apk_id, project_id=project_id, userid=userid):
+            return APK(apk_id=apk_id) if self._allowed('apk') else None
+        return await APK.get(self.app, apk_id=apk_id, project_id=project_id, userid=userid)
+
+    async def camera(self, *, camera_id, project_id, userid):
+        if self._known('camera', camera_id=camera_id, project_id=project_id, userid=userid):
+            return Camera(camera_id=camera_id) if self._allowed('camera') else None
+        return await Camera.get(self.app, camera_id=camera_id, project_id=project_id, userid=userid)
+
+    async def campaign(self, *, campaign_id, project_id, userid):
+        if self._known('campaign', campaign_id=campaign_id, project_id=project_id, userid=userid):
+            return Campaign(campaign_id=campaign_id) if self._allowed('campaign') else None
+        return await Campaign.get(self.app, campaign_id=campaign_id, project_id=project_id, userid=userid)
+
+    async def testsource(self, *, testsource_id, project_id, userid):
+        if self._known('testsource', testsource_id=testsource_id, project_id=project_id, userid=userid):
+            return Testsource(testsource_id=testsource_id) if self._allowed('testsource') else None
+        return await Testsource.get(self.app, testsource_id=testsource_id, project_id=project_id, userid=userid)
@@ -0,0 +1,213 @@
+"""
+
+Progress of the tasks, keyed by message id.
+
+A message can be delivered more than once: when a worker dies before the
+ack, or when a task publishes its children again after being redelivered.
+The ledger records the steps completed by a task, with their results, so
+that a second run skips them, and whether the whole task has completed.
+
+While a task runs, its worker holds a lease on the ledger entry, renewed
+every third of worker.ledger_lease seconds, so that two copies of a message
+never run at the same time. The lease expires if the worker dies. Taking
+the lease also creates and loads the entry, in a single query, and no
+connection is held between the queries.
+
+DeviceLease is the same kind of lease, on the device of an AVM: the tasks
+that run commands on a device (DEVICE_LEASE_TASKS) wait for each other,
+whatever their lane and worker.
+
+"""
+
+import asyncio
+import uuid
+
+from psycopg2.extras import Json
+
+from ats.util.db import sql
+
+
+# namespace of the message ids derived from a parent message
+CHILD_NAMESPACE = uuid.UUID('6b1d1f42-3c4e-4f0e-9a53-2f3cf0a0d6a5')
+
+
+def child_message_id(message_id, key):
+    return uuid.uuid5(CHILD_NAMESPACE, '{}/{}'.format(message_id, key)).hex
+
+
+async def renew_lease_forever(app, lease, qry, params):
+    """
+    Run the query that extends a lease every third of its duration
+    """
+    while True:
+        await asyncio.sleep(lease / 3)
+        try:
+            await sql(app, qry, params)
+        except Exception:
+            app.log.exception('could not renew a lease')
+
+
+class TaskLedger:
+    def __init__(self, app, *, message_id, task, avm_id=None):
+        self.app = app
+        self.message_id = message_id
+        self.task = task
+        self.avm_id = avm_id
+        self.steps = {}
+        self.completed = False
+        self.lease = app.config['worker']['ledger_lease']
+        self.owner = uuid.uuid1().hex
+        self.renewer = None
+
+    async def acquire(self):
+        """
+        Take the lease of the message id and load the ledger. Return False
+        if another worker is running the same message.
+        """
+        rows = await sql(self.app, """
+            INSERT INTO task_ledger (
+                    message_id, task, avm_id, lease_owner, ts_lease_expires
+                ) VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP + %s * INTERVAL '1 second')
+            ON CONFLICT (message_id) DO UPDATE
+               SET lease_owner = EXCLUDED.lease_owner,
+                   ts_lease_expires = EXCLUDED.ts_lease_expires,
+                   ts_updated = CURRENT_TIMESTAMP
+             WHERE task_ledger.ts_lease_expires IS NULL
+                   OR task_ledger.ts_lease_expires < CURRENT_TIMESTAMP
+            RETURNING steps, completed
+            """, [self.message_id, self.task, self.avm_id, self.owner, self.lease])
+
+        if not rows:
+            return False
+
+        self.steps = rows[0].steps
+        self.completed = rows[0].completed
+        self.renewer = self.app.loop.create_task(self.renew_forever())
+        return True
+
+    async def renew_forever(self):
+        await renew_lease_forever(self.app, self.lease, """
+            UPDATE task_ledger
+               SET ts_lease_expires = CURRENT_TIMESTAMP + %s * INTERVAL '1 second'
+             WHERE message_id = %s
+                   AND lease_owner = %s
+            """, [self.lease, self.message_id, self.owner])
+
+    def stop_renewing(self):
+        if self.renewer:
+            self.renewer.cancel()
+            self.renewer = None
+
+    async def release(self):
+        """
+        Give up the lease, unless complete() already did
+        """
+        if self.renewer is None:
+            return
+        self.stop_renewing()
+        await sql(self.app, """
+            UPDATE task_ledger
+               SET lease_owner = NULL,
+                   ts_lease_expires = NULL
+             WHERE message_id = %s
+                   AND lease_owner = %s
+            """, [self.message_id, self.owner])
+
+    async def checkpoint(self, step, func):
+        """
+        Return the result of func(), a coroutine function, or the result
+        it had in a previous run of the task. The result must be JSON
+        serializable.
+        """
+        if step in self.steps:
+            return self.steps[step]
+
+        result = await func()
+        self.steps[step] = result
+
+        await sql(self.app, """
+            UPDATE task_ledger
+               SET steps = %s,
+                   ts_updated = CURRENT_TIMESTAMP
+             WHERE message_id = %s
+            """, [Json(self.steps), self.message_id])
+
+        return result
+
+    async def complete(self):
+        """
+        Mark the task completed, and give up the lease
+        """
+        self.completed = True
+        self.stop_renewing()
+        await sql(self.app, """
+            UPDATE task_ledger
+               SET completed = TRUE,
+                   lease_owner = NULL,
+                   ts_lease_expires = NULL,
+                   ts_updated = CURRENT_TIMESTAMP
+             WHERE message_id = %s
+            """, [self.message_id])
+
+
+class DeviceLease:
+    def __init__(self, app, *, avm_id):
+        self.app = app
+        self.avm_id = avm_id
+        self.lease = app.config['worker']['ledger_lease']
+        self.owner = uuid.uuid1().hex
+        self.renewer = None
+
+    async def acquire(self):
+        """
+        Take the lease of the device. Return False if another task holds it.
+        """
+        rows = await sql(self.app, """
+            UPDATE avms
+               SET device_lease_owner = %s,
+                   ts_device_lease_expires = CURRENT_TIMESTAMP + %s * INTERVAL '1 second'
+             WHERE avm_id = %s
+                   AND (ts_device_lease_expires IS NULL
+                        OR ts_device_lease_expires < CURRENT_TIMESTAMP)
+            RETURNING avm_id
+            """, [self.owner, self.lease, self.avm_id])
+
+        if not rows:
+            # no lease to take on an AVM that does not exist, the task will tell
+            exists = await sql(self.app, """
+                SELECT 1 AS dummy
+                  FROM avms
+                 WHERE avm_id = %s
+                """, [self.avm_id])
+            return not exists
+
+        self.renewer = self.app.loop.create_task(renew_lease_forever(self.app, self.lease, """
+            UPDATE avms
+               SET ts_device_lease_expires = CURRENT_TIMESTAMP + %s * INTERVAL '1 second'
+             WHERE avm_id = %s
+                   AND device_lease_owner = %s
+            """, [self.lease, self.avm_id, self.owner]))
+        return True
+
+    async def release(self):
+        if self.renewer is None:
+            return
+        self.renewer.cancel()
+        self.renewer = None
+        await sql(self.app, """
+            UPDATE avms
+               SET device_lease_owner = NULL,
+                   ts_device_lease_expires = NULL
+             WHERE avm_id = %s
+                   AND device_lease_owner = %s
+            """, [self.avm_id, self.owner])
+
+
+async def purge_ledger(dbh, *, retention):
+    """
+    Forget the tasks not updated for retention seconds
+    """
+    await sql(dbh, """
+        DELETE FROM task_ledger
+         WHERE ts_updated < CURRENT_TIMESTAMP - %s * INTERVAL '1 second'
+        """, [retention])
@@ -4,7 +4,9 @@ import asyncio
 import json
 import os
 from pathlib import Path
+import signal
 import sys
+import time
 import traceback
 import warnings
 
@@ -12,16 +14,31 @@ import aiopg
 import psycopg2.extras
 import structlog
 
+from ats.kyaraben.adb import AdbPool
+from ats.kyaraben.blocking import io_executor, setup_loop_debug
 from ats.kyaraben.config import config_get
+from ats.kyaraben.device import DeviceStateTracker
+from ats.kyaraben.fleet import release_slot
+from ats.kyaraben.model.command import Command
 from ats.util.logging import setup_logging, setup_structlog
-from ats.kyaraben.tasks import TaskBroker, ConnectionFactory
-from ats.kyaraben.worker.task_errors import set_status_error, is_task_obsolete
-from ats.kyaraben.worker.openstack.exceptions import OSHeatError, AVMNotFoundError, AVMImageNotFoundError
+from ats.kyaraben.metrics import Meter
+from ats.kyaraben.tasks import (TaskBroker, ConnectionFactory, DEVICE_LEASE_TASKS, LANES,
+                                task_lane)
+from ats.kyaraben.worker.context import TaskContext
+from ats.kyaraben.worker.ledger import DeviceLease, TaskLedger
+from ats.kyaraben.worker.task_errors import set_status_error
+from ats.kyaraben.worker.openstack.exceptions import (OSHeatError, AVMNotFoundError,
+                                                      AVMImageNotFoundError, AVMSnapshotError)
 
 from . import tasks
 from .amqp.admin import AMQPAdminGateway
+from .compiler import CompilerPool
+from .openstack.cinderclient import CinderClient
 from .openstack.gateway import OpenStackGateway
 from .openstack.heatclient import HeatClient
+from .openstack.novaclient import NovaClient
+from .supervisor import Supervisor
+from .transcode import TranscodePool
 
 
 psycopg2.extras.register_uuid()
@@ -39,6 +56,8 @@ async def handle_message(app, log, channel, msg, envelope, properties):
             'avm_create': tasks.avm_create,
             'avm_containers_create': tasks.avm_containers_create,
             'avm_delete': tasks.avm_delete,
+            'avm_snapshot_create': tasks.avm_snapshot_create,
+            'avm_reset': tasks.avm_reset,
             'avm_monkey': tasks.avm_monkey,
             'avm_test_run': tasks.avm_test_run,
             'camera_upload': tasks.camera_upload,
@@ -52,35 +71,74 @@ async def handle_message(app, log, channel, msg, envelope, properties):
             'campaign_containers_create': tasks.campaign_containers_create,
             'campaign_runtest': tasks.campaign_runtest,
             'campaign_delete': tasks.campaign_delete,
+            'trace_replay': tasks.trace_replay,
         }[task]
     except KeyError:
         log.error('unknown task')
         raise
 
-    if await is_task_obsolete(app, **msg):
+    ctx = await TaskContext.load(app, message_id=properties.message_id, msg=msg)
+
+    if ctx.is_obsolete():
         log.warning('task is obsolete')
+        if msg.get('batch_id'):
+            await Command(command_id=msg['command_id']).set_status(app, 'ERROR', 'obsolete')
+            await release_slot(app, batch_id=msg['batch_id'], command_id=msg['command_id'], log=log)
+        return
+
+    delay_msecs = app.config['worker']['heat_poll_interval'] * 1000
+
+    ledger = TaskLedger(app, message_id=properties.message_id, task=task,
+                        avm_id=msg.get('avm_id'))
+
+    if not await ledger.acquire():
+        log.warning('task is running on another worker, delayed')
+        await app.task_broker.publish(task, msg, delay=delay_msecs, message_id=properties.message_id, log=log)
         return
 
+    device_lease = None
+    if task in DEVICE_LEASE_TASKS and not ledger.completed:
+        device_lease = DeviceLease(app, avm_id=msg['avm_id'])
+        if not await device_lease.acquire():
+            await ledger.release()
+            log.info('device busy with another task, delayed')
+            await app.task_broker.publish(task, msg, delay=delay_msecs,
+                                          message_id=properties.message_id, log=log)
+            return
+
     exception = None
     reason = ''
+    # the task won't run again
+    done = False
 
     try:
-        await handler(app=app, log=log, **msg)
+        if ledger.completed:
+            log.warning('task already completed')
+        else:
+            ctx.ledger = ledger
+
+            await handler(app=app, log=log, ctx=ctx, **msg)
+            await ledger.complete()
+        done = True
     except tasks.TaskDelay as exc:
         reason = exc.args[0]
-        delay_msecs = None
-        if delay_msecs is None:
-            delay_msecs = app.config['worker']['heat_poll_interval'] * 1000
         log.debug('republishing message', delay_msecs=delay_msecs, reason=reason)
-        await app.task_broker.publish(task, msg, delay=delay_msecs, log=log)
+        # same message id, to resume from the last completed step
+        await app.task_broker.publish(task, msg, delay=delay_msecs, message_id=properties.message_id, log=log)
     except OSHeatError as exc:
         exception = traceback.format_exc()
         if isinstance(exc, AVMImageNotFoundError):
             reason = 'Image {[image]} not found'.format(msg)
         if isinstance(exc, AVMNotFoundError):
             reason = 'VM {[avm_id]} not found'.format(msg)
+        if isinstance(exc, AVMSnapshotError):
+            reason = 'data volume snapshot error'
     except Exception:
         exception = traceback.format_exc()
+    finally:
+        if device_lease:
+            await device_lease.release()
+        await ledger.release()
 
     # Exceptions caught here and not re-raised are permanent.
     # Raising from handle_message() sends a nack to the dead-letter exchange, if defined.
@@ -93,10 +151,14 @@ async def handle_message(app, log, channel, msg, envelope, properties):
                   exception=exception)
 
         await set_status_error(app, log, reason=reason, message=msg)
+        done = True
+
+    if done and msg.get('batch_id'):
+        await release_slot(app, batch_id=msg['batch_id'], command_id=msg['command_id'], log=log)
 
 
 class App:
-    def __init__(self, *, config, args, loop):
+    def __init__(self, *, config, args, loop, metrics_sink=None):
         self.config = config
         self.args = args
         self.loop = loop
@@ -104,16 +166,59 @@ class App:
         self.dbpool = None
         osgw = OpenStackGateway(config_os=config['openstack'], logger=self.log)
         self.heat = HeatClient(osgw, config)
+        self.nova = NovaClient(osgw, config)
+        self.cinder = CinderClient(osgw, config)
         self.task_broker = None
         self.amqp_admin = None
+        self.adb_pool = AdbPool(port=config['adb']['port'],
+                                connect_timeout=config['adb']['connect_timeout'],
+                                loop=loop)
+        self.device_state = DeviceStateTracker(self,
+                                               state_ttl=config['device']['state_ttl'],
+                                               boot_poll_interval=config['device']['boot_poll_interval'])
+        self.compilers = {
+            name: CompilerPool(image='aic.{}'.format(name),
+                               size=config['compiler']['concurrency'],
+                               queue_max=config['compiler']['queue_max'],
+                               lifetime=config['compiler']['lifetime'],
+                               max_uses=config['compiler']['max_uses'])
+            for name in ('dslcc', 'testcc')
+        }
+        self.executor = io_executor(config)
+        self.transcoder = TranscodePool(size=config['camera']['concurrency'],
+                                        queue_max=config['camera']['queue_max'])
         self.done_tasks = 0
+        self.meter = Meter('worker', sink=metrics_sink)
+        self.running = set()
+        self.draining = False
+
+    def max_running_tasks(self):
+        """
+        Number of tasks the worker can receive at once, from the prefetch of its lanes
+        """
+        prefetch = {
+            'interactive': self.config['orchestration']['avm_shards'],
+            'batch': self.config['worker']['batch_prefetch'],
+            'device': self.config['worker']['device_prefetch'],
+            'replay': self.config['trace']['replay_prefetch'],
+        }
+        return sum(prefetch[lane] for lane in self.args.lanes)
 
     async def setup(self):
-        self.dbpool = await aiopg.create_pool(self.config['db']['dsn'])
+        # a connection for each task that can run at once, and spare ones for the
+        # lease renewals and the background jobs
+        self.dbpool = await aiopg.create_pool(self.config['db']['dsn'],
+                                              maxsize=self.max_running_tasks()
+                                              + self.config['db']['pool_spare'])
         self.amqp_connection_factory = ConnectionFactory(host=self.config['amqp']['hostname'],
                                                          login=self.config['amqp']['admin_username'],
                                                          password=self.config['amqp']['admin_password'])
-        self.task_broker = TaskBroker(self.amqp_connection_factory)
+        self.task_broker = TaskBroker(self.amqp_connection_factory,
+                                      shards=self.config['orchestration']['avm_shards'],
+                                      batch_prefetch=self.config['worker']['batch_prefetch'],
+                                      device_prefetch=self.config['worker']['device_prefetch'],
+                                      replay_prefetch=self.config['trace']['replay_prefetch'],
+                                      publish_channels=self.config['amqp']['publish_channels'])
         await self.task_broker.setup()
         await self.setup_amqp_admin()
 
@@ -133,8 +238,59 @@ class App:
                                        type_name='topic',
                                        durable=True,
                                        auto_delete=False)
+        if self.config['amqp']['event_credentials'] == 'shared':
+            await self.setup_shared_event_user()
+
+    async def setup_shared_event_user(self):
+        """
+        All the players use the same user, which can read every event queue
+        """
+        username = self.config['amqp']['event_username']
+        password = self.config['amqp']['event_password']
+        if not password:
+            raise ValueError('amqp.event_password is required with shared event credentials')
+        await self.amqp_admin.create_user(username, password)
+        await self.amqp_admin.set_permissions('/', username, read='^android-events\\..*')
 
     async def consume(self, channel, body, envelope, properties):
+        # Run the task aside: the callbacks of aioamqp block the connection,
+        # and the tasks of one queue must not wait for those of another.
+        # The prefetch counts limit the number of running tasks.
+        task = self.loop.create_task(self.process(channel, body, envelope, properties))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    async def drain(self, timeout):
+        """
+        Stop consuming, let the running tasks finish, then stop the loop
+        """
+        if self.draining:
+            return
+        self.draining = True
+        self.log.info('draining', running=len(self.running))
+        try:
+            await self.task_broker.cancel()
+        except Exception:
+            self.log.exception('could not cancel the consumers')
+        if self.running:
+            await asyncio.wait(list(self.running), timeout=timeout)
+        self.log.info('drained', running=len(self.running))
+        for pool in self.compilers.values():
+            await pool.close(self.log)
+        self.executor.shutdown(wait=False)
+        self.loop.stop()
+
+    def observe_latency(self, lane, properties):
+        try:
+            published = float(properties.headers['x-kyaraben-published'])
+        except (KeyError, ValueError):
+            return
+        self.meter.observe('%s_latency' % lane, time.time() - published)
+
+    async def process(self, channel, body, envelope, properties):
+        lane = task_lane(properties.headers.get('x-kyaraben-task', ''))
+        self.meter.mark('%s_received' % lane)
+        self.observe_latency(lane, properties)
         try:
             log = self.log.bind(delivery_tag=envelope.delivery_tag, message_id=properties.message_id)
             payload = body.decode('utf8')
@@ -148,6 +304,7 @@ class App:
                 log.info('message acknowledged')
                 await channel.basic_client_ack(delivery_tag=envelope.delivery_tag)
                 self.done_tasks += 1
+                self.meter.mark('%s_done' % lane)
         except Exception:
             log.exception()
             log.warning('message rejected upon task failure', message_id=properties.message_id)
@@ -164,14 +321,24 @@ class App:
                 # loop.call_soon_threadsafe(loop.stop)
 
     async def run(self):
-        self.log.info('waiting for messages')
-        await self.task_broker.consume(callback=self.consume)
+        self.log.info('waiting for messages', lanes=self.args.lanes)
+        await self.task_broker.consume(callback=self.consume, lanes=self.args.lanes, rotate=os.getpid())
+        self.loop.create_task(self.meter.report_forever(self.config['worker']['metrics_interval'],
+                                                        self.log,
+                                                        gauges=self.gauges))
+
+    async def gauges(self):
+        return {
+            '%s_depth' % lane: depth
+            for lane, depth in (await self.task_broker.queue_depths()).items()
+        }
 
 
-async def init(*, loop, config, args):
-    app = App(config=config, args=args, loop=loop)
+async def init(*, loop, config, args, metrics_sink=None):
+    app = App(config=config, args=args, loop=loop, metrics_sink=metrics_sink)
     await app.setup()
     await app.run()
+    return app
 
 
 def get_parser():
@@ -182,31 +349,66 @@ def get_parser():
                     nargs='*',
                     default=[])
 
+    ap.add_argument('--lanes',
+                    help='Consume tasks from these lanes only',
+                    nargs='+',
+                    choices=LANES,
+                    default=list(LANES))
+
+    ap.add_argument('--processes',
+                    help='Run this number of worker processes, under a supervisor',
+                    type=int,
+                    default=1)
+
     ap.add_argument('--tasks',
-                    help='Perform a given number of tasks, then quit (0 = loop forever)',
+                    help='Perform a given number of tasks, then quit (0 = loop forever). '
+                         'With --processes, the tasks are split between the workers',
                     type=int,
                     default=0)
 
     return ap
 
 
-def main(argv=sys.argv[1:]):
-    parser = get_parser()
-    args = parser.parse_args(argv)
+def run_worker(args, metrics_conn=None):
+    """
+    Run a worker process, until SIGTERM (or --tasks) stops it.
 
+    metrics_conn: end of a pipe to send the metrics to the supervisor
+    """
     config = config_get(environ=os.environ)
     setup_logging(config)
     setup_structlog(config,
                     key_order=['uid', 'project', 'project_id', 'avm'])
 
     loop = asyncio.get_event_loop()
-    # asyncio debugging
-    loop.set_debug(enabled=False)
+    setup_loop_debug(loop, config)
+
+    app = loop.run_until_complete(init(loop=loop, config=config, args=args,
+                                       metrics_sink=metrics_conn.send if metrics_conn else None))
 
-    loop.run_until_complete(init(loop=loop, config=config, args=args))
+    drain_timeout = config['worker']['drain_timeout']
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, lambda: loop.create_task(app.drain(drain_timeout)))
 
     try:
         loop.run_forever()
         loop.close()
     except KeyboardInterrupt:
         pass
+
+
+def main(argv=sys.argv[1:]):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+
+    if args.processes > 1:
+        config = config_get(environ=os.environ)
+        setup_logging(config)
+        setup_structlog(config)
+        supervisor = Supervisor(run_worker, args,
+                                processes=args.processes,
+                                drain_timeout=config['worker']['drain_timeout'],
+                                metrics_interval=config['worker']['metrics_interval'])
+        supervisor.run()
+    else:
+        run_worker(args)
@@ -0,0 +1,104 @@
+from http import HTTPStatus
+import json
+
+from .exceptions import AVMSnapshotError
+from .heatclient import status_message
+
+
+header_json_content = ('Content-Type', 'application/json')
+
+# reverting a volume to a snapshot requires this microversion
+header_revert_version = ('OpenStack-API-Version', 'volume 3.40')
+
+GET = 'get'
+POST = 'post'
+DELETE = 'delete'
+
+
+class CinderClient:
+    """
+    Snapshots of the volumes of an AVM, with the block storage API v3
+    """
+
+    def __init__(self, openstack, config):
+        self.openstack = openstack
+        self.config = config
+        # name of the service in the catalog
+        self.service = config['openstack']['volume_service']
+
+    async def request(self, method, path, **kwargs):
+        try:
+            return await self.openstack(self.service, method, path, **kwargs)
+        except KeyError:
+            # no endpoint for the service
+            raise AVMSnapshotError('%s is not in the service catalog' % self.service) from None
+
+    async def check(self, r, expected, log):
+        if r.status not in expected:
+            text = await r.text()
+            log.warning('Error from cinder', error=text)
+            raise AVMSnapshotError(status_message(r.status))
+
+    async def status(self, kind, object_id, log):
+        """
+        Status of a volume or snapshot, or None if it does not exist
+        """
+        r = await self.request(GET, [kind + 's', object_id])
+
+        if r.status == HTTPStatus.NOT_FOUND:
+            r.close()
+            return None
+
+        await self.check(r, [HTTPStatus.OK], log)
+
+        return (await r.json())[kind]['status']
+
+    async def volume_status(self, volume_id, log):
+        return await self.status('volume', volume_id, log)
+
+    async def snapshot_status(self, snapshot_id, log):
+        return await self.status('snapshot', snapshot_id, log)
+
+    async def snapshot_create(self, volume_id, name, log):
+        """
+        Snapshot a volume, even if it is attached. Return the snapshot id.
+        """
+        log.info('Creating snapshot', volume_id=volume_id, name=name)
+
+        r = await self.request(POST, ['snapshots'],
+                               data=json.dumps({
+                                   'snapshot': {
+                                       'volume_id': volume_id,
+                                       'name': name,
+                                       'force': True,
+                                   }
+                               }),
+                               headers=[header_json_content])
+        await self.check(r, [HTTPStatus.ACCEPTED], log)
+
+        return (await r.json())['snapshot']['id']
+
+    async def snapshot_delete(self, snapshot_id, log):
+        log.info('Removing snapshot', snapshot_id=snapshot_id)
+
+        r = await self.request(DELETE, ['snapshots', snapshot_id])
+
+        if r.status == HTTPStatus.NOT_FOUND:
+            r.close()
+            log.warning('snapshot already removed', snapshot_id=snapshot_id)
+            return
+
+        await self.check(r, [HTTPStatus.ACCEPTED], log)
+        r.close()
+
+    async def volume_revert(self, volume_id, snapshot_id, log):
+        """
+        Revert a detached volume to its latest snapshot
+        """
+        log.info('Reverting volume', volume_id=volume_id, snapshot_id=snapshot_id)
+
+        r = await self.request(POST, ['volumes', volume_id, 'action'],
+                               data=json.dumps({'revert': {'snapshot_id': snapshot_id}}),
+                               headers=[header_json_content, header_revert_version])
+        await self.check(r, [HTTPStatus.ACCEPTED], log)
+        r.close()
@@ -13,3 +13,7 @@ class AVMCreationError(OSHeatError):
 
 class AVMImageNotFoundError(AVMCreationError):
     pass
+
+
+class AVMSnapshotError(OSHeatError):
+    pass
@@ -38,10 +38,25 @@ def output_dict(outputs):
     return ret
 
 
+TEMPLATE_PACKAGE = 'ats.kyaraben.templates.openstack'
+
+
+def load_templates():
+    """
+    Read the stack templates once, rather than from the package at each stack creation
+    """
+    return {
+        name: pkg_resources.resource_string(TEMPLATE_PACKAGE, name).decode('utf8')
+        for name in pkg_resources.resource_listdir(TEMPLATE_PACKAGE, '')
+        if name.endswith(('.yaml', '.yml'))
+    }
+
+
 class HeatClient:
     def __init__(self, openstack, config):
         self.openstack = openstack
         self.config = config
+        self.templates = load_templates()
 
     async def stack_output(self, stack_name, stack_id, log):
         """
@@ -72,7 +87,10 @@ class HeatClient:
                 self.template_re.pattern)
             )
 
-        template = pkg_resources.resource_string('ats.kyaraben.templates.openstack', template).decode('utf8')
+        try:
+            template = self.templates[template]
+        except KeyError:
+            raise ValueError('Unknown template "%s"' % template)
 
         response_js = {
             'stack_name': stack_name,
@@ -98,6 +116,32 @@ class HeatClient:
 
         return js['stack']
 
+    async def stack_list(self, log, page_size=100):
+        """
+        Retrieves all the stacks visible to the tenant, following the pagination.
+
+        returns:
+            list of stack dictionaries (stack_name, id, stack_status...)
+        """
+        stacks = []
+        marker = None
+        while True:
+            query = 'stacks?limit=%d' % page_size
+            if marker:
+                query += '&marker=%s' % marker
+            r = await self.openstack(HEAT, GET, [query])
+
+            if r.status != HTTPStatus.OK:
+                text = await r.text()
+                log.warning('Error from heat', error=text)
+                raise Exception(status_message(r.status))
+
+            page = (await r.json())['stacks']
+            stacks.extend(page)
+            if len(page) < page_size:
+                return stacks
+            marker = page[-1]['id']
+
     async def lookup_stack_id(self, stack_name, log):
         r = await self.openstack(HEAT, GET, ['stacks', stack_name])
 
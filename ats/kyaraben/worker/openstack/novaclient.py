@@ -0,0 +1,81 @@
+from http import HTTPStatus
+import json
+
+from .exceptions import AVMSnapshotError
+from .heatclient import status_message
+
+
+header_json_content = ('Content-Type', 'application/json')
+
+NOVA = 'nova'
+
+GET = 'get'
+POST = 'post'
+DELETE = 'delete'
+
+
+class NovaClient:
+    """
+    The few server actions needed to swap the data volume of an AVM
+    """
+
+    def __init__(self, openstack, config):
+        self.openstack = openstack
+        self.config = config
+
+    async def check(self, r, expected, log):
+        if r.status not in expected:
+            text = await r.text()
+            log.warning('Error from nova', error=text)
+            raise AVMSnapshotError(status_message(r.status))
+
+    async def server_status(self, server_id, log):
+        """
+        ACTIVE, SHUTOFF... or None if the server does not exist
+        """
+        r = await self.openstack(NOVA, GET, ['servers', server_id])
+
+        if r.status == HTTPStatus.NOT_FOUND:
+            r.close()
+            return None
+
+        await self.check(r, [HTTPStatus.OK], log)
+
+        return (await r.json())['server']['status']
+
+    async def server_action(self, server_id, action, log):
+        log.info('Server action', server_id=server_id, action=action)
+
+        r = await self.openstack(NOVA, POST, ['servers', server_id, 'action'],
+                                 data=json.dumps({action: None}),
+                                 headers=[header_json_content])
+        await self.check(r, [HTTPStatus.ACCEPTED], log)
+        r.close()
+
+    async def server_stop(self, server_id, log):
+        await self.server_action(server_id, 'os-stop', log)
+
+    async def server_start(self, server_id, log):
+        await self.server_action(server_id, 'os-start', log)
+
+    async def volume_attach(self, server_id, volume_id, device, log):
+        log.info('Attaching volume', server_id=server_id, volume_id=volume_id, device=device)
+
+        r = await self.openstack(NOVA, POST, ['servers', server_id, 'os-volume_attachments'],
+                                 data=json.dumps({
+                                     'volumeAttachment': {
+                                         'volumeId': volume_id,
+                                         'device': device,
+                                     }
+                                 }),
+                                 headers=[header_json_content])
+        await self.check(r, [HTTPStatus.OK], log)
+        r.close()
+
+    async def volume_detach(self, server_id, volume_id, log):
+        log.info('Detaching volume', server_id=server_id, volume_id=volume_id)
+
+        r = await self.openstack(NOVA, DELETE,
+                                 ['servers', server_id, 'os-volume_attachments', volume_id])
+        await self.check(r, [HTTPStatus.ACCEPTED], log)
+        r.close()
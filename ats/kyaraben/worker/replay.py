@@ -0,0 +1,133 @@
+"""
+
+Replay a trace of player events on the android-events exchange.
+
+The events are grouped in ticks of batch_window seconds of trace time, and
+all the events of a tick are published, for every AVM, when the tick is
+due. Due times are computed from the start of the replay rather than from
+the previous tick, so that delays don't accumulate. A time_scale of 2
+replays the trace twice as fast.
+
+The progress is saved every progress_interval seconds. A replay whose
+message is delivered again, after a worker crash, resumes from there.
+A replay is stopped within progress_interval seconds, even in a long gap
+between two events: the wait is done in slices of that length.
+The events are not confirmed by the broker: a missed sample is better
+replaced by the next one than delayed.
+
+"""
+
+import asyncio
+import base64
+
+
+def event_ticks(events, *, start, window):
+    """
+    Yield (offset, [(key, payload)]) for the events from offset start,
+    grouped by window seconds.
+    """
+    tick_offset = None
+    tick = []
+    for offset, key, payload in events:
+        if offset < start:
+            continue
+        if tick and offset - tick_offset >= window:
+            yield tick_offset, tick
+            tick = []
+        if not tick:
+            tick_offset = offset
+        tick.append((key, base64.b64decode(payload)))
+    if tick:
+        yield tick_offset, tick
+
+
+class TraceReplayer:
+    def __init__(self, app, log, *, replay, events, avm_ids, time_scale,
+                 position=0, events_published=0, max_lag=0,
+                 batch_window, progress_interval):
+        self.app = app
+        self.log = log
+        self.replay = replay
+        self.events = events
+        self.avm_ids = avm_ids
+        self.time_scale = time_scale
+        self.position = position
+        self.events_published = events_published
+        self.max_lag = max_lag
+        self.batch_window = batch_window
+        self.progress_interval = progress_interval
+
+    async def save_progress(self):
+        await self.replay.update_progress(self.app,
+                                          position=self.position,
+                                          events_published=self.events_published,
+                                          max_lag=self.max_lag)
+
+    async def is_stopping(self):
+        if await self.replay.get_status(self.app) == 'STOPPING':
+            self.log.info('replay stopped', position=self.position)
+            return True
+        return False
+
+    async def wait_until(self, due):
+        """
+        Sleep until the loop time due, return False if the replay is
+        stopped in the meantime.
+        """
+        loop = asyncio.get_event_loop()
+        delay = due - loop.time()
+        while delay > 0:
+            await asyncio.sleep(min(delay, self.progress_interval))
+            delay = due - loop.time()
+            if delay > 0 and await self.is_stopping():
+                return False
+        return True
+
+    async def run(self):
+        """
+        Return True when the whole trace has been replayed, False if the
+        replay was stopped.
+        """
+        transport, protocol = await self.app.amqp_connection_factory()
+        try:
+            channel = await protocol.channel()
+            completed = await self.play(channel)
+            if completed:
+                self.position = self.events[-1][0]
+        finally:
+            await protocol.close()
+            transport.close()
+        await self.save_progress()
+        return completed
+
+    async def play(self, channel):
+        loop = asyncio.get_event_loop()
+        # a resumed replay starts where it stopped
+        ts_start = loop.time() - self.position / self.time_scale
+        ts_progress = loop.time()
+
+        prefixes = ['android-events.{}.'.format(avm_id) for avm_id in self.avm_ids]
+
+        for offset, tick in event_ticks(self.events, start=self.position, window=self.batch_window):
+            due = ts_start + offset / self.time_scale
+            if not await self.wait_until(due):
+                return False
+
+            for prefix in prefixes:
+                for key, payload in tick:
+                    await channel.publish(payload,
+                                          exchange_name='android-events',
+                                          routing_key=prefix + key)
+
+            self.events_published += len(tick) * len(prefixes)
+            self.max_lag = max(self.max_lag, loop.time() - due)
+            # the next tick, should the replay be resumed
+            self.position = offset + self.batch_window
+
+            if loop.time() - ts_progress > self.progress_interval:
+                ts_progress = loop.time()
+                await self.save_progress()
+                if await self.is_stopping():
+                    return False
+
+        return True
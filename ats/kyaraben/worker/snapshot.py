@@ -0,0 +1,159 @@
+"""
+
+Reset an AVM to a snapshot of its data volume.
+
+The data volume (the data_image of the stack) is snapshotted once the first
+boot has completed, before the AVM is READY. To reset the AVM, the server
+is stopped, the volume is detached, reverted to the snapshot in place by
+cinder, attached again and the server is started: the system and sdcard
+volumes, the player containers and the AMQP configuration are kept. The
+device boots again with the state it had after the first boot; the
+packages installed since then are gone.
+
+The snapshot is removed before the stack, which could not remove the data
+volume otherwise.
+
+"""
+
+import asyncio
+import time
+
+from ats.kyaraben.device import adb_shell
+from ats.kyaraben.model.android import AndroidVM
+
+from .openstack.exceptions import AVMSnapshotError
+
+
+# device of the data volume, as in the block_device_mapping of the templates
+DATA_DEVICE = '/dev/vdb'
+
+
+async def wait_status(app, what, get_status, wanted, *, log):
+    """
+    Poll get_status() until it returns wanted (None: the object is gone)
+    """
+    config = app.config['openstack']
+    deadline = time.monotonic() + config['volume_timeout']
+    while True:
+        status = await get_status()
+        if status == wanted:
+            return
+        if status is not None and status.lower().startswith('error'):
+            raise AVMSnapshotError('%s is %s' % (what, status))
+        if time.monotonic() > deadline:
+            raise AVMSnapshotError('%s is still %s, expected %s' % (what, status, wanted))
+        log.debug('waiting', what=what, status=status, wanted=wanted)
+        await asyncio.sleep(config['volume_poll_interval'])
+
+
+async def data_snapshot_create(app, log, *, avm_id, stack_name):
+    """
+    Snapshot the data volume of a booted AVM
+    """
+    avm = AndroidVM(avm_id=avm_id)
+
+    row = await avm.get_data_snapshot(app)
+
+    if row.data_snapshot_id:
+        log.info('data volume already snapshotted', snapshot_id=row.data_snapshot_id)
+        return
+
+    if not row.data_volume_id:
+        raise AVMSnapshotError('The data volume of %s is not known' % avm_id)
+
+    # the volume is snapshotted while in use, flush what can be
+    await adb_shell(app, avm_id, 'sync', log=log)
+
+    snapshot_id = await app.cinder.snapshot_create(row.data_volume_id,
+                                                   name='{}-data'.format(stack_name),
+                                                   log=log)
+
+    # recorded at once, to be removed with the stack
+    await avm.set_data_snapshot(app, snapshot_id)
+
+    try:
+        await wait_status(app, 'snapshot %s' % snapshot_id,
+                          lambda: app.cinder.snapshot_status(snapshot_id, log),
+                          'available', log=log)
+    except AVMSnapshotError:
+        await data_snapshot_delete(app, log, avm_id=avm_id)
+        raise
+
+    log.info('data volume snapshotted', snapshot_id=snapshot_id)
+
+
+async def data_snapshot_restore(app, log, *, avm_id):
+    """
+    Revert the data volume of an AVM to its snapshot, and boot it again
+    """
+    avm = AndroidVM(avm_id=avm_id)
+
+    row = await avm.get_data_snapshot(app)
+
+    if not row.data_snapshot_id:
+        raise AVMSnapshotError('No snapshot of the data volume of %s' % avm_id)
+
+    server_id = row.server_id
+    volume_id = row.data_volume_id
+    snapshot_id = row.data_snapshot_id
+
+    def server_status():
+        return app.nova.server_status(server_id, log)
+
+    def volume_status():
+        return app.cinder.volume_status(volume_id, log)
+
+    log.info('resetting avm', snapshot_id=snapshot_id)
+
+    await wait_status(app, 'snapshot %s' % snapshot_id,
+                      lambda: app.cinder.snapshot_status(snapshot_id, log),
+                      'available', log=log)
+
+    app.adb_pool.discard(avm_id)
+    app.device_state.forget(avm_id)
+
+    # a previous attempt may have stopped halfway
+    if await server_status() != 'SHUTOFF':
+        await app.nova.server_stop(server_id, log)
+        await wait_status(app, 'server %s' % server_id, server_status, 'SHUTOFF', log=log)
+
+    if await volume_status() == 'in-use':
+        await app.nova.volume_detach(server_id, volume_id, log)
+        await wait_status(app, 'volume %s' % volume_id, volume_status, 'available', log=log)
+
+    await app.cinder.volume_revert(volume_id, snapshot_id, log)
+    await wait_status(app, 'volume %s' % volume_id, volume_status, 'available', log=log)
+
+    await app.nova.volume_attach(server_id, volume_id, DATA_DEVICE, log)
+    await wait_status(app, 'volume %s' % volume_id, volume_status, 'in-use', log=log)
+
+    await app.nova.server_start(server_id, log)
+    await wait_status(app, 'server %s' % server_id, server_status, 'ACTIVE', log=log)
+
+    # the device will be prepared and the packages installed again
+    await avm.forget_installed_packages(app)
+    await avm.set_install_boot_id(app, None)
+
+    log.info('avm reset', snapshot_id=snapshot_id)
+
+
+async def data_snapshot_delete(app, log, *, avm_id):
+    """
+    Remove the snapshot of the data volume of an AVM, if any
+    """
+    avm = AndroidVM(avm_id=avm_id)
+
+    row = await avm.get_data_snapshot(app)
+
+    if not row.data_snapshot_id:
+        return
+
+    snapshot_id = row.data_snapshot_id
+
+    await app.cinder.snapshot_delete(snapshot_id, log)
+
+    await wait_status(app, 'snapshot %s' % snapshot_id,
+                      lambda: app.cinder.snapshot_status(snapshot_id, log),
+                      None, log=log)
+
+    await avm.set_data_snapshot(app, None)
@@ -0,0 +1,152 @@
+"""
+
+Run several worker processes on one machine.
+
+The supervisor starts the workers, restarts those that exit unexpectedly,
+logs the sum of their metrics, and on SIGTERM or SIGINT lets them finish
+their running tasks before exiting.
+
+"""
+
+import copy
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import signal
+import time
+
+import structlog
+
+
+class Child:
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.ts_started = time.monotonic()
+
+
+class Supervisor:
+    # don't restart a crashing worker more often than that
+    restart_delay = 5
+
+    def __init__(self, target, args, *, processes, drain_timeout, metrics_interval):
+        """
+        target(args, metrics_conn) runs a worker
+        """
+        self.target = target
+        self.args = copy.copy(args)
+        self.args.processes = 1
+        # --tasks is the total: it is split between the workers
+        self.tasks = args.tasks
+        if self.tasks:
+            processes = min(processes, self.tasks)
+        self.processes = processes
+        self.drain_timeout = drain_timeout
+        self.metrics_interval = metrics_interval
+        self.log = structlog.get_logger()
+        # workers don't share anything with the supervisor (event loop, connections)
+        self.mp = multiprocessing.get_context('spawn')
+        self.children = {}
+        # pid -> last metrics sent by the worker
+        self.metrics = {}
+        self.stopping = False
+
+    def slot_tasks(self, slot):
+        """
+        Share of --tasks of the worker in a slot (0: loop forever)
+        """
+        if not self.tasks:
+            return 0
+        return self.tasks // self.processes + (1 if slot < self.tasks % self.processes else 0)
+
+    def start_child(self, slot):
+        args = copy.copy(self.args)
+        args.tasks = self.slot_tasks(slot)
+        parent_conn, child_conn = self.mp.Pipe(duplex=False)
+        process = self.mp.Process(target=self.target,
+                                  args=(args, child_conn),
+                                  name='kyaraben-worker-%d' % slot)
+        process.start()
+        child_conn.close()
+        self.children[slot] = Child(process, parent_conn)
+        self.log.info('worker started', slot=slot, pid=process.pid)
+
+    def stop(self, signum, frame):
+        self.log.info('stopping workers', signal=signum)
+        self.stopping = True
+
+    def receive_metrics(self, timeout):
+        conns = {child.conn: child for child in self.children.values() if child.conn is not None}
+        if not conns:
+            time.sleep(timeout)
+            return
+        for conn in wait(list(conns), timeout=timeout):
+            try:
+                self.metrics[conns[conn].process.pid] = conn.recv()
+            except (EOFError, OSError):
+                # the worker has exited
+                conn.close()
+                conns[conn].conn = None
+
+    def report_metrics(self):
+        totals = {}
+        rates = {}
+        for metrics in self.metrics.values():
+            for event, count in metrics['totals'].items():
+                totals[event] = totals.get(event, 0) + count
+            for name, value in metrics['rates'].items():
+                if name.endswith('_per_sec'):
+                    rates[name] = round(rates.get(name, 0) + value, 2)
+        self.log.info('worker fleet metrics', workers=len(self.metrics), totals=totals, **rates)
+
+    def check_children(self):
+        for slot, child in list(self.children.items()):
+            if child.process.is_alive():
+                continue
+            self.metrics.pop(child.process.pid, None)
+            if child.conn is not None:
+                child.conn.close()
+                # not to be waited on again while the restart is delayed
+                child.conn = None
+            if self.tasks and child.process.exitcode == 0:
+                # --tasks: the worker is done
+                self.log.info('worker finished', slot=slot, pid=child.process.pid)
+                del self.children[slot]
+                continue
+            if time.monotonic() - child.ts_started < self.restart_delay:
+                continue
+            self.log.warning('worker exited, restarting', slot=slot, pid=child.process.pid,
+                             exitcode=child.process.exitcode)
+            self.start_child(slot)
+
+    def drain(self):
+        for child in self.children.values():
+            if child.process.is_alive():
+                child.process.terminate()
+        deadline = time.monotonic() + self.drain_timeout + 5
+        for slot, child in self.children.items():
+            child.process.join(max(0, deadline - time.monotonic()))
+            if child.process.is_alive():
+                self.log.warning('worker did not stop, killing it', slot=slot, pid=child.process.pid)
+                os.kill(child.process.pid, signal.SIGKILL)
+                child.process.join()
+        self.log.info('all workers stopped')
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for slot in range(self.processes):
+            self.start_child(slot)
+
+        ts_reported = time.monotonic()
+        while not self.stopping and self.children:
+            self.receive_metrics(timeout=1)
+            if self.stopping:
+                break
+            self.check_children()
+            if time.monotonic() - ts_reported > self.metrics_interval:
+                self.report_metrics()
+                ts_reported = time.monotonic()
+
+        self.drain()
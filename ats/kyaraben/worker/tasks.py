@@ -1,26 +1,38 @@
 
+import asyncio
+import collections
 import datetime
+import hashlib
+import json
 import os
-import tempfile
+import time
 import uuid
 import re
 
 from ats.kyaraben.model.android import AndroidVM
 from ats.kyaraben.model.apk import APK
-from ats.kyaraben.model.camera import Camera
-from ats.kyaraben.model.campaign import Campaign
+from ats.kyaraben.model.camera import CameraCache
 from ats.kyaraben.model.command import Command
-from ats.kyaraben.model.project import Project
-from ats.kyaraben.model.testsource import Testsource
-from ats.kyaraben.docker import cmd_docker_exec, cmd_docker, cmd_docker_cp, cmd_docker_run
+from ats.kyaraben.model.testsource import CompileCache
+from ats.kyaraben.model.trace import Trace, TraceReplay
+from ats.kyaraben.blocking import run_blocking
+from ats.kyaraben.device import (adb_install, adb_shell, install_apk, prepare_install,
+                                 prj_container)
+from ats.kyaraben.docker import (cmd_docker_exec, cmd_docker, cmd_docker_cp,
+                                 cmd_docker_read_file)
 from ats.kyaraben.password import generate_password
 from ats.kyaraben.process import quoted_cmdline, ProcessError
+from ats.kyaraben.tasks import OutgoingTask
 from ats.util.db import sql
 
 from .amqp.admin import AMQPRestError
-from .amqp.queues import create_event_queues, delete_event_queues
+from .amqp.queues import create_event_queues, delete_event_queues, delete_event_queues_many
+from .compiler import CompilerBusy
 from .compose import player_up, player_down, project_up, project_down
-from .openstack.exceptions import AVMNotFoundError
+from .openstack.exceptions import AVMNotFoundError, OSHeatError
+from .replay import TraceReplayer
+from .snapshot import data_snapshot_create, data_snapshot_delete, data_snapshot_restore
+from .transcode import TranscodeBusy, read_source, source_extension
 
 
 class TaskDelay(Exception):
@@ -40,16 +52,8 @@ def new_stack_name(stack_prefix, userid, avm_id):
         return '{}-{}'.format(userid, avm_id)
 
 
-def adb_container(avm_id):
-    return '{}_adb'.format(avm_id)
-
-
-def prj_container(project_id):
-    return '{}_prjdata'.format(project_id)
-
-
-async def project_container_create(app, log, *, userid, project_id):
-    project = await Project.get(app, project_id=project_id, userid=userid)
+async def project_container_create(app, log, *, ctx, userid, project_id):
+    project = await ctx.project(project_id=project_id, userid=userid)
     if not project:
         raise Exception('Project %s not found, or no permission for user %s' % (project_id, userid))
 
@@ -62,39 +66,84 @@ async def project_container_create(app, log, *, userid, project_id):
     log.info('project READY', project_id=project_id)
 
 
-async def project_container_delete(app, log, *, userid, project_id):
-    project = await Project.get(app, project_id=project_id, userid=userid)
+async def project_container_delete(app, log, *, ctx, userid, project_id, force=False):
+    project = await ctx.project(project_id=project_id, userid=userid)
     if not project:
         raise Exception('Project %s not found, or no permission for user %s' % (project_id, userid))
 
+    if force:
+        await project.cancel_campaigns(app)
+        await avms_teardown(app, log, avms=await project.live_avms(app))
+
     if (await project.is_active(app)):
         raise Exception('cannot delete project with active vms or campaigns')
 
     await project_down(project_id=project_id)
 
+    await CompileCache.forget_project(app, project_id)
+    await CameraCache.forget_project(app, project_id)
+
     log.info('deleting project', project_id=project_id)
     await project.set_status(app, 'DELETED')
 
 
-async def camera_upload(app, log, *, userid, project_id, camera_id, filename, tmppath):
-    project = await Project.get(app, project_id=project_id, userid=userid)
+async def camera_upload(app, log, *, ctx, userid, project_id, camera_id, filename, tmppath):
+    project = await ctx.project(project_id=project_id, userid=userid)
     if not project:
         raise Exception('Project %s not found, or no permission for user %s' % (project_id, userid))
 
-    camera = await Camera.get(app, camera_id=camera_id, project_id=project_id, userid=userid)
+    camera = await ctx.camera(camera_id=camera_id, project_id=project_id, userid=userid)
 
     log.info('uploading file', filename=filename)
 
-    with open(tmppath, 'rb') as fin:
-        # XXX should buffer or use docker cp
-        stdin_bytes = fin.read()
+    stdin_bytes, source_sha256 = await run_blocking(app, read_source, tmppath)
+    extension = source_extension(filename)
+    output_format = app.config['camera']['output_format']
+    camera_path = await app.camera_path(camera_id=camera_id)
+
+    cached = await CameraCache.get(app,
+                                   source_sha256=source_sha256,
+                                   extension=extension,
+                                   output_format=output_format)
 
-    await cmd_docker_exec('-i', prj_container(project_id),
-                          '/root/video_create.sh',
-                          filename,
-                          await app.camera_path(camera_id=camera_id),
-                          log=log,
-                          stdin_bytes=stdin_bytes)
+    if cached:
+        log.info('camera cache hit', camera_id=cached.camera_id)
+        try:
+            await cmd_docker_cp(from_container=prj_container(cached.project_id),
+                                from_file=await app.camera_path(camera_id=cached.camera_id),
+                                to_container=prj_container(project_id),
+                                to_file=camera_path,
+                                log=log)
+        except ProcessError as exc:
+            log.warning('cannot copy the cached camera file',
+                        camera_id=cached.camera_id, error=str(exc))
+            await CameraCache.forget_camera(app, cached.camera_id)
+            cached = None
+
+    if not cached:
+        async def convert():
+            await cmd_docker_exec('-i', prj_container(project_id),
+                                  '/root/video_create.sh',
+                                  filename,
+                                  camera_path,
+                                  log=log,
+                                  stdin_bytes=stdin_bytes)
+
+        try:
+            _, seconds = await app.transcoder.run(convert)
+        except TranscodeBusy as exc:
+            raise TaskDelay(exc.args[0])
+
+        app.meter.observe('camera_transcode', seconds)
+        log.info('camera file converted', filename=filename, seconds=round(seconds, 3))
+        await camera.set_transcode_seconds(app, seconds)
+
+        await CameraCache.add(app,
+                              source_sha256=source_sha256,
+                              extension=extension,
+                              output_format=output_format,
+                              camera_id=camera_id,
+                              project_id=project_id)
 
     await camera.set_status(app, 'READY')
 
@@ -102,12 +151,12 @@ async def camera_upload(app, log, *, userid, project_id, camera_id, filename, tm
     os.unlink(tmppath)
 
 
-async def apk_upload(app, log, *, userid, project_id, apk_id, filename, tmppath):
-    project = await Project.get(app, project_id=project_id, userid=userid)
+async def apk_upload(app, log, *, ctx, userid, project_id, apk_id, filename, tmppath):
+    project = await ctx.project(project_id=project_id, userid=userid)
     if not project:
         raise Exception('Project %s not found, or no permission for user %s' % (project_id, userid))
 
-    apk = await APK.get(app, apk_id=apk_id, project_id=project_id, userid=userid)
+    apk = await ctx.apk(apk_id=apk_id, project_id=project_id, userid=userid)
 
     log.info('uploading file', filename=filename)
 
@@ -124,33 +173,37 @@ async def apk_upload(app, log, *, userid, project_id, apk_id, filename, tmppath)
     os.unlink(tmppath)
 
 
-async def camera_delete(app, log, *, userid, project_id, camera_id):
-    project = await Project.get(app, project_id=project_id, userid=userid)
+async def camera_delete(app, log, *, ctx, userid, project_id, camera_id):
+    project = await ctx.project(project_id=project_id, userid=userid)
     if not project:
         raise Exception('Project %s not found, or no permission for user %s' % (project_id, userid))
 
-    camera = await Camera.get(app, camera_id=camera_id, project_id=project_id, userid=userid)
+    camera = await ctx.camera(camera_id=camera_id, project_id=project_id, userid=userid)
 
     log.info('deleting file', camera_id=camera_id)
 
+    await CameraCache.forget_camera(app, camera_id)
+
     await cmd_docker_exec(prj_container(project_id),
                           'rm', '-f', await app.camera_path(camera_id=camera_id), log=log)
 
     await camera.set_status(app, 'DELETED')
 
 
-async def apk_delete(app, log, *, userid, project_id, apk_id):
-    project = await Project.get(app, project_id=project_id, userid=userid)
+async def apk_delete(app, log, *, ctx, userid, project_id, apk_id):
+    project = await ctx.project(project_id=project_id, userid=userid)
     if not project:
         raise Exception('Project %s not found, or no permission for user %s' % (project_id, userid))
 
-    apk = await APK.get(app, apk_id=apk_id, project_id=project_id, userid=userid)
+    apk = await ctx.apk(apk_id=apk_id, project_id=project_id, userid=userid)
 
     log.info('deleting apk', apk_id=apk_id)
 
     await cmd_docker_exec(prj_container(project_id),
                           'rm', '-f', await app.apk_path(apk_id=apk_id), log=log)
 
+    await CompileCache.forget_apk(app, apk_id)
+
     await sql(app, """
               UPDATE testsources
                  SET apk_id = NULL
@@ -160,13 +213,33 @@ async def apk_delete(app, log, *, userid, project_id, apk_id):
     await apk.set_status(app, 'DELETED')
 
 
-async def avm_amqp_config_create(app, log, *, userid, avm_id, amqp_user, amqp_password):
-    avm = await AndroidVM.get(app, avm_id=avm_id, userid=userid)
+def shared_event_credentials(app):
+    return app.config['amqp']['event_credentials'] == 'shared'
+
+
+def amqp_event_user(app, avm_id):
+    if shared_event_credentials(app):
+        return app.config['amqp']['event_username']
+    return avm_id
+
+
+def amqp_event_password(app):
+    if shared_event_credentials(app):
+        return app.config['amqp']['event_password']
+    return generate_password(32)
+
+
+async def avm_amqp_config_create(app, log, *, ctx, userid, avm_id, amqp_user, amqp_password):
+    avm = await ctx.avm(avm_id=avm_id, userid=userid)
     if not avm:
         raise Exception('AVM %s not found, or no permission for user %s' % (avm_id, userid))
 
     await create_event_queues(app, log, avm_id=avm_id)
 
+    if shared_event_credentials(app):
+        # created by the worker at startup
+        return
+
     try:
         await app.amqp_admin.create_user(amqp_user, amqp_password)
     except AMQPRestError:
@@ -180,13 +253,17 @@ async def avm_amqp_config_create(app, log, *, userid, avm_id, amqp_user, amqp_pa
         raise
 
 
-async def avm_amqp_config_delete(app, log, *, userid, avm_id):
-    avm = await AndroidVM.get(app, avm_id=avm_id, userid=userid)
+async def avm_amqp_config_delete(app, log, *, ctx, userid, avm_id):
+    avm = await ctx.avm(avm_id=avm_id, userid=userid)
     if not avm:
         raise Exception('User %s has no permission for avm %s' % (userid, avm_id))
 
     await delete_event_queues(app, log, avm_id=avm_id)
 
+    if shared_event_credentials(app):
+        # a user left by a previous configuration is removed by kyaraben-monitor
+        return
+
     try:
         await app.amqp_admin.delete_user(avm_id)
     except AMQPRestError as exc:
@@ -197,28 +274,10 @@ async def avm_amqp_config_delete(app, log, *, userid, avm_id):
             raise
 
 
-async def avm_create(app, log, *, userid, image, project_id, avm_id, hwconfig, vnc_secret):
-    avm = await AndroidVM.get(app, avm_id=avm_id, userid=userid)
-    if not avm:
-        raise Exception('User %s has no permission for avm %s' % (userid, avm_id))
-
-    await avm.set_status(app, 'CREATING')
-
-    amqp_user = avm_id
-    amqp_password = generate_password(32)
-
-    await avm_amqp_config_create(app, log,
-                                 userid=userid,
-                                 avm_id=avm_id,
-                                 amqp_user=amqp_user,
-                                 amqp_password=amqp_password)
-
-    stack_prefix = app.config['orchestration']['stackprefix']
-
-    stack_name = new_stack_name(stack_prefix, userid, avm_id)
-
-    await avm.update_stack_name(app, stack_name=stack_name)
-
+async def avm_stack_create(app, log, *, stack_name, image):
+    """
+    Create the Heat stack of an AVM, return {'id': stack_id}
+    """
     row = await sql(app, """
             SELECT system_image, data_image
               FROM images
@@ -238,6 +297,40 @@ async def avm_create(app, log, *, userid, image, project_id, avm_id, hwconfig, v
         template=app.config['openstack']['template'],
         log=log)
 
+    return {'id': stack['id']}
+
+
+async def avm_create(app, log, *, ctx, userid, image, project_id, avm_id, hwconfig, vnc_secret):
+    avm = await ctx.avm(avm_id=avm_id, userid=userid)
+    if not avm:
+        raise Exception('User %s has no permission for avm %s' % (userid, avm_id))
+
+    await avm.set_status(app, 'CREATING')
+
+    amqp_user = amqp_event_user(app, avm_id)
+
+    async def amqp_config_create():
+        amqp_password = amqp_event_password(app)
+        await avm_amqp_config_create(app, log,
+                                     ctx=ctx,
+                                     userid=userid,
+                                     avm_id=avm_id,
+                                     amqp_user=amqp_user,
+                                     amqp_password=amqp_password)
+        return amqp_password
+
+    amqp_password = await ctx.checkpoint('amqp_config_create', amqp_config_create)
+
+    stack_prefix = app.config['orchestration']['stackprefix']
+
+    stack_name = new_stack_name(stack_prefix, userid, avm_id)
+
+    await avm.update_stack_name(app, stack_name=stack_name)
+
+    stack = await ctx.checkpoint('stack_create', lambda: avm_stack_create(app, log,
+                                                                          stack_name=stack_name,
+                                                                          image=image))
+
     rows = await sql(app, """
                      SELECT android_version::TEXT AS android_version
                        FROM images
@@ -259,13 +352,13 @@ async def avm_create(app, log, *, userid, image, project_id, avm_id, hwconfig, v
         'stack_id': stack['id'],
         'userid': userid,
         'vnc_secret': vnc_secret,
-    }, log=log)
+    }, message_id=ctx.child_message_id('avm_containers_create'), log=log)
 
 
-async def avm_containers_create(app, log, *, userid, project_id, avm_id,
+async def avm_containers_create(app, log, *, ctx, userid, project_id, avm_id,
                                 amqp_user, amqp_password, hwconfig,
                                 stack_name, stack_id, android_version, vnc_secret):
-    avm = await AndroidVM.get(app, avm_id=avm_id, userid=userid)
+    avm = await ctx.avm(avm_id=avm_id, userid=userid)
     if not avm:
         raise Exception('User %s has no permission for avm %s' % (userid, avm_id))
 
@@ -282,6 +375,13 @@ async def avm_containers_create(app, log, *, userid, project_id, avm_id,
 
     amqp_host = app.config['amqp']['hostname']
 
+    await avm.update_instance_ip(app, instance_ip=instance_ip)
+
+    # not in the outputs of every template
+    await avm.update_data_volume(app,
+                                 server_id=stack_output.get('server_id'),
+                                 data_volume_id=stack_output.get('data_volume_id'))
+
     await player_up(project_id=project_id,
                     avm_id=avm_id,
                     instance_ip=instance_ip,
@@ -289,16 +389,76 @@ async def avm_containers_create(app, log, *, userid, project_id, avm_id,
                     amqp_host=amqp_host,
                     amqp_user=amqp_user,
                     amqp_password=amqp_password,
+                    amqp_topology=app.config['amqp']['event_topology'],
                     vnc_secret=vnc_secret,
                     android_version=android_version)
 
     await avm.start_billing(app)
 
+    if app.config['openstack']['data_snapshot'] and stack_output.get('data_volume_id'):
+        # READY once the snapshot is taken, so that it has the state of the first boot
+        await app.task_broker.publish('avm_snapshot_create', {
+            'userid': userid,
+            'avm_id': avm_id,
+            'stack_name': stack_name,
+        }, message_id=ctx.child_message_id('avm_snapshot_create'), log=log)
+        return
+
+    await avm.set_status(app, 'READY')
+
+
+async def avm_snapshot_create(app, log, *, ctx, userid, avm_id, stack_name):
+    avm = await ctx.avm(avm_id=avm_id, userid=userid)
+    if not avm:
+        raise Exception('User %s has no permission for avm %s' % (userid, avm_id))
+
+    async def now():
+        return time.time()
+
+    # the message is delivered again until the device has booted
+    ts_first = await ctx.checkpoint('first_attempt', now)
+
+    if await app.device_state.wait_boot_completed(avm.avm_id, timeout=0, log=log):
+        try:
+            await data_snapshot_create(app, log, avm_id=avm_id, stack_name=stack_name)
+        except Exception as exc:
+            # the AVM is usable, it just can't be reset
+            log.warning('cannot snapshot avm', exception=repr(exc))
+    elif time.time() - ts_first < app.config['openstack']['data_snapshot_boot_timeout']:
+        raise TaskDelay('dev.bootcomplete != 1 for %s' % stack_name)
+    else:
+        log.warning('cannot snapshot avm, the device has not booted')
+
+    status, _ = await avm.get_status(app)
+    # unless it has been deleted in the meantime
+    if status == 'CREATING':
+        await avm.set_status(app, 'READY')
+
+
+async def avm_reset(app, log, *, ctx, userid, avm_id):
+    avm = await ctx.avm(avm_id=avm_id, userid=userid)
+    if not avm:
+        raise Exception('User %s has no permission for avm %s' % (userid, avm_id))
+
+    await data_snapshot_restore(app, log, avm_id=avm_id)
+
     await avm.set_status(app, 'READY')
 
 
-async def avm_delete(app, log, *, userid, avm_id, stack_name):
-    avm = await AndroidVM.get(app, avm_id=avm_id, userid=userid)
+async def avm_stack_delete(app, log, *, avm_id, stack_name):
+    """
+    Remove the stack of an AVM, after the snapshot that would keep its data volume
+    """
+    await data_snapshot_delete(app, log, avm_id=avm_id)
+
+    try:
+        await app.heat.stack_delete(stack_name=stack_name, log=log)
+    except AVMNotFoundError:
+        log.warning('stack already removed', stack_name=stack_name)
+
+
+async def avm_delete(app, log, *, ctx, userid, avm_id, stack_name):
+    avm = await ctx.avm(avm_id=avm_id, userid=userid)
     if not avm:
         raise Exception('User %s has no permission for avm %s' % (userid, avm_id))
 
@@ -306,35 +466,37 @@ async def avm_delete(app, log, *, userid, avm_id, stack_name):
 
     await player_down(avm_id=avm_id, project_id=project_id)
 
+    app.adb_pool.discard(avm_id)
+    app.device_state.forget(avm_id)
+
     await avm.stop_billing(app)
 
     await avm_amqp_config_delete(app, log,
+                                 ctx=ctx,
                                  userid=userid,
                                  avm_id=avm_id)
 
-    try:
-        await app.heat.stack_delete(stack_name=stack_name, log=log)
-    except AVMNotFoundError:
-        log.warning('stack already removed', stack_name=stack_name)
+    await avm_stack_delete(app, log, avm_id=avm_id, stack_name=stack_name)
 
     await avm.set_status(app, 'DELETED')
 
 
-async def apk_install(app, log, *, userid, project_id, avm_id, apk_id, command_id):
-    avm = await AndroidVM.get(app, avm_id=avm_id, userid=userid)
+async def apk_install(app, log, *, ctx, userid, project_id, avm_id, apk_id, command_id,
+                      batch_id=None):
+    avm = await ctx.avm(avm_id=avm_id, userid=userid)
     if not avm:
         raise Exception('User %s has no permission for avm %s' % (userid, avm_id))
 
     log.info('installing APK', avm_id=avm_id, apk_id=apk_id)
 
-    apk = await APK.get(app,
-                        apk_id=apk_id,
+    apk = await ctx.apk(apk_id=apk_id,
                         project_id=project_id,
                         userid=userid)
 
     package_name = await apk.get_package_name(app)
 
-    unquoted_command = ['adb', 'install', '-r', await app.apk_path(apk_id=apk_id)]
+    apk_path = await app.apk_path(apk_id=apk_id)
+    unquoted_command = ['adb', 'install', '-r', apk_path]
 
     quoted_command = quoted_cmdline(*unquoted_command)
     ts_begin = datetime.datetime.now()
@@ -350,19 +512,17 @@ async def apk_install(app, log, *, userid, project_id, avm_id, apk_id, command_i
                AND command_id = %s
         """, [quoted_command, ts_begin, avm_id, command_id])
 
-    # force uninstall, in case of changed signature, etc.
-    try:
-        await cmd_docker_exec(adb_container(avm_id), 'adb', 'shell', 'pm', 'uninstall', package_name, log=log)
-    except ProcessError:
-        pass
-
-    await cmd_docker_exec(adb_container(avm_id),
-                          'adb', 'shell', 'settings', 'put', 'global', 'install_non_market_apps', '1', log=log)
-
-    await cmd_docker_exec(adb_container(avm_id),
-                          'adb', 'shell', 'settings', 'put', 'global', 'package_verifier_enable', '0', log=log)
-
-    proc = await cmd_docker_exec(adb_container(avm_id), *unquoted_command, log=log)
+    if package_name:
+        proc = await install_apk(app, avm_id,
+                                 project_id=project_id,
+                                 apk=apk,
+                                 package_name=package_name,
+                                 apk_path=apk_path,
+                                 log=log)
+    else:
+        # the package name could not be read at upload
+        await prepare_install(app, avm_id, log=log)
+        proc = await adb_install(app, avm_id, project_id=project_id, apk_path=apk_path, log=log)
 
     ts_end = datetime.datetime.now()
 
@@ -384,8 +544,9 @@ async def apk_install(app, log, *, userid, project_id, avm_id, apk_id, command_i
     log.info('APK installed', avm_id=avm_id, apk_id=apk_id)
 
 
-async def avm_monkey(app, log, *, userid, avm_id, command_id, packages, event_count, throttle):
-    avm = await AndroidVM.get(app, avm_id=avm_id, userid=userid)
+async def avm_monkey(app, log, *, ctx, userid, avm_id, command_id, packages, event_count, throttle,
+                     batch_id=None):
+    avm = await ctx.avm(avm_id=avm_id, userid=userid)
     if not avm:
         raise Exception('User %s has no permission for avm %s' % (userid, avm_id))
 
@@ -416,7 +577,7 @@ async def avm_monkey(app, log, *, userid, avm_id, command_id, packages, event_co
                AND command_id = %s
         """, [quoted_command, ts_begin, avm_id, command_id])
 
-    proc = await cmd_docker_exec(adb_container(avm_id), *unquoted_command, log=log)
+    proc = await adb_shell(app, avm_id, *unquoted_command[2:], log=log)
 
     ts_end = datetime.datetime.now()
 
@@ -435,8 +596,8 @@ async def avm_monkey(app, log, *, userid, avm_id, command_id, packages, event_co
     log.info('monkey finished', status=proc.status)
 
 
-async def avm_test_run(app, log, *, userid, avm_id, package, command_id):
-    avm = await AndroidVM.get(app, avm_id=avm_id, userid=userid)
+async def avm_test_run(app, log, *, ctx, userid, avm_id, package, command_id, batch_id=None):
+    avm = await ctx.avm(avm_id=avm_id, userid=userid)
     if not avm:
         raise Exception('User %s has no permission for avm %s' % (userid, avm_id))
 
@@ -458,7 +619,7 @@ async def avm_test_run(app, log, *, userid, avm_id, package, command_id):
                AND command_id = %s
         """, [quoted_command, ts_begin, avm_id, command_id])
 
-    proc = await cmd_docker_exec(adb_container(avm_id), *unquoted_command, log=log)
+    proc = await adb_shell(app, avm_id, *unquoted_command[2:], log=log)
 
     ts_end = datetime.datetime.now()
 
@@ -477,18 +638,20 @@ async def avm_test_run(app, log, *, userid, avm_id, package, command_id):
     log.info('test run finished', status=proc.status)
 
 
-async def campaign_run(app, log, *, userid, project_id, campaign_id):
-    project = await Project.get(app, project_id=project_id, userid=userid)
+async def campaign_run(app, log, *, ctx, userid, project_id, campaign_id):
+    project = await ctx.project(project_id=project_id, userid=userid)
     if not project:
         raise Exception('User %s has no permission for project %s' % (userid, project_id))
 
-    campaign = await Campaign.get(app, campaign_id=campaign_id, project_id=project_id, userid=userid)
+    campaign = await ctx.campaign(campaign_id=campaign_id, project_id=project_id, userid=userid)
     if not campaign:
         raise Exception('Campaign not found: %s' % campaign_id)
 
     await campaign.set_status(app, 'RUNNING')
 
-    # create task for each image
+    # testruns by image and hwconfig, which can share an AVM
+
+    groups = collections.OrderedDict()
 
     for row in await sql(app, """
             SELECT testruns.testrun_id,
@@ -509,65 +672,128 @@ async def campaign_run(app, log, *, userid, project_id, campaign_id):
         apk_ids = row.apk_ids
         packages = [pkg for pkg in set(row.packages) if pkg is not None]
 
-        await app.task_broker.publish('campaign_avm_create', {
-            'userid': userid,
-            'project_id': project_id,
-            'campaign_id': campaign_id,
+        if not packages:
+            # from the manifests, or listed on the device after the installs
+            packages = await APK.instrumentations_many(app, apk_ids) or []
+            for package in packages:
+                await sql(app, """
+                          INSERT INTO testrun_packages (
+                              testrun_id, package
+                          ) SELECT %s, %s
+                             WHERE NOT EXISTS (SELECT 1
+                                                 FROM testrun_packages
+                                                WHERE testrun_id = %s
+                                                      AND package = %s)
+                          """, [testrun_id, package, testrun_id, package])
+
+        key = (image, json.dumps(hwconfig, sort_keys=True))
+        groups.setdefault(key, []).append({
             'testrun_id': testrun_id,
-            'image': image,
             'hwconfig': hwconfig,
             'apk_ids': apk_ids,
-            'packages': packages
-        }, log=log)
+            'packages': packages,
+        })
 
+    # create an AVM for each chain of up to avm_reuse_limit testruns
+
+    reuse_limit = max(1, app.config['campaign']['avm_reuse_limit'])
+
+    avm_tasks = []
+
+    for (image, _), testruns in groups.items():
+        for start in range(0, len(testruns), reuse_limit):
+            first, *next_testruns = testruns[start:start + reuse_limit]
+            avm_tasks.append(OutgoingTask('campaign_avm_create', {
+                'userid': userid,
+                'project_id': project_id,
+                'campaign_id': campaign_id,
+                'testrun_id': first['testrun_id'],
+                'image': image,
+                'hwconfig': first['hwconfig'],
+                'apk_ids': first['apk_ids'],
+                'packages': first['packages'],
+                'next_testruns': [chained_testrun(testrun) for testrun in next_testruns],
+            }, message_id=ctx.child_message_id('campaign_avm_create/%s' % first['testrun_id'])))
 
-async def campaign_avm_create(app, log, *, userid, project_id, campaign_id,
-                              testrun_id, image, hwconfig, apk_ids, packages):
-    project = await Project.get(app, project_id=project_id, userid=userid)
+    log.info('campaign testruns', testruns=sum(len(testruns) for testruns in groups.values()),
+             avms=len(avm_tasks))
+
+    await app.task_broker.publish_many(avm_tasks, log=log)
+
+
+def chained_testrun(testrun):
+    """
+    What campaign_runtest needs to know of the testruns that follow on the same AVM
+    """
+    return {
+        'testrun_id': testrun['testrun_id'],
+        'apk_ids': testrun['apk_ids'],
+        'packages': testrun['packages'],
+    }
+
+
+async def campaign_avm_create(app, log, *, ctx, userid, project_id, campaign_id,
+                              testrun_id, image, hwconfig, apk_ids, packages, next_testruns=None):
+    project = await ctx.project(project_id=project_id, userid=userid)
     if not project:
         raise Exception('User %s has no permission for project %s' % (userid, project_id))
 
-    campaign = await Campaign.get(app, campaign_id=campaign_id, project_id=project_id, userid=userid)
+    campaign = await ctx.campaign(campaign_id=campaign_id, project_id=project_id, userid=userid)
     if not campaign:
         raise Exception('Campaign not found: %s' % campaign_id)
 
-    avm_id = uuid.uuid1().hex
+    async def avm_insert():
+        avm_id = uuid.uuid1().hex
 
-    log = log.bind(avm_id=avm_id)
+        vnc_secret = generate_password(128, password_chars='01234567890abcdef')
 
-    vnc_secret = generate_password(128, password_chars='01234567890abcdef')
+        vm_per_user = app.config['quota']['vm_async_max']
 
-    vm_per_user = app.config['quota']['vm_async_max']
+        async_current = (await AndroidVM.count(app, uid_owner=userid))['async_current']
 
-    async_current = (await AndroidVM.count(app, uid_owner=userid))['async_current']
+        if vm_per_user and async_current >= vm_per_user:
+            raise TaskDelay('Async vm quota reached (%d), waiting for a slot' % async_current)
 
-    if vm_per_user and async_current >= vm_per_user:
-        raise TaskDelay('Async vm quota reached (%d), waiting for a slot' % async_current)
+        await AndroidVM.insert(app,
+                               avm_id=avm_id,
+                               avm_name=None,
+                               userid=userid,
+                               project_id=project.project_id,
+                               image=image,
+                               hwconfig=hwconfig,
+                               testrun_id=testrun_id,
+                               vnc_secret=vnc_secret)
 
-    await AndroidVM.insert(app,
-                           avm_id=avm_id,
-                           avm_name=None,
-                           userid=userid,
-                           project_id=project.project_id,
-                           image=image,
-                           hwconfig=hwconfig,
-                           testrun_id=testrun_id,
-                           vnc_secret=vnc_secret)
+        await campaign.set_testrun_avm(app, testrun_id=testrun_id, avm_id=avm_id)
 
-    avm = await AndroidVM.get(app, avm_id=avm_id, userid=userid)
+        return {'avm_id': avm_id, 'vnc_secret': vnc_secret}
+
+    # a redelivered message must not boot another VM
+    inserted = await ctx.checkpoint('avm_insert', avm_insert)
+    avm_id = inserted['avm_id']
+    vnc_secret = inserted['vnc_secret']
+
+    log = log.bind(avm_id=avm_id)
+
+    avm = await ctx.avm(avm_id=avm_id, userid=userid)
     if not avm:
         raise Exception('User %s has no permission for avm %s' % (userid, avm_id))
 
     await avm.set_status(app, 'CREATING')
 
-    amqp_user = avm_id
-    amqp_password = generate_password(32)
+    amqp_user = amqp_event_user(app, avm_id)
 
-    await avm_amqp_config_create(app, log,
-                                 userid=userid,
-                                 avm_id=avm_id,
-                                 amqp_user=amqp_user,
-                                 amqp_password=amqp_password)
+    async def amqp_config_create():
+        amqp_password = amqp_event_password(app)
+        await avm_amqp_config_create(app, log,
+                                     ctx=ctx,
+                                     userid=userid,
+                                     avm_id=avm_id,
+                                     amqp_user=amqp_user,
+                                     amqp_password=amqp_password)
+        return amqp_password
+
+    amqp_password = await ctx.checkpoint('amqp_config_create', amqp_config_create)
 
     stack_prefix = app.config['orchestration']['stackprefix']
 
@@ -575,24 +801,9 @@ async def campaign_avm_create(app, log, *, userid, project_id, campaign_id,
 
     await avm.update_stack_name(app, stack_name=stack_name)
 
-    row = await sql(app, """
-            SELECT system_image, data_image
-              FROM images
-             WHERE image = %s""", [image])
-
-    system_image = row[0].system_image
-    data_image = row[0].data_image
-
-    stack = await app.heat.stack_create(
-        stack_name=stack_name,
-        stack_params={
-            'system_image': system_image,
-            'data_image': data_image,
-            # floating_net is only used by developer stack templates
-            'floating_net': app.config['openstack']['floating_net'],
-        },
-        template=app.config['openstack']['template'],
-        log=log)
+    stack = await ctx.checkpoint('stack_create', lambda: avm_stack_create(app, log,
+                                                                          stack_name=stack_name,
+                                                                          image=image))
 
     rows = await sql(app, """
                      SELECT android_version::TEXT AS android_version
@@ -618,15 +829,16 @@ async def campaign_avm_create(app, log, *, userid, project_id, campaign_id,
         'stack_id': stack['id'],
         'apk_ids': apk_ids,
         'packages': packages,
+        'next_testruns': next_testruns,
         'vnc_secret': vnc_secret
-    }, log=log)
+    }, message_id=ctx.child_message_id('campaign_containers_create'), log=log)
 
 
-async def campaign_containers_create(app, log, *, userid, project_id, campaign_id,
+async def campaign_containers_create(app, log, *, ctx, userid, project_id, campaign_id,
                                      testrun_id, avm_id, hwconfig, amqp_user, amqp_password,
                                      android_version, stack_name, stack_id, apk_ids, packages,
-                                     vnc_secret):
-    avm = await AndroidVM.get(app, avm_id=avm_id, userid=userid)
+                                     vnc_secret, next_testruns=None):
+    avm = await ctx.avm(avm_id=avm_id, userid=userid)
     if not avm:
         raise Exception('User %s has no permission for avm %s' % (userid, avm_id))
 
@@ -643,6 +855,13 @@ async def campaign_containers_create(app, log, *, userid, project_id, campaign_i
 
     amqp_host = app.config['amqp']['hostname']
 
+    await avm.update_instance_ip(app, instance_ip=instance_ip)
+
+    # not in the outputs of every template
+    await avm.update_data_volume(app,
+                                 server_id=stack_output.get('server_id'),
+                                 data_volume_id=stack_output.get('data_volume_id'))
+
     await player_up(project_id=project_id,
                     avm_id=avm_id,
                     instance_ip=instance_ip,
@@ -650,6 +869,7 @@ async def campaign_containers_create(app, log, *, userid, project_id, campaign_i
                     amqp_host=amqp_host,
                     amqp_user=amqp_user,
                     amqp_password=amqp_password,
+                    amqp_topology=app.config['amqp']['event_topology'],
                     vnc_secret=vnc_secret,
                     android_version=android_version)
 
@@ -666,26 +886,128 @@ async def campaign_containers_create(app, log, *, userid, project_id, campaign_i
         'apk_ids': apk_ids,
         'testrun_id': testrun_id,
         'packages': packages,
-    }, log=log)
+        'next_testruns': next_testruns,
+    }, message_id=ctx.child_message_id('campaign_runtest'), log=log)
 
 
-async def campaign_runtest(app, log, *, userid, project_id, campaign_id,
-                           avm_id, stack_name, apk_ids, testrun_id, packages):
-    campaign = await Campaign.get(app, campaign_id=campaign_id, project_id=project_id, userid=userid)
+async def campaign_runtest(app, log, *, ctx, userid, project_id, campaign_id,
+                           avm_id, stack_name, apk_ids, testrun_id, packages, next_testruns=None):
+    campaign = await ctx.campaign(campaign_id=campaign_id, project_id=project_id, userid=userid)
     if not campaign:
         raise Exception('Campaign not found: %s' % campaign_id)
 
-    avm = await AndroidVM.get(app, avm_id=avm_id, userid=userid)
+    avm = await ctx.avm(avm_id=avm_id, userid=userid)
     if not avm:
         raise Exception('User %s has no permission for avm %s' % (userid, avm_id))
 
+    # start as soon as the boot has completed, rather than waiting for a retry
+    if not await app.device_state.wait_boot_completed(avm.avm_id,
+                                                      timeout=app.config['device']['boot_wait'],
+                                                      log=log):
+        raise TaskDelay('dev.bootcomplete != 1 for %s' % stack_name)
+
+    next_testruns = next_testruns or []
+
+    snapshot_reset = app.config['campaign']['snapshot_reset'] and bool(next_testruns)
+
+    if snapshot_reset:
+        try:
+            await data_snapshot_create(app, log, avm_id=avm_id, stack_name=stack_name)
+        except (OSHeatError, ProcessError) as exc:
+            log.warning('cannot snapshot avm, the packages will be reset', exception=repr(exc))
+            snapshot_reset = False
+
     try:
-        proc = await cmd_docker_exec(adb_container(avm.avm_id),
-                                     'adb', 'shell', 'getprop', 'dev.bootcomplete', log=log)
-        if proc.out != '1':
-            raise TaskDelay('dev.bootcomplete != 1 for %s' % stack_name)
-    except ProcessError:
-        raise TaskDelay('dev.bootcomplete not responding for %s' % stack_name)
+        await campaign_testrun(app, log,
+                               avm=avm,
+                               project_id=project_id,
+                               testrun_id=testrun_id,
+                               apk_ids=apk_ids,
+                               packages=packages)
+    except Exception:
+        if next_testruns:
+            # don't fail the testruns that were to follow on this AVM
+            await campaign_chain_restart(app, log,
+                                         ctx=ctx,
+                                         userid=userid,
+                                         project_id=project_id,
+                                         campaign_id=campaign_id,
+                                         testruns=next_testruns)
+        raise
+
+    if next_testruns:
+        following = next_testruns[0]
+
+        log.info('reusing avm', testrun_id=following['testrun_id'])
+
+        try:
+            if snapshot_reset:
+                await data_snapshot_restore(app, log, avm_id=avm_id)
+            else:
+                await campaign_reset_device(app, log,
+                                            avm_id=avm_id,
+                                            apk_ids=apk_ids,
+                                            next_apk_ids=following['apk_ids'])
+        except (ProcessError, OSHeatError):
+            log.warning('cannot reset avm, the next testruns will have a new one')
+            await campaign_chain_restart(app, log,
+                                         ctx=ctx,
+                                         userid=userid,
+                                         project_id=project_id,
+                                         campaign_id=campaign_id,
+                                         testruns=next_testruns)
+            next_testruns = []
+
+    if next_testruns:
+        following, *next_testruns = next_testruns
+
+        await campaign.set_testrun_avm(app, testrun_id=following['testrun_id'], avm_id=avm_id)
+
+        await app.task_broker.publish('campaign_runtest', {
+            'userid': userid,
+            'project_id': project_id,
+            'campaign_id': campaign_id,
+            'avm_id': avm_id,
+            'stack_name': stack_name,
+            'apk_ids': following['apk_ids'],
+            'testrun_id': following['testrun_id'],
+            'packages': following['packages'],
+            'next_testruns': next_testruns,
+        }, message_id=ctx.child_message_id('campaign_runtest/%s' % following['testrun_id']),
+            log=log)
+        return
+
+    log.info('deleting avm')
+
+    await avm.set_status(app, 'DELETING')
+
+    project_id = await avm.get_project_id(app)
+
+    await player_down(avm_id=avm_id, project_id=project_id)
+
+    app.adb_pool.discard(avm_id)
+    app.device_state.forget(avm_id)
+
+    await avm.stop_billing(app)
+
+    await avm_amqp_config_delete(app, log,
+                                 ctx=ctx,
+                                 userid=userid,
+                                 avm_id=avm_id)
+
+    await avm_stack_delete(app, log, avm_id=avm_id, stack_name=stack_name)
+
+    await avm.set_status(app, 'DELETED')
+
+    if list((await campaign.command_statuses(app)).keys()) == ['READY']:
+        await campaign.set_status(app, 'READY')
+
+
+async def campaign_testrun(app, log, *, avm, project_id, testrun_id, apk_ids, packages):
+    """
+    Install the APKs of a testrun and run its test packages
+    """
+    avm_id = avm.avm_id
 
     for apk_id in apk_ids:
         command_id = uuid.uuid1().hex
@@ -707,7 +1029,8 @@ async def campaign_runtest(app, log, *, userid, project_id, campaign_id,
 
         log.info('installing APK', apk_id=apk_id)
 
-        unquoted_command = ['adb', 'install', '-r', await app.apk_path(apk_id=apk_id)]
+        apk_path = await app.apk_path(apk_id=apk_id)
+        unquoted_command = ['adb', 'install', '-r', apk_path]
 
         quoted_command = quoted_cmdline(*unquoted_command)
         ts_begin = datetime.datetime.now()
@@ -723,7 +1046,18 @@ async def campaign_runtest(app, log, *, userid, project_id, campaign_id,
                 AND command_id = %s
             """, [quoted_command, ts_begin, avm_id, command_id])
 
-        proc = await cmd_docker_exec(adb_container(avm_id), *unquoted_command, log=log)
+        apk = APK(apk_id=apk_id)
+        package_name = await apk.get_package_name(app)
+
+        if package_name:
+            proc = await install_apk(app, avm_id,
+                                     project_id=project_id,
+                                     apk=apk,
+                                     package_name=package_name,
+                                     apk_path=apk_path,
+                                     log=log)
+        else:
+            proc = await adb_install(app, avm_id, project_id=project_id, apk_path=apk_path, log=log)
 
         ts_end = datetime.datetime.now()
 
@@ -787,7 +1121,7 @@ async def campaign_runtest(app, log, *, userid, project_id, campaign_id,
                 AND command_id = %s
             """, [quoted_command, ts_begin, avm_id, command_id])
 
-        proc = await cmd_docker_exec(adb_container(avm_id), *unquoted_command, log=log)
+        proc = await adb_shell(app, avm_id, *unquoted_command[2:], log=log)
 
         ts_end = datetime.datetime.now()
 
@@ -805,107 +1139,160 @@ async def campaign_runtest(app, log, *, userid, project_id, campaign_id,
 
         log.info('test run finished', status=proc.status)
 
-    log.info('deleting avm')
 
-    project_id = await avm.get_project_id(app)
+async def campaign_reset_device(app, log, *, avm_id, apk_ids, next_apk_ids):
+    """
+    Remove the state left by a testrun before the next one on the same AVM.
+    The APKs needed again are kept, with their data cleared, so that they
+    are not installed twice.
+    """
+    for apk_id in apk_ids:
+        package_name = await APK(apk_id=apk_id).get_package_name(app)
+        if not package_name:
+            continue
+        if apk_id in next_apk_ids:
+            await adb_shell(app, avm_id, 'pm', 'clear', package_name, log=log)
+            continue
+        try:
+            await adb_shell(app, avm_id, 'pm', 'uninstall', package_name, log=log)
+        except ProcessError:
+            pass
+        await AndroidVM(avm_id=avm_id).forget_installed_package(app, package_name)
 
-    await player_down(avm_id=avm_id, project_id=project_id)
 
-    await avm.stop_billing(app)
+async def campaign_chain_restart(app, log, *, ctx, userid, project_id, campaign_id, testruns):
+    """
+    Run the testruns on a new AVM, after a failure of the AVM they were chained to
+    """
+    first, *next_testruns = testruns
 
-    await avm_amqp_config_delete(app, log,
-                                 userid=userid,
-                                 avm_id=avm_id)
+    rows = await sql(app, """
+        SELECT image,
+               hwconfig
+          FROM testruns
+         WHERE testrun_id = %s
+        """, [first['testrun_id']])
 
-    try:
-        await app.heat.stack_delete(stack_name=stack_name, log=log)
-    except AVMNotFoundError:
-        log.warning('stack already removed', stack_name=stack_name)
+    await app.task_broker.publish('campaign_avm_create', {
+        'userid': userid,
+        'project_id': project_id,
+        'campaign_id': campaign_id,
+        'testrun_id': first['testrun_id'],
+        'image': rows[0].image,
+        'hwconfig': rows[0].hwconfig,
+        'apk_ids': first['apk_ids'],
+        'packages': first['packages'],
+        'next_testruns': next_testruns,
+    }, message_id=ctx.child_message_id('campaign_avm_create/%s' % first['testrun_id']),
+        log=log)
 
-    await avm.set_status(app, 'DELETED')
 
-    if list((await campaign.command_statuses(app)).keys()) == ['READY']:
-        await campaign.set_status(app, 'READY')
+DSLCC_OUTPUT = '/home/developer/com.zenika.aicdsl/DslFiles/Testing.java'
+TESTCC_OUTPUT = '/home/developer/signed.apk'
 
 
-async def testsource_compile(app, log, *, userid, project_id, testsource_id):
-    project = await Project.get(app, project_id=project_id, userid=userid)
+async def testsource_compile(app, log, *, ctx, userid, project_id, testsource_id):
+    project = await ctx.project(project_id=project_id, userid=userid)
     if not project:
         raise Exception('User %s has no permission for project %s' % (userid, project_id))
 
-    testsource = await Testsource.get(app,
-                                      testsource_id=testsource_id,
-                                      project_id=project.project_id,
-                                      userid=userid)
+    testsource = await ctx.testsource(testsource_id=testsource_id,
+                                  project_id=project.project_id,
+                                  userid=userid)
 
     apk_id = await testsource.apk_id(app)
     content = await testsource.content(app)
 
-    apk = await APK.get(app,
-                        apk_id=apk_id,
+    apk = await ctx.apk(apk_id=apk_id,
                         project_id=project.project_id,
                         userid=userid)
 
     if not apk:
         raise Exception('APK not found: %s' % apk_id)
 
-    await apk.set_status(app, 'COMPILING DSL')
-
-    dslcc_container = uuid.uuid1().hex
-
-    try:
-        await cmd_docker_run('--name', dslcc_container, '-i', '--restart=no', 'aic.dslcc',
-                             'scripts/compile.sh',
-                             log=log,
-                             stdin_bytes=content.encode('utf8'))
-    except ProcessError as exc:
-        await apk.set_status(app, 'ERROR', reason=exc.proc.err)
-        await cmd_docker('rm', '-f', dslcc_container, log=log)
-        return
+    apk_path = await app.apk_path(apk_id=apk_id)
 
-    log.info('dslcc: {}'.format(dslcc_container))
+    source_sha256 = hashlib.sha256(content.encode('utf8')).hexdigest()
 
-    dslcc_output = '/home/developer/com.zenika.aicdsl/DslFiles/Testing.java'
-    testcc_output = '/home/developer/signed.apk'
+    cached = await CompileCache.get(app, source_sha256)
 
-    with tempfile.NamedTemporaryFile() as testing_java:
-        await cmd_docker('cp', '{}:{}'.format(dslcc_container, dslcc_output), testing_java.name, log=log)
-        with open(testing_java.name) as fin:
-            testing_java_content = fin.read()
+    # a new build is installed again on the devices
+    fingerprint = None
 
-        await apk.set_status(app, 'COMPILING JAVA')
+    if cached and cached.apk_id != apk_id:
+        log.info('compile cache hit', apk_id=cached.apk_id)
+        fingerprint = await APK(apk_id=cached.apk_id).get_fingerprint(app)
+        try:
+            await cmd_docker_cp(from_container=prj_container(cached.project_id),
+                                from_file=await app.apk_path(apk_id=cached.apk_id),
+                                to_container=prj_container(project_id),
+                                to_file=apk_path,
+                                sha256=fingerprint and fingerprint.sha256,
+                                log=log)
+        except ProcessError as exc:
+            log.warning('cannot copy the cached APK', apk_id=cached.apk_id, error=str(exc))
+            await CompileCache.forget_apk(app, cached.apk_id)
+            cached = fingerprint = None
 
-        testcc_container = uuid.uuid1().hex
+    if cached:
+        package_name = cached.package
+    else:
+        # the file of the APK is replaced
+        await CompileCache.forget_apk(app, apk_id)
 
         try:
-            proc = await cmd_docker_run('--name', testcc_container, '-i', '--restart=no', 'aic.testcc',
-                                        '/home/developer/scripts/compile.sh',
-                                        log=log,
-                                        stdin_bytes=testing_java_content.encode('utf8'))
+            package_name = await compile_testsource(app, log,
+                                                    apk=apk,
+                                                    content=content,
+                                                    project_id=project_id,
+                                                    apk_path=apk_path)
+        except CompilerBusy as exc:
+            raise TaskDelay(exc.args[0])
         except ProcessError as exc:
             await apk.set_status(app, 'ERROR', reason=exc.proc.err)
-            await cmd_docker('rm', '-f', dslcc_container, log=log)
-            await cmd_docker('rm', '-f', testcc_container, log=log)
             return
 
-        package_name = proc.out_lines[-1]
+        await CompileCache.add(app,
+                               source_sha256=source_sha256,
+                               apk_id=apk_id,
+                               project_id=project_id,
+                               package=package_name)
 
-    tempdir = app.config['media']['tempdir']
+    await apk.set_package_name(app, package_name)
+    await apk.set_fingerprint(app, fingerprint)
 
-    await cmd_docker('rm', '-f', dslcc_container, log=log)
+    await apk.set_status(app, 'READY')
 
-    await cmd_docker_cp(from_container=testcc_container,
-                        from_file=testcc_output,
-                        to_container='{}_prjdata'.format(project_id),
-                        to_file=await app.apk_path(apk_id=apk_id),
-                        tempdir=tempdir,
-                        log=log)
 
-    await apk.set_package_name(app, package_name)
+async def compile_testsource(app, log, *, apk, content, project_id, apk_path):
+    """
+    Compile a DSL source to Java, then to an APK written to apk_path in the
+    project container. Return the package name.
+    """
+    async def dslcc(container):
+        await apk.set_status(app, 'COMPILING DSL')
+        await cmd_docker_exec(container, 'rm', '-f', DSLCC_OUTPUT, log=log)
+        await cmd_docker_exec('-i', container, 'scripts/compile.sh',
+                              log=log,
+                              stdin_bytes=content.encode('utf8'))
+        return await cmd_docker_read_file(container=container, path=DSLCC_OUTPUT, log=log)
 
-    await cmd_docker('rm', '-f', testcc_container, log=log)
+    testing_java = await app.compilers['dslcc'].run(dslcc, log=log)
 
-    await apk.set_status(app, 'READY')
+    async def testcc(container):
+        await apk.set_status(app, 'COMPILING JAVA')
+        await cmd_docker_exec(container, 'rm', '-f', TESTCC_OUTPUT, log=log)
+        proc = await cmd_docker_exec('-i', container, '/home/developer/scripts/compile.sh',
+                                     log=log,
+                                     stdin_bytes=testing_java)
+        await cmd_docker_cp(from_container=container,
+                            from_file=TESTCC_OUTPUT,
+                            to_container=prj_container(project_id),
+                            to_file=apk_path,
+                            log=log)
+        return proc.out_lines[-1]
+
+    return await app.compilers['testcc'].run(testcc, log=log)
 
 
 async def campaign_get_packages(app, avm_id, log):
@@ -913,7 +1300,7 @@ async def campaign_get_packages(app, avm_id, log):
 
     unquoted_command = ['adb', 'shell', 'pm', 'list', 'instrumentation']
 
-    proc = await cmd_docker_exec(adb_container(avm_id), *unquoted_command, log=log)
+    proc = await adb_shell(app, avm_id, *unquoted_command[2:], log=log)
 
     _re_parse_instrumentation = re.compile('instrumentation:(?P<package>.*) \(target=(?P<target>.*)\)')
 
@@ -930,24 +1317,126 @@ async def campaign_get_packages(app, avm_id, log):
     return packages
 
 
-async def campaign_delete(app, log, *, userid, project_id, campaign_id):
+async def avms_teardown(app, log, *, avms, reason=''):
+    """
+    Remove several AVMs at once: containers and stacks are removed concurrently
+    (at most worker.teardown_concurrency at a time), while database and AMQP
+    updates are done in bulk.
+
+    avms is a list of rows with avm_id, project_id and stack_name. reason is
+    recorded with the DELETED status.
+    """
+    if not avms:
+        return
+
+    avm_ids = [avm.avm_id for avm in avms]
 
-    campaign = await Campaign.get(app, campaign_id=campaign_id, project_id=project_id, userid=userid)
+    log.info('tearing down avms', avm_count=len(avm_ids))
 
-    for row in await sql(app, """
-            SELECT avm_id, stack_name
+    await AndroidVM.set_status_many(app, avm_ids, 'DELETING')
+
+    semaphore = asyncio.Semaphore(app.config['worker']['teardown_concurrency'])
+
+    async def teardown_one(avm):
+        async with semaphore:
+            await player_down(avm_id=avm.avm_id, project_id=avm.project_id)
+            if avm.stack_name:
+                await avm_stack_delete(app, log, avm_id=avm.avm_id, stack_name=avm.stack_name)
+
+    results = await asyncio.gather(*[teardown_one(avm) for avm in avms],
+                                   return_exceptions=True)
+
+    deleted = []
+    failed = []
+    for avm, result in zip(avms, results):
+        if isinstance(result, Exception):
+            log.error('could not remove avm', avm_id=avm.avm_id, exception=repr(result))
+            failed.append(avm.avm_id)
+        else:
+            deleted.append(avm.avm_id)
+
+    # the stack and containers of a failed teardown may still be running
+    await AndroidVM.stop_billing_many(app, deleted)
+
+    await AndroidVM.set_status_many(app, deleted, 'DELETED', reason=reason)
+    await AndroidVM.set_status_many(app, failed, 'ERROR', reason='teardown failed')
+
+    # kyaraben-monitor runs the teardown as well, and has no device connections
+    if hasattr(app, 'adb_pool'):
+        for avm_id in avm_ids:
+            app.adb_pool.discard(avm_id)
+            app.device_state.forget(avm_id)
+
+    await delete_event_queues_many(app, log, avm_ids=avm_ids)
+
+    # with shared credentials, the AVMs have no user of their own
+    if not shared_event_credentials(app):
+        try:
+            await app.amqp_admin.delete_users(avm_ids)
+        except AMQPRestError as exc:
+            # the users left are removed by kyaraben-monitor
+            log.warning('Could not remove AMQP users (%s)', exc)
+
+    log.info('avms removed', deleted=len(deleted), failed=len(failed))
+
+
+async def campaign_delete(app, log, *, ctx, userid, project_id, campaign_id):
+
+    campaign = await ctx.campaign(campaign_id=campaign_id, project_id=project_id, userid=userid)
+
+    avms = await sql(app, """
+            SELECT DISTINCT campaign_resources.avm_id,
+                   campaign_resources.stack_name,
+                   avms.project_id
               FROM campaign_resources
-             WHERE campaign_id = %s""", [campaign_id]):
-        avm_id = row.avm_id
-        stack_name = row.stack_name
+              JOIN avms ON avms.avm_id = campaign_resources.avm_id
+             WHERE campaign_id = %s
+                   AND avms.status <> 'DELETED'
+                   AND avms.avm_id IN (SELECT avm_id FROM permission_avms WHERE userid = %s)
+            """, [campaign_id, userid])
 
-        avm = await AndroidVM.get(app, avm_id=avm_id, userid=userid)
-        if avm:
-            await app.task_broker.publish('avm_delete', {
-                'userid': userid,
-                'avm_id': avm_id,
-                'stack_name': stack_name,
-            }, log=log)
-            await avm.set_status(app, status='DELETING')
+    await avms_teardown(app, log, avms=avms)
 
     await campaign.set_status(app, status='DELETED')
+
+
+async def trace_replay(app, log, *, ctx, userid, project_id, trace_id, replay_id):
+    project = await ctx.project(project_id=project_id, userid=userid)
+    if not project:
+        raise Exception('User %s has no permission for project %s' % (userid, project_id))
+
+    replay = TraceReplay(replay_id=replay_id)
+    row = await replay.select(app)
+
+    if row['status'] == 'STOPPING':
+        await replay.set_status(app, 'STOPPED')
+        return
+
+    if row['status'] not in ('QUEUED', 'RUNNING'):
+        log.warning('replay already ended', status=row['status'])
+        return
+
+    await replay.set_status(app, 'RUNNING')
+
+    config_trace = app.config['trace']
+
+    replayer = TraceReplayer(app, log,
+                             replay=replay,
+                             events=await Trace(trace_id=trace_id).events(app),
+                             avm_ids=row['avm_ids'],
+                             time_scale=row['time_scale'],
+                             position=row['position'],
+                             events_published=row['events_published'],
+                             max_lag=row['max_lag'],
+                             batch_window=config_trace['batch_window'],
+                             progress_interval=config_trace['progress_interval'])
+
+    log.info('replay started', avm_count=len(row['avm_ids']), position=row['position'])
+
+    completed = await replayer.run()
+
+    log.info('replay ended', completed=completed,
+             events_published=replayer.events_published,
+             max_lag=round(replayer.max_lag, 3))
+
+    await replay.set_status(app, 'FINISHED' if completed else 'STOPPED')
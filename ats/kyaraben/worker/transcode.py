@@ -0,0 +1,63 @@
+"""
+
+Bounded pool of the camera file conversions.
+
+video_create.sh runs in the project container and is CPU bound: the number
+of conversions a worker runs at once is limited, whatever the number of
+batch tasks it consumes. Past queue_max conversions waiting for a slot,
+TranscodeBusy is raised and the task is delayed, rather than holding a slot
+of the batch lane.
+
+"""
+
+import asyncio
+import hashlib
+import os
+import time
+
+
+class TranscodeBusy(Exception):
+    pass
+
+
+def source_extension(filename):
+    """
+    The lowercase extension of an uploaded file, which the conversion may depend on
+    """
+    return os.path.splitext(filename)[1].lower()[:16]
+
+
+def read_source(path):
+    """
+    Return the content of an uploaded file, and its SHA-256
+    """
+    with open(path, 'rb') as fin:
+        content = fin.read()
+    return content, hashlib.sha256(content).hexdigest()
+
+
+class TranscodePool:
+    def __init__(self, *, size, queue_max):
+        self.semaphore = asyncio.Semaphore(size)
+        self.queue_max = queue_max
+        self.waiting = 0
+
+    async def run(self, func):
+        """
+        Return (await func(), seconds spent in func)
+        """
+        if self.waiting >= self.queue_max:
+            raise TranscodeBusy('%d conversions waiting' % self.waiting)
+
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        try:
+            ts_start = time.monotonic()
+            ret = await func()
+            return ret, time.monotonic() - ts_start
+        finally:
+            self.semaphore.release()
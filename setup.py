@@ -57,6 +57,7 @@ setup(
             'kyaraben-server = ats.kyaraben.server.main:main',
             'kyaraben-worker = ats.kyaraben.worker.main:main',
             'kyaraben-retry = ats.kyaraben.retry.main:main',
+            'kyaraben-monitor = ats.kyaraben.monitor.main:main',
         ],
         # for Cliff
         'kyaraben': [
@@ -71,10 +72,13 @@ setup(
             'android monkey run = ats.kyaraben.client.android:Monkey',
             'android otp = ats.kyaraben.client.android:GetOTP',
             'android properties = ats.kyaraben.client.android:Properties',
+            'android reset = ats.kyaraben.client.android:Reset',
             'android show = ats.kyaraben.client.android:Show',
             'android test list = ats.kyaraben.client.android:TestList',
             'android test run = ats.kyaraben.client.android:TestRun',
             'android update = ats.kyaraben.client.android:Update',
+            'fleet command run = ats.kyaraben.client.fleet:Run',
+            'fleet command status = ats.kyaraben.client.fleet:Status',
             'image list = ats.kyaraben.client.image:List',
             'project apk delete = ats.kyaraben.client.project_apk:Delete',
             'project apk list = ats.kyaraben.client.project_apk:List',
@@ -99,6 +103,12 @@ setup(
             'project testsource delete = ats.kyaraben.client.testsource:Delete',
             'project testsource download = ats.kyaraben.client.testsource:Download',
             'project update = ats.kyaraben.client.project:Update',
+            'project trace delete = ats.kyaraben.client.trace:Delete',
+            'project trace list = ats.kyaraben.client.trace:List',
+            'project trace replay = ats.kyaraben.client.trace:Replay',
+            'project trace upload = ats.kyaraben.client.trace:Upload',
+            'project replay show = ats.kyaraben.client.trace:ReplayShow',
+            'project replay stop = ats.kyaraben.client.trace:ReplayStop',
             'user quota = ats.kyaraben.client.user:Quota',
             'user whoami = ats.kyaraben.client.user:Whoami',
         ]
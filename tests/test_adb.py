@@ -0,0 +1,153 @@
+import asyncio
+import struct
+import unittest
+
+from ats.kyaraben.adb import (A_CLSE, A_CNXN, A_OKAY, A_OPEN, A_VERSION, A_WRTE, AdbConnection,
+                              AdbError, HEADER, pack_message, parse_shell_status, sync_request,
+                              unpack_header)
+
+
+class TestMessages(unittest.TestCase):
+    def test_roundtrip(self):
+        msg = pack_message(A_CNXN, 0x01000000, 4096, b'host::\0')
+        self.assertEqual(len(msg), HEADER.size + 7)
+        self.assertEqual(unpack_header(msg[:HEADER.size]), (A_CNXN, 0x01000000, 4096, 7))
+        self.assertEqual(msg[HEADER.size:], b'host::\0')
+
+    def test_checksum(self):
+        msg = pack_message(A_OKAY, 1, 2, b'\x01\x02\xff')
+        self.assertEqual(HEADER.unpack(msg[:HEADER.size])[4], 0x102)
+
+    def test_bad_magic(self):
+        header = bytearray(pack_message(A_OKAY, 1, 2))
+        header[-1] ^= 0xff
+        with self.assertRaises(AdbError):
+            unpack_header(bytes(header))
+
+    def test_sync_request(self):
+        self.assertEqual(sync_request(b'DATA', 3, b'abc'), b'DATA\x03\x00\x00\x00abc')
+        self.assertEqual(sync_request(b'QUIT', 0), b'QUIT\x00\x00\x00\x00')
+
+    def test_shell_status(self):
+        self.assertEqual(parse_shell_status(b'output\nKYARABEN_STATUS=3\n'), (b'output', 3))
+        self.assertEqual(parse_shell_status(b'\nKYARABEN_STATUS=0\n'), (b'', 0))
+        with self.assertRaises(AdbError):
+            parse_shell_status(b'KYARABEN_STATUS=0 in the output\n')
+
+
+class FakeAdbd:
+    """
+    Serves one connection: answers CNXN, runs shell: streams from a table of
+    outputs, and records the files sent on sync: streams.
+    """
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+        self.files = {}
+        self.commands = []
+
+    async def read_message(self, reader):
+        command, arg0, arg1, length = unpack_header(await reader.readexactly(HEADER.size))
+        data = await reader.readexactly(length) if length else b''
+        return command, arg0, arg1, data
+
+    async def handle(self, reader, writer):
+        sync = {}
+        try:
+            while True:
+                command, arg0, arg1, data = await self.read_message(reader)
+                if command == A_CNXN:
+                    writer.write(pack_message(A_CNXN, A_VERSION, 4096, b'device::\0'))
+                elif command == A_OPEN:
+                    destination = data.rstrip(b'\0').decode('utf8')
+                    remote_id = 100 + arg0
+                    writer.write(pack_message(A_OKAY, remote_id, arg0))
+                    if destination.startswith('shell:'):
+                        self.commands.append(destination[len('shell:'):])
+                        writer.write(pack_message(A_WRTE, remote_id, arg0,
+                                                  self.outputs.pop(0)))
+                        writer.write(pack_message(A_CLSE, remote_id, arg0))
+                    else:
+                        sync[arg0] = b''
+                elif command == A_WRTE:
+                    writer.write(pack_message(A_OKAY, arg1, arg0))
+                    sync[arg0] += data
+                    if sync[arg0].endswith(b'QUIT\0\0\0\0'):
+                        continue
+                    if self.sync_done(sync[arg0]):
+                        writer.write(pack_message(A_WRTE, arg1, arg0, b'OKAY\0\0\0\0'))
+        except asyncio.IncompleteReadError:
+            writer.close()
+
+    def sync_done(self, data):
+        offset = 0
+        path = None
+        content = b''
+        while offset + 8 <= len(data):
+            request = data[offset:offset + 4]
+            length = struct.unpack('<I', data[offset + 4:offset + 8])[0]
+            if request == b'DONE':
+                self.files[path] = content
+                return offset + 8 == len(data)
+            if offset + 8 + length > len(data):
+                return False
+            chunk = data[offset + 8:offset + 8 + length]
+            if request == b'SEND':
+                path = chunk.decode('utf8').split(',')[0]
+            elif request == b'DATA':
+                content += chunk
+            offset += 8 + length
+        return False
+
+
+class TestConnection(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+
+    def connect(self, adbd):
+        server = self.loop.run_until_complete(
+            asyncio.start_server(adbd.handle, '127.0.0.1', 0))
+        port = server.sockets[0].getsockname()[1]
+        conn = AdbConnection('127.0.0.1', port, loop=self.loop)
+        self.loop.run_until_complete(conn.connect())
+
+        def close():
+            conn.close()
+            server.close()
+            self.loop.run_until_complete(asyncio.sleep(0.01))
+
+        self.addCleanup(close)
+        return conn
+
+    def test_shell_status(self):
+        adbd = FakeAdbd([b'package:/data/app/x.apk\r\nKYARABEN_STATUS=0\r\n',
+                         b'Error: unknown package\nKYARABEN_STATUS=1\n'])
+        conn = self.connect(adbd)
+        self.assertEqual(conn.banner, 'device::')
+
+        output, status = self.loop.run_until_complete(conn.shell('pm', 'path', 'x'))
+        self.assertEqual((output, status), (b'package:/data/app/x.apk', 0))
+
+        output, status = self.loop.run_until_complete(conn.shell('pm', 'clear', 'y'))
+        self.assertEqual((output, status), (b'Error: unknown package', 1))
+
+        self.assertTrue(adbd.commands[0].startswith('pm path x;'))
+
+    def test_shell_no_status(self):
+        conn = self.connect(FakeAdbd([b'killed']))
+        with self.assertRaises(AdbError):
+            self.loop.run_until_complete(conn.shell('sleep', '1000'))
+
+    def test_push_stream(self):
+        adbd = FakeAdbd([])
+        conn = self.connect(adbd)
+        content = bytes(range(256)) * 1000
+        reader = asyncio.StreamReader(loop=self.loop)
+        reader.feed_data(content + b'trailer')
+        reader.feed_eof()
+        self.loop.run_until_complete(conn.push_stream(reader, len(content),
+                                                      '/data/local/tmp/a.apk'))
+        self.assertEqual(adbd.files, {'/data/local/tmp/a.apk': content})
+        self.assertEqual(self.loop.run_until_complete(reader.read()), b'trailer')
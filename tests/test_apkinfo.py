@@ -0,0 +1,130 @@
+import hashlib
+import io
+import unittest
+import zipfile
+
+from ats.kyaraben.apkinfo import (apk_fingerprint, component_name, der_header,
+                                  parse_instrumentations, signer_certificate)
+
+
+def der(tag, content):
+    if len(content) < 0x80:
+        return bytes([tag, len(content)]) + content
+    size = (len(content).bit_length() + 7) // 8
+    return bytes([tag, 0x80 | size]) + len(content).to_bytes(size, 'big') + content
+
+
+SIGNED_DATA_OID = der(0x06, bytes.fromhex('2a864886f70d010702'))
+
+
+def pkcs7(*certificates):
+    signed_data = der(0x30, der(0x02, b'\x01') +
+                      der(0x31, b'') +
+                      der(0x30, SIGNED_DATA_OID) +
+                      der(0xa0, b''.join(certificates)) +
+                      der(0x31, b''))
+    return der(0x30, SIGNED_DATA_OID + der(0xa0, signed_data))
+
+
+def make_apk(files):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as apk:
+        for name, content in files.items():
+            apk.writestr(name, content)
+    buf.seek(0)
+    return buf
+
+
+class TestDer(unittest.TestCase):
+    def test_short_length(self):
+        self.assertEqual(der_header(b'\x30\x03abc', 0), (0x30, 2, 3))
+
+    def test_long_length(self):
+        data = der(0x04, b'x' * 300)
+        self.assertEqual(der_header(data, 0), (0x04, 4, 300))
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            der_header(b'\x30\x05abc', 0)
+
+
+class TestSigner(unittest.TestCase):
+    def test_first_certificate(self):
+        cert = der(0x30, der(0x02, b'\x2a') + der(0x04, b'c' * 200))
+        other = der(0x30, der(0x02, b'\x2b'))
+        self.assertEqual(signer_certificate(pkcs7(cert, other)), cert)
+
+    def test_no_certificate(self):
+        with self.assertRaises(ValueError):
+            signer_certificate(der(0x30, SIGNED_DATA_OID))
+
+    def test_fingerprint(self):
+        cert = der(0x30, der(0x02, b'\x2a'))
+        apk = make_apk({
+            'AndroidManifest.xml': b'manifest',
+            'META-INF/MANIFEST.MF': b'Manifest-Version: 1.0',
+            'META-INF/CERT.RSA': pkcs7(cert),
+        })
+        content = apk.getvalue()
+        fingerprint = apk_fingerprint(apk)
+        self.assertEqual(fingerprint.sha256, hashlib.sha256(content).hexdigest())
+        self.assertEqual(fingerprint.signer, hashlib.sha256(cert).hexdigest())
+
+    def test_same_signer(self):
+        cert = der(0x30, der(0x02, b'\x2a'))
+        v1 = apk_fingerprint(make_apk({'classes.dex': b'v1', 'META-INF/CERT.RSA': pkcs7(cert)}))
+        v2 = apk_fingerprint(make_apk({'classes.dex': b'v2', 'META-INF/CERT.RSA': pkcs7(cert)}))
+        self.assertNotEqual(v1.sha256, v2.sha256)
+        self.assertEqual(v1.signer, v2.signer)
+
+    def test_unsigned(self):
+        fingerprint = apk_fingerprint(make_apk({'AndroidManifest.xml': b'manifest'}))
+        self.assertIsNone(fingerprint.signer)
+
+    def test_not_a_zip(self):
+        fingerprint = apk_fingerprint(io.BytesIO(b'not an apk'))
+        self.assertEqual(fingerprint.sha256, hashlib.sha256(b'not an apk').hexdigest())
+        self.assertIsNone(fingerprint.signer)
+
+
+XMLTREE = """N: android=http://schemas.android.com/apk/res/android
+  E: manifest (line=2)
+    A: android:versionCode(0x0101021b)=(type 0x10)0x1
+    A: package="com.example.app.test" (Raw: "com.example.app.test")
+    E: uses-sdk (line=7)
+      A: android:minSdkVersion(0x0101020c)=(type 0x10)0x12
+    E: instrumentation (line=11)
+      A: android:label(0x01010001)="Tests for com.example.app" (Raw: "Tests for com.example.app")
+      A: android:name(0x01010003)="android.support.test.runner.AndroidJUnitRunner" (Raw: "android.support.test.runner.AndroidJUnitRunner")
+      A: android:targetPackage(0x01010021)="com.example.app" (Raw: "com.example.app")
+    E: instrumentation (line=15)
+      A: android:name(0x01010003)=".SmokeRunner" (Raw: ".SmokeRunner")
+      A: android:targetPackage(0x01010021)="com.example.app" (Raw: "com.example.app")
+      E: meta-data (line=16)
+        A: android:name(0x01010003)="listener" (Raw: "listener")
+    E: application (line=18)
+      E: uses-library (line=19)
+        A: android:name(0x01010003)="android.test.runner" (Raw: "android.test.runner")
+"""
+
+
+class TestInstrumentations(unittest.TestCase):
+    def test_component_name(self):
+        self.assertEqual(component_name('com.example', 'com.example.Runner'), 'com.example/.Runner')
+        self.assertEqual(component_name('com.example', '.Runner'), 'com.example/.Runner')
+        self.assertEqual(component_name('com.example', 'Runner'), 'com.example/.Runner')
+        self.assertEqual(component_name('com.example', 'org.junit.Runner'), 'com.example/org.junit.Runner')
+
+    def test_parse(self):
+        self.assertEqual(parse_instrumentations(XMLTREE.splitlines()), [
+            'com.example.app.test/android.support.test.runner.AndroidJUnitRunner',
+            'com.example.app.test/.SmokeRunner',
+        ])
+
+    def test_no_instrumentation(self):
+        lines = XMLTREE.splitlines()[:6]
+        self.assertEqual(parse_instrumentations(lines), [])
+
+    def test_no_package(self):
+        with self.assertRaises(ValueError):
+            parse_instrumentations(['N: android=http://schemas.android.com/apk/res/android'])
@@ -0,0 +1,39 @@
+import asyncio
+import threading
+import unittest
+
+from ats.kyaraben.blocking import io_executor, run_blocking, setup_loop_debug
+
+
+CONFIG = {
+    'asyncio': {
+        'debug': True,
+        'slow_callback_duration': 0.5,
+        'io_threads': 2,
+    }
+}
+
+
+class App:
+    def __init__(self, loop):
+        self.loop = loop
+        self.executor = io_executor(CONFIG)
+
+
+class TestBlocking(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_run_blocking(self):
+        app = App(self.loop)
+        thread = self.loop.run_until_complete(run_blocking(app, threading.current_thread))
+        self.assertIsNot(thread, threading.current_thread())
+        app.executor.shutdown()
+
+    def test_loop_debug(self):
+        setup_loop_debug(self.loop, CONFIG)
+        self.assertTrue(self.loop.get_debug())
+        self.assertEqual(self.loop.slow_callback_duration, 0.5)
@@ -0,0 +1,92 @@
+import asyncio
+import hashlib
+import io
+import tarfile
+import unittest
+
+from ats.kyaraben.docker import (TAR_BLOCK, tar_copy_content, tar_header_size,
+                                 tar_read_file_header, tar_rename)
+
+
+def make_tar(name, content):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w', format=tarfile.PAX_FORMAT) as tar:
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        tar.addfile(info, io.BytesIO(content))
+    return buf.getvalue()
+
+
+def stream_reader(data):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    return reader
+
+
+class BufferWriter:
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+
+def run(coro):
+    return asyncio.new_event_loop().run_until_complete(coro)
+
+
+class TestTar(unittest.TestCase):
+    def test_rename(self):
+        archive = make_tar('signed.apk', b'apk content')
+        header = tar_rename(archive[:TAR_BLOCK], 'f00d.apk')
+        with tarfile.open(fileobj=io.BytesIO(header + archive[TAR_BLOCK:]), mode='r:') as tar:
+            member = tar.next()
+            self.assertEqual(member.name, 'f00d.apk')
+            self.assertEqual(tar.extractfile(member).read(), b'apk content')
+
+    def test_rename_too_long(self):
+        with self.assertRaises(ValueError):
+            tar_rename(make_tar('a', b'')[:TAR_BLOCK], 'x' * 101)
+
+    def test_header_size(self):
+        self.assertEqual(tar_header_size(make_tar('a', b'x' * 1000)[:TAR_BLOCK]), 1000)
+
+    def test_copy(self):
+        content = b'x' * 1500
+        archive = make_tar('signed.apk', content)
+
+        async def copy():
+            reader = stream_reader(archive)
+            writer = BufferWriter()
+            digest = hashlib.sha256()
+            header = await tar_read_file_header(reader)
+            writer.write(tar_rename(header, 'f00d.apk'))
+            await tar_copy_content(reader, writer, size=tar_header_size(header), digest=digest)
+            writer.write(await reader.read())
+            return writer.data, digest.hexdigest()
+
+        data, sha256 = run(copy())
+        self.assertEqual(sha256, hashlib.sha256(content).hexdigest())
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r:') as tar:
+            self.assertEqual(tar.getnames(), ['f00d.apk'])
+
+    def test_skip_extended_header(self):
+        # a long name is stored in an extended header, which is dropped
+        archive = make_tar('d' * 120 + '.apk', b'content')
+
+        async def read():
+            return await tar_read_file_header(stream_reader(archive))
+
+        header = run(read())
+        self.assertEqual(tar_header_size(header), len(b'content'))
+
+    def test_not_a_file(self):
+        async def read():
+            return await tar_read_file_header(stream_reader(bytes(2 * TAR_BLOCK)))
+
+        with self.assertRaises(ValueError):
+            run(read())
@@ -0,0 +1,65 @@
+import json
+import logging
+import unittest
+
+import asynctest
+
+from ats.kyaraben.model.android import AndroidVM
+from ats.kyaraben.monitor.events import ContainerEventWatcher, down_containers
+
+log = logging.getLogger(__name__)
+
+AVM_ID = 'a' * 32
+
+
+def docker_event(service, action, **attributes):
+    attributes['name'] = '{}_{}'.format(AVM_ID, service)
+    return json.dumps({'Action': action, 'time': 1, 'Actor': {'Attributes': attributes}})
+
+
+class FakeWatcher(ContainerEventWatcher):
+    def __init__(self, ps_lines):
+        super().__init__(app=None)
+        self.ps_lines = ps_lines
+
+    async def list_containers(self, avm_id, log):
+        return self.ps_lines
+
+
+class TestDownContainers(unittest.TestCase):
+    def test_status(self):
+        down = down_containers([
+            '{}_adb\tUp 3 minutes'.format(AVM_ID),
+            '{}_sdl\tExited (137) 2 minutes ago'.format(AVM_ID),
+            '{}_sensors\tUp 3 minutes (unhealthy)'.format(AVM_ID),
+            '{}_camera\tCreated'.format(AVM_ID),
+            'other\tExited (1) 1 minute ago',
+            '',
+        ])
+        self.assertEqual(down, {'sdl': 'died (exit code 137)',
+                                'sensors': 'is unhealthy',
+                                'camera': 'is not running'})
+
+
+class TestContainerEvents(asynctest.TestCase):
+    @asynctest.patch.object(AndroidVM, 'container_up')
+    @asynctest.patch.object(AndroidVM, 'container_down')
+    async def test_two_down_one_restarted(self, container_down, container_up):
+        # adb then sdl die, adb is restarted: sdl is still down
+        watcher = FakeWatcher(['{}_adb\tUp 1 second'.format(AVM_ID),
+                               '{}_sdl\tExited (1) 1 minute ago'.format(AVM_ID)])
+        await watcher.handle_event(docker_event('adb', 'die', exitCode='137'), log)
+        await watcher.handle_event(docker_event('sdl', 'die', exitCode='1'), log)
+        await watcher.handle_event(docker_event('adb', 'start'), log)
+
+        self.assertEqual(container_down.call_count, 2)
+        container_up.assert_called_once_with(None, service='adb',
+                                             still_down={'sdl': 'died (exit code 1)'})
+
+    @asynctest.patch.object(AndroidVM, 'container_up')
+    async def test_all_restarted(self, container_up):
+        watcher = FakeWatcher(['{}_adb\tUp 1 second'.format(AVM_ID),
+                               '{}_sdl\tUp 1 minute'.format(AVM_ID)])
+        await watcher.handle_event(docker_event('sdl', 'start'), log)
+
+        container_up.assert_called_once_with(None, service='sdl', still_down={})
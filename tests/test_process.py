@@ -5,7 +5,7 @@ import logging
 import tempfile
 import unittest
 
-from ats.kyaraben.process import aiorun, ProcessError, quoted_cmdline
+from ats.kyaraben.process import aiorun, aiorun_lines, ProcessError, quoted_cmdline
 
 log = logging.getLogger(__name__)
 
@@ -160,3 +160,15 @@ class TestAiorun(asynctest.TestCase):
     async def test_stdin(self):
         r = await aiorun('cat', stdin_bytes=b'some data', log=log)
         self.assertEqual(r.out, 'some data')
+
+    async def test_lines_stderr(self):
+        # more than a pipe buffer on stderr, before the line on stdout
+        lines = []
+
+        async def callback(line):
+            lines.append(line)
+
+        status = await aiorun_lines('sh', '-c', 'head -c 200000 /dev/zero >&2; echo done',
+                                    log=log, callback=callback)
+        self.assertEqual(status, 0)
+        self.assertEqual(lines, ['done'])
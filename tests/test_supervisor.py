@@ -0,0 +1,49 @@
+import argparse
+import multiprocessing
+import unittest
+
+from ats.kyaraben.worker.supervisor import Child, Supervisor
+
+
+class DeadProcess:
+    pid = 1234
+    exitcode = 1
+
+    def is_alive(self):
+        return False
+
+
+def supervisor(*, processes, tasks=0):
+    return Supervisor(target=None,
+                      args=argparse.Namespace(processes=processes, tasks=tasks),
+                      processes=processes,
+                      drain_timeout=1,
+                      metrics_interval=1)
+
+
+class TestSupervisor(unittest.TestCase):
+    def test_split_tasks(self):
+        sup = supervisor(processes=3, tasks=10)
+        self.assertEqual([sup.slot_tasks(slot) for slot in range(sup.processes)], [4, 3, 3])
+
+    def test_fewer_tasks_than_processes(self):
+        sup = supervisor(processes=4, tasks=2)
+        self.assertEqual(sup.processes, 2)
+        self.assertEqual([sup.slot_tasks(slot) for slot in range(sup.processes)], [1, 1])
+
+    def test_loop_forever(self):
+        sup = supervisor(processes=2)
+        self.assertEqual(sup.slot_tasks(1), 0)
+
+    def test_early_exit(self):
+        # a worker that exits before restart_delay is not restarted at once,
+        # and its closed connection must not be waited on
+        sup = supervisor(processes=1)
+        parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+        child_conn.close()
+        sup.children[0] = Child(DeadProcess(), parent_conn)
+
+        sup.check_children()
+
+        self.assertIsNone(sup.children[0].conn)
+        sup.receive_metrics(timeout=0)
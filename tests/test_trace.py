@@ -0,0 +1,109 @@
+import asyncio
+import unittest
+
+from ats.kyaraben.trace import TraceError, parse_trace
+from ats.kyaraben.worker.replay import TraceReplayer, event_ticks
+
+
+class TestParseTrace(unittest.TestCase):
+    def test_parse(self):
+        events = parse_trace([
+            b'{"t": 1.5, "key": "gps", "text": "fix 1"}\n',
+            b'\n',
+            b'{"t": 0, "key": "sensors.accelerometer", "payload": "AAE="}\n',
+        ], max_events=10)
+        self.assertEqual(events, [[0.0, 'sensors.accelerometer', 'AAE='],
+                                  [1.5, 'gps', 'Zml4IDE=']])
+
+    def test_errors(self):
+        for line, error in [
+            ('not json', 'line 1: invalid JSON'),
+            ('{"t": -1, "key": "gps", "text": ""}', 'line 1: t must be a positive number'),
+            ('{"t": NaN, "key": "gps", "text": ""}', 'line 1: t must be a positive number'),
+            ('{"t": Infinity, "key": "gps", "text": ""}', 'line 1: t must be a positive number'),
+            ('{"t": 0, "key": "wifi", "text": ""}', 'line 1: key must start with'),
+            ('{"t": 0, "key": "gps", "payload": "%%"}', 'line 1: payload is not valid base64'),
+            ('{"t": 0, "key": "gps"}', 'line 1: payload or text is required'),
+        ]:
+            with self.assertRaisesRegex(TraceError, '^' + error):
+                parse_trace([line], max_events=10)
+
+    def test_limits(self):
+        with self.assertRaisesRegex(TraceError, 'no event'):
+            parse_trace([''], max_events=10)
+        with self.assertRaisesRegex(TraceError, 'too many events'):
+            parse_trace(['{"t": 0, "key": "gps", "text": ""}'] * 3, max_events=2)
+
+
+class TestEventTicks(unittest.TestCase):
+    events = [[0.0, 'gps', 'YQ=='],
+              [0.005, 'gps', 'Yg=='],
+              [0.5, 'gps', 'Yw=='],
+              [1.0, 'battery', 'ZA==']]
+
+    def test_window(self):
+        ticks = list(event_ticks(self.events, start=0, window=0.01))
+        self.assertEqual(ticks, [(0.0, [('gps', b'a'), ('gps', b'b')]),
+                                 (0.5, [('gps', b'c')]),
+                                 (1.0, [('battery', b'd')])])
+
+    def test_resume(self):
+        ticks = list(event_ticks(self.events, start=0.5, window=1))
+        self.assertEqual(ticks, [(0.5, [('gps', b'c'), ('battery', b'd')])])
+
+
+class FakeReplay:
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+
+    async def get_status(self, app):
+        return self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+
+    async def update_progress(self, app, **progress):
+        pass
+
+
+class FakeChannel:
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, payload, *, exchange_name, routing_key):
+        self.published.append((routing_key, payload))
+
+
+class FakeLog:
+    def info(self, *args, **kwargs):
+        pass
+
+
+class TestTraceReplayer(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+
+    def replayer(self, statuses, events):
+        return TraceReplayer(None, FakeLog(),
+                             replay=FakeReplay(statuses),
+                             events=events,
+                             avm_ids=['a' * 32],
+                             time_scale=1,
+                             batch_window=0.01,
+                             progress_interval=0.02)
+
+    def test_stopped_in_gap(self):
+        replayer = self.replayer(['RUNNING', 'STOPPING'],
+                                 [[0.0, 'gps', 'YQ=='], [3600.0, 'gps', 'Yg==']])
+        channel = FakeChannel()
+        ts_start = self.loop.time()
+        completed = self.loop.run_until_complete(asyncio.wait_for(replayer.play(channel), 5))
+        self.assertFalse(completed)
+        self.assertLess(self.loop.time() - ts_start, 1)
+        self.assertEqual(channel.published, [('android-events.{}.gps'.format('a' * 32), b'a')])
+
+    def test_completed(self):
+        replayer = self.replayer(['RUNNING'],
+                                 [[0.0, 'gps', 'YQ=='], [0.05, 'gps', 'Yg==']])
+        channel = FakeChannel()
+        self.assertTrue(self.loop.run_until_complete(replayer.play(channel)))
+        self.assertEqual(len(channel.published), 2)
@@ -0,0 +1,55 @@
+import asyncio
+import unittest
+
+from ats.kyaraben.worker.transcode import TranscodeBusy, TranscodePool, source_extension
+
+
+class TestTranscodePool(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_extension(self):
+        self.assertEqual(source_extension('Logo.PNG'), '.png')
+        self.assertEqual(source_extension('video'), '')
+
+    def test_bounded(self):
+        pool = TranscodePool(size=2, queue_max=10)
+        running = []
+        peak = []
+
+        async def convert():
+            running.append(1)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+            return 'done'
+
+        async def run_all():
+            return await asyncio.gather(*[pool.run(convert) for _ in range(5)])
+
+        results = self.loop.run_until_complete(run_all())
+        self.assertEqual([ret for ret, seconds in results], ['done'] * 5)
+        self.assertTrue(all(seconds >= 0 for ret, seconds in results))
+        self.assertEqual(max(peak), 2)
+
+    def test_busy(self):
+        pool = TranscodePool(size=1, queue_max=1)
+        release = asyncio.Event()
+
+        async def convert():
+            await release.wait()
+
+        async def run_all():
+            first = asyncio.ensure_future(pool.run(convert))
+            second = asyncio.ensure_future(pool.run(convert))
+            await asyncio.sleep(0)
+            with self.assertRaises(TranscodeBusy):
+                await pool.run(convert)
+            release.set()
+            await asyncio.gather(first, second)
+
+        self.loop.run_until_complete(run_all())